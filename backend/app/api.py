@@ -1,29 +1,158 @@
+import datetime
 import fastapi
-import sqlalchemy.orm
+import math
+import os
+import pydantic
+import sqlalchemy.exc
+import sqlalchemy.ext.asyncio
+import time
 import typing
-from . import schemas, data_access, database, models
+from starlette.datastructures import MutableHeaders
+from . import cache, compression, schemas, data_access, database, etags
+from . import export, metrics, migrations, ratelimit, security, tracing
 
 
-# Create DB
-models.Base.metadata.create_all(bind=database.engine)
-
 _VERSION = "/api/v.1"
 _SESSION_KEY = "api_key"
+_CHARGE_PAGE_MAX_SIZE = 1000
+_EXPORT_BATCH_SIZE = 1000
+_READ_PRIMARY_COOKIE = "read_primary_until"
+
+# Seconds a client reads from the primary after writing, the time the
+# replica may take to catch up with its writes
+REPLICA_STALENESS_SECONDS = float(
+    os.environ.get("REPLICA_STALENESS_SECONDS", 5)
+)
+# By client IP address, see FORWARDED_ALLOW_IPS for clients behind a proxy
+recent_writers = cache.TTLCache(
+    maxsize=65536, ttl=REPLICA_STALENESS_SECONDS
+)
+
+rate_limiter = ratelimit.create_rate_limiter()
+
+# Apply pending migrations when the server starts, turn it off when
+# `manage migrate` runs before the workers are started
+MIGRATE_ON_STARTUP = os.environ.get("MIGRATE_ON_STARTUP", "1") == "1"
+
+
+class ReadPrimaryCookieMiddleware:
+    """ Read Primary Cookie Middleware
+
+    Send the cookie of `track_write` once, on the response the client
+    gets. FastAPI copies the headers dependencies set once per
+    sub-dependency, so `track_write` only leaves the time on the request
+    state.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            until = scope.get("state", {}).get("read_primary_until")
+            if message["type"] == "http.response.start" and until:
+                cookie = fastapi.Response()
+                cookie.set_cookie(
+                    key=_READ_PRIMARY_COOKIE,
+                    value=f"{until:.3f}",
+                    max_age=math.ceil(REPLICA_STALENESS_SECONDS),
+                )
+                MutableHeaders(scope=message).append(
+                    "set-cookie", cookie.headers["set-cookie"]
+                )
+
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
 
 
 app = fastapi.FastAPI(
     openapi_url=_VERSION + "/openapi.json",
     docs_url=_VERSION + "/docs",
+    default_response_class=fastapi.responses.ORJSONResponse,
+)
+app.add_middleware(ReadPrimaryCookieMiddleware)
+app.add_middleware(compression.CompressionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(tracing.TracingMiddleware)
+metrics.install_sql_listeners()
+tracing.install_sql_listeners()
+metrics.registry.add_collector(
+    metrics.cache_collector(
+        {
+            "api_key": data_access.api_key_cache.cache_info,
+            "charge_page": data_access.charge_page_cache.statistics,
+            "cpf_cnpj": data_access.docs.cache_info,
+        }
+    )
 )
 
 
 # Dependency
-def get_db():
-    db = database.SessionLocal()
+async def _close_session(db: database.AnySession):
+    if isinstance(db, sqlalchemy.ext.asyncio.AsyncSession):
+        await db.close()
+    else:
+        await fastapi.concurrency.run_in_threadpool(db.close)
+
+
+def _client_key(request: fastapi.Request) -> str:
+    return request.client.host if request.client else ""
+
+
+def track_write(request: fastapi.Request):
+    """ Track Write
+
+    Dependency of the endpoints that write, the client reads from the
+    primary for a while so it sees its own writes. The cookie, sent by
+    `ReadPrimaryCookieMiddleware`, carries that to the other workers.
+    """
+    recent_writers.set(_client_key(request), True)
+    request.state.read_primary_until = time.time() + REPLICA_STALENESS_SECONDS
+
+
+def reads_from_primary(request: fastapi.Request) -> bool:
+    if recent_writers.get(_client_key(request)):
+        return True
+
+    try:
+        until = float(request.cookies.get(_READ_PRIMARY_COOKIE, 0))
+    except ValueError:
+        return False
+
+    return until > time.time()
+
+
+async def get_db(request: fastapi.Request):
+    """ Get DB
+
+    Session of the request, the endpoint and its dependencies, e.g.
+    `current_principal`, share it so a request holds one connection at
+    most. Endpoints that write use the primary. The others use the
+    replica, or the read only pool, unless the client wrote in the last
+    `REPLICA_STALENESS_SECONDS`, then the primary is used.
+    """
+    if request.method not in ("GET", "HEAD") or reads_from_primary(request):
+        db = (
+            database.AsyncSessionLocal()
+            if database.SQLALCHEMY_ASYNC
+            else database.SessionLocal()
+        )
+    else:
+        db = (
+            database.AsyncReadSessionLocal()
+            if database.SQLALCHEMY_ASYNC
+            else database.ReadSessionLocal()
+        )
+
     try:
         yield db
     finally:
-        db.close()
+        await _close_session(db)
 
 
 def get_api_key_from_request(request: fastapi.Request):
@@ -32,6 +161,129 @@ def get_api_key_from_request(request: fastapi.Request):
     )
 
 
+async def current_principal(
+    request: fastapi.Request,
+    api_key: str = None,
+    db: database.AnySession = fastapi.Depends(get_db),
+) -> data_access.Principal:
+    """ Current Principal
+
+    Dependency of the authenticated endpoints, the API key of the query or
+    the session cookie is resolved to its owner once per request. It costs
+    one query, none when the key is on `api_key_cache`.
+
+    A missing or unknown key spends a token of the client IP address
+    before the 403, guessing keys is limited like `rate_limit`.
+    """
+    # `api_key` is declared for the docs, the cookie is read as well
+    try:
+        return await data_access.run(
+            db,
+            data_access.get_principal,
+            api_key=get_api_key_from_request(request),
+        )
+    except data_access.APIKeyNotFound:
+        rate_limit(request)
+        raise
+
+
+def rate_limit(request: fastapi.Request):
+    """ Rate Limit
+
+    Dependency of the API endpoints without authentication, spends a token
+    of the client IP address on the budget of the endpoint, named after its
+    function. An API key sent along is ignored, made up keys must not get
+    budgets of their own.
+    """
+    rate_limiter.hit(
+        request.scope["endpoint"].__name__,
+        ratelimit.client_key(None, _client_key(request)),
+    )
+
+
+def rate_limit_principal(
+    request: fastapi.Request,
+    principal: data_access.Principal = fastapi.Depends(current_principal),
+):
+    """ Rate Limit Principal
+
+    `rate_limit` of the authenticated endpoints, the token is spent from
+    the budget of the API key once `current_principal` found it valid.
+    Invalid keys are charged to the IP by `current_principal`.
+    """
+    rate_limiter.hit(
+        request.scope["endpoint"].__name__,
+        ratelimit.client_key(principal.api_key_id, _client_key(request)),
+    )
+
+
+async def idempotent(
+    request: fastapi.Request,
+    db: database.AnySession,
+    principal: data_access.Principal,
+    idempotency_key: typing.Optional[str],
+    payload: pydantic.BaseModel,
+    status_code: int,
+    write: typing.Callable[[], typing.Awaitable],
+):
+    """ Idempotent
+
+    Run `write` once per Idempotency-Key of the client on the endpoint,
+    retries with the key get the first response back from
+    `idempotency_keys` and never reach the charge tables. Without a key
+    `write` just runs.
+
+    Args:
+        payload (BaseModel): body of the request, a retry must send the
+         same one
+        write (callable): coroutine function of the endpoint, returns a
+         charge
+    """
+    if idempotency_key is None:
+        return await write()
+
+    arguments = {
+        "principal": principal,
+        "route": request.scope["endpoint"].__name__,
+        "key": idempotency_key,
+        "claimed_at": datetime.datetime.utcnow(),
+    }
+    stored = await data_access.run(
+        db,
+        data_access.claim_idempotency_key,
+        request_hash=data_access.idempotency_digest(payload.json()),
+        **arguments,
+    )
+    if stored is not None:
+        return fastapi.Response(
+            stored.body,
+            status_code=stored.status_code,
+            media_type="application/json",
+            headers={"Idempotent-Replayed": "true"},
+        )
+
+    try:
+        charge = await write()
+    except BaseException:
+        await data_access.run(
+            db, data_access.release_idempotency_key, **arguments
+        )
+        raise
+
+    response = fastapi.responses.ORJSONResponse(
+        schemas.ChargeDatabase.from_orm(charge).dict(),
+        status_code=status_code,
+    )
+    await data_access.run(
+        db,
+        data_access.save_idempotent_response,
+        status_code=response.status_code,
+        body=response.body,
+        **arguments,
+    )
+    return response
+
+
 @app.exception_handler(data_access.DataAccessException)
 def handle_data_access_error(
     request: fastapi.Request, exception: data_access.DataAccessException
@@ -44,6 +296,23 @@ def handle_data_access_error(
             status_code=400, content={"detail": str(exception)}
         )
 
+    if isinstance(exception, data_access.Conflict):
+        return fastapi.responses.JSONResponse(
+            status_code=409, content={"detail": str(exception)}
+        )
+
+    if isinstance(exception, data_access.IdempotencyKeyInUse):
+        return fastapi.responses.JSONResponse(
+            status_code=409,
+            content={"detail": str(exception)},
+            headers={"Retry-After": "1"},
+        )
+
+    if isinstance(exception, data_access.IdempotencyKeyMismatch):
+        return fastapi.responses.JSONResponse(
+            status_code=422, content={"detail": str(exception)}
+        )
+
     if isinstance(exception, data_access.DoesNotExisit):
         return fastapi.responses.JSONResponse(
             status_code=404, content={"detail": str(exception)}
@@ -52,47 +321,148 @@ def handle_data_access_error(
     raise exception
 
 
-@app.post(_VERSION + "/entity", status_code=201, response_model=schemas.Entity)
-def create_entity(
+@app.exception_handler(security.PasswordHasherBusy)
+def handle_password_hasher_busy(
+    request: fastapi.Request, exception: security.PasswordHasherBusy
+):
+    return fastapi.responses.JSONResponse(
+        status_code=503,
+        content={"detail": "Too many password checks, try again"},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(ratelimit.RateLimitExceeded)
+def handle_rate_limit_exceeded(
+    request: fastapi.Request, exception: ratelimit.RateLimitExceeded
+):
+    return fastapi.responses.JSONResponse(
+        status_code=429,
+        content={"detail": "Too many requests, try again later"},
+        headers={"Retry-After": exception.retry_after_header},
+    )
+
+
+@app.exception_handler(sqlalchemy.exc.TimeoutError)
+def handle_pool_exhausted(
+    request: fastapi.Request, exception: sqlalchemy.exc.TimeoutError
+):
+    # Every connection is in use and none was released within the pool
+    # timeout, fail now instead of holding the request
+    return fastapi.responses.JSONResponse(
+        status_code=503,
+        content={"detail": "Database is busy, try again"},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.on_event("startup")
+async def migrate_database():
+    if MIGRATE_ON_STARTUP:
+        await fastapi.concurrency.run_in_threadpool(
+            migrations.upgrade, database.engine
+        )
+
+
+@app.on_event("shutdown")
+def shutdown_password_hasher():
+    security.shutdown()
+
+
+# Scraped from inside the network, nginx only proxies /api. Values are of
+# the worker that answers, see `metrics`
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    return fastapi.Response(
+        metrics.registry.render(), media_type=metrics.CONTENT_TYPE
+    )
+
+
+@app.post(
+    _VERSION + "/entity",
+    status_code=201,
+    response_model=schemas.Entity,
+    dependencies=[
+        fastapi.Depends(rate_limit),
+        fastapi.Depends(track_write),
+    ],
+)
+async def create_entity(
     entity: schemas.EntityCreate,
-    db: sqlalchemy.orm.Session = fastapi.Depends(get_db),
+    db: database.AnySession = fastapi.Depends(get_db),
 ):
-    return data_access.create_entity(
-        db, entity=schemas.Entity(**entity.dict()), password=entity.password,
+    return await data_access.run(
+        db,
+        data_access.create_entity,
+        entity=schemas.Entity(**entity.dict()),
+        password=entity.password,
     )
 
 
-@app.get(_VERSION + "/entity/{cpf_cnpj}", response_model=schemas.Entity)
-def read_entity(
+@app.get(
+    _VERSION + "/entity/{cpf_cnpj}",
+    response_model=schemas.Entity,
+    dependencies=[
+        fastapi.Depends(rate_limit_principal),
+        fastapi.Depends(current_principal),
+    ],
+)
+async def read_entity(
     cpf_cnpj: schemas.CpfOrCnpj,
-    api_key: str = None,
-    db: sqlalchemy.orm.Session = fastapi.Depends(get_db),
+    response: fastapi.Response,
+    if_none_match: str = fastapi.Header(None),
+    db: database.AnySession = fastapi.Depends(get_db),
 ):
-    return data_access.get_entity_by_cpf_cnpj(
-        db, cpf_cnpj=cpf_cnpj, api_key=api_key, raise_error=True
+    db_entity = await data_access.run(
+        db,
+        data_access.get_entity_by_cpf_cnpj,
+        cpf_cnpj=cpf_cnpj,
+        raise_error=True,
     )
 
+    tag = etags.make(db_entity.cpf_cnpj, db_entity.name, db_entity.type_entity)
+    if etags.matches(if_none_match, tag):
+        return etags.not_modified(tag)
 
-@app.get(_VERSION + "/entity-logged", response_model=schemas.Entity)
-def read_entity_logged(
-    request: fastapi.Request,
-    api_key: str = None,
-    db: sqlalchemy.orm.Session = fastapi.Depends(get_db),
+    etags.set_headers(response, tag)
+    return db_entity
+
+
+@app.get(
+    _VERSION + "/entity-logged",
+    response_model=schemas.Entity,
+    dependencies=[fastapi.Depends(rate_limit_principal)],
+)
+async def read_entity_logged(
+    principal: data_access.Principal = fastapi.Depends(current_principal),
 ):
-    return data_access.get_entity_by_api_key(
-        db, get_api_key_from_request(request)
-    )
+    if principal.entity is None:
+        raise data_access.DoesNotExisit("Entity does not exist")
 
+    return principal.entity
 
-@app.get(_VERSION + "/entity", response_model=typing.List[schemas.Entity])
-def filter_entity(
+
+@app.get(
+    _VERSION + "/entity",
+    response_model=typing.List[schemas.Entity],
+    dependencies=[
+        fastapi.Depends(rate_limit_principal),
+        fastapi.Depends(current_principal),
+    ],
+)
+async def filter_entity(
     type_entity: schemas.EntityTypeEnum = None,
     limit: int = 100,
-    api_key: str = None,
-    db: sqlalchemy.orm.Session = fastapi.Depends(get_db),
+    db: database.AnySession = fastapi.Depends(get_db),
 ):
-    return data_access.filter_entity_by_type(
-        db=db, type_entity=type_entity, limit=limit, api_key=api_key
+    entities = await data_access.run(
+        db,
+        data_access.filter_entity_by_type,
+        type_entity=type_entity,
+        limit=limit,
+    )
+    return fastapi.responses.ORJSONResponse(
+        [schemas.entity_dict(entity) for entity in entities]
     )
 
 
@@ -100,91 +470,273 @@ def filter_entity(
     _VERSION + "/charge",
     status_code=201,
     response_model=schemas.ChargeDatabase,
+    dependencies=[
+        fastapi.Depends(rate_limit_principal),
+        fastapi.Depends(track_write),
+    ],
 )
-def create_charge(
+async def create_charge(
     request: fastapi.Request,
     charge: schemas.ChargeCreate,
-    api_key: str = None,
-    db: sqlalchemy.orm.Session = fastapi.Depends(get_db),
+    idempotency_key: str = fastapi.Header(None),
+    principal: data_access.Principal = fastapi.Depends(current_principal),
+    db: database.AnySession = fastapi.Depends(get_db),
+):
+    async def write():
+        return await data_access.run(
+            db, data_access.create_charge, charge=charge, principal=principal
+        )
+
+    return await idempotent(
+        request,
+        db,
+        principal,
+        idempotency_key,
+        charge,
+        status_code=201,
+        write=write,
+    )
+
+
+@app.post(
+    _VERSION + "/charge/batch",
+    response_model=schemas.ChargeBatchResult,
+    dependencies=[
+        fastapi.Depends(rate_limit_principal),
+        fastapi.Depends(track_write),
+    ],
+)
+async def create_charge_batch(
+    batch: schemas.ChargeBatchCreate,
+    principal: data_access.Principal = fastapi.Depends(current_principal),
+    db: database.AnySession = fastapi.Depends(get_db),
+):
+    """ Create Charge Batch
+
+    Create up to 5000 charges at once, each item of `results` tells how its
+    charge went using the status code `POST /charge` would have returned.
+    """
+    return await data_access.run(
+        db,
+        data_access.create_charges,
+        charges=batch.charges,
+        principal=principal,
+    )
+
+
+@app.get(
+    _VERSION + "/charge/export",
+    dependencies=[
+        fastapi.Depends(rate_limit_principal),
+        fastapi.Depends(current_principal),
+    ],
+)
+async def export_charge(
+    debtor_cpf_cnpj: schemas.CpfOrCnpj = None,
+    creditor_cpf_cnpj: schemas.CpfOrCnpj = None,
+    is_active: bool = None,
+    export_format: schemas.ExportFormatEnum = fastapi.Query(
+        schemas.ExportFormatEnum.ndjson, alias="format"
+    ),
+    db: database.AnySession = fastapi.Depends(get_db),
 ):
-    return data_access.create_charge(
-        db=db, charge=charge, api_key=get_api_key_from_request(request)
+    """ Export Charge
+
+    Stream every charge matching the filter as NDJSON or CSV, rows are
+    read and sent in chunks so memory does not grow with the result.
+    """
+    charge_filter = schemas.ChargeFilter(
+        debtor_cpf_cnpj=debtor_cpf_cnpj,
+        creditor_cpf_cnpj=creditor_cpf_cnpj,
+        is_active=is_active,
+    )
+    partitions = data_access.stream(
+        db,
+        data_access.charge_export_statement(charge_filter),
+        batch_size=_EXPORT_BATCH_SIZE,
+    )
+    filename = f"charges.{export_format.value}"
+    return fastapi.responses.StreamingResponse(
+        export.encode(export_format, partitions),
+        media_type=export.MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
 
 @app.get(
-    _VERSION + "/charge/{charge_id}", response_model=schemas.ChargeDatabase
+    _VERSION + "/charge/{charge_id}",
+    response_model=schemas.ChargeDatabase,
+    dependencies=[
+        fastapi.Depends(rate_limit_principal),
+        fastapi.Depends(current_principal),
+    ],
 )
-def read_charge(
+async def read_charge(
     charge_id: str,
-    api_key: str = None,
-    db: sqlalchemy.orm.Session = fastapi.Depends(get_db),
+    response: fastapi.Response,
+    if_none_match: str = fastapi.Header(None),
+    db: database.AnySession = fastapi.Depends(get_db),
 ):
-    return data_access.get_charge_by_id(
-        db, charge_id=charge_id, api_key=api_key
+    db_charge = await data_access.run(
+        db, data_access.get_charge_by_id, charge_id=charge_id
     )
 
+    tag = etags.make(etags.charge_version(db_charge.id, db_charge.version))
+    if etags.matches(if_none_match, tag):
+        return etags.not_modified(tag)
+
+    etags.set_headers(response, tag)
+    return db_charge
+
 
 @app.get(
-    _VERSION + "/charge", response_model=typing.List[schemas.ChargeFullInfo]
+    _VERSION + "/charge",
+    response_model=typing.List[schemas.ChargeFullInfo],
+    dependencies=[fastapi.Depends(rate_limit_principal)],
 )
-def filter_charge(
-    request: fastapi.Request,
+async def filter_charge(
     debtor_cpf_cnpj: schemas.CpfOrCnpj = None,
     creditor_cpf_cnpj: schemas.CpfOrCnpj = None,
     is_active: bool = None,
-    api_key: str = None,
-    db: sqlalchemy.orm.Session = fastapi.Depends(get_db),
+    limit: int = fastapi.Query(100, ge=1, le=_CHARGE_PAGE_MAX_SIZE),
+    cursor: str = None,
+    if_none_match: str = fastapi.Header(None),
+    principal: data_access.Principal = fastapi.Depends(current_principal),
+    db: database.AnySession = fastapi.Depends(get_db),
 ):
+    """ Filter Charge
+
+    The result is paginated, when there are more charges the
+    `X-Next-Cursor` header holds the `cursor` of the next page. Pages
+    carry an ETag, send it on `If-None-Match` to get 304 when they did not
+    change.
+    """
     charge_filter = schemas.ChargeFilter(
         debtor_cpf_cnpj=debtor_cpf_cnpj,
         creditor_cpf_cnpj=creditor_cpf_cnpj,
         is_active=is_active,
     )
 
-    return data_access.filter_charge(
+    page = await data_access.run(
         db,
+        data_access.filter_charge,
         charge_filter=charge_filter,
-        api_key=get_api_key_from_request(request),
+        principal=principal,
+        limit=limit,
+        cursor=cursor,
     )
+    # The debtor and creditor of the items are part of the body too
+    tag = etags.make(
+        page.next_cursor,
+        *(
+            (
+                etags.charge_version(item["id"], version),
+                item["debtor"],
+                item["creditor"],
+            )
+            for item, version in zip(page.items, page.versions)
+        ),
+    )
+    if etags.matches(if_none_match, tag):
+        response = etags.not_modified(tag)
+    else:
+        response = fastapi.responses.ORJSONResponse(page.items)
+        etags.set_headers(response, tag)
+
+    if page.next_cursor:
+        response.headers["X-Next-Cursor"] = page.next_cursor
 
+    return response
 
-@app.post(_VERSION + "/charge/payment", response_model=schemas.ChargeDatabase)
-def charge_payment(
+
+@app.post(
+    _VERSION + "/charge/payment",
+    response_model=schemas.ChargeDatabase,
+    dependencies=[
+        fastapi.Depends(rate_limit_principal),
+        fastapi.Depends(track_write),
+    ],
+)
+async def charge_payment(
     request: fastapi.Request,
     payment_info: schemas.ChargePayment,
-    api_key: str = None,
-    db: sqlalchemy.orm.Session = fastapi.Depends(get_db),
+    idempotency_key: str = fastapi.Header(None),
+    principal: data_access.Principal = fastapi.Depends(current_principal),
+    db: database.AnySession = fastapi.Depends(get_db),
 ):
-    return data_access.payment_charge(
+    async def write():
+        return await data_access.run(
+            db,
+            data_access.payment_charge,
+            payment_info=payment_info,
+            principal=principal,
+        )
+
+    return await idempotent(
+        request,
         db,
-        payment_info=payment_info,
-        api_key=get_api_key_from_request(request),
+        principal,
+        idempotency_key,
+        payment_info,
+        status_code=200,
+        write=write,
+    )
+
+
+@app.get(
+    _VERSION + "/balance",
+    response_model=schemas.Balance,
+    dependencies=[fastapi.Depends(rate_limit_principal)],
+)
+async def read_balance(
+    principal: data_access.Principal = fastapi.Depends(current_principal),
+    db: database.AnySession = fastapi.Depends(get_db),
+):
+    return await data_access.run(
+        db, data_access.get_balance, principal=principal
     )
 
 
-@app.post(_VERSION + "/authenticate", response_model=schemas.APIKey)
-def authenticate_login(
+@app.post(
+    _VERSION + "/authenticate",
+    response_model=schemas.APIKey,
+    dependencies=[
+        fastapi.Depends(rate_limit),
+        fastapi.Depends(track_write),
+    ],
+)
+async def authenticate_login(
     response: fastapi.Response,
     login: schemas.Authenticate,
-    db: sqlalchemy.orm.Session = fastapi.Depends(get_db),
+    db: database.AnySession = fastapi.Depends(get_db),
 ):
-    entity = data_access.get_entity_by_cpf_cnpj_and_password(
-        db, cpf_cnpj=login.cpf_cnpj, password=login.password
+    entity = await data_access.run(
+        db,
+        data_access.get_entity_by_cpf_cnpj_and_password,
+        cpf_cnpj=login.cpf_cnpj,
+        password=login.password,
     )
 
-    api_key = data_access.create_api_key(db, cpf_cnpj=entity.cpf_cnpj)
+    api_key = await data_access.run(
+        db, data_access.create_api_key, cpf_cnpj=entity.cpf_cnpj
+    )
     if login.set_cookie:
         response.set_cookie(key=_SESSION_KEY, value=api_key)
 
     return schemas.APIKey(api_key=api_key, cpf_cnpj=entity.cpf_cnpj)
 
 
-@app.delete(_VERSION + "/authenticate", status_code=204)
-def authenticate_logout(
-    request: fastapi.Request,
-    api_key: str = None,
-    db: sqlalchemy.orm.Session = fastapi.Depends(get_db),
+@app.delete(
+    _VERSION + "/authenticate",
+    status_code=204,
+    dependencies=[
+        fastapi.Depends(rate_limit_principal),
+        fastapi.Depends(track_write),
+    ],
+)
+async def authenticate_logout(
+    principal: data_access.Principal = fastapi.Depends(current_principal),
+    db: database.AnySession = fastapi.Depends(get_db),
 ):
-    data_access.delete_api_key(db, api_key=get_api_key_from_request(request))
+    await data_access.run(db, data_access.delete_api_key, principal=principal)
     return {}
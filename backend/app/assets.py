@@ -0,0 +1,160 @@
+""" Assets
+
+Build step of the frontend. Static files are copied with a hash of their
+content in the name, e.g. main.js -> main.3f2a9c01de.js, so nginx can
+let browsers keep them for a year, a new build gives new names. The home
+page is rewritten to point at them and is the only file browsers check
+on every visit.
+
+Every file also gets a gzip copy next to it, served by nginx
+`gzip_static` without compressing per request. With the optional
+`brotli` package a .br copy is written too, for nginx builds with the
+brotli module.
+
+    python -m app.assets
+    python -m app.assets --source ../frontend --output ../frontend/dist
+"""
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import pathlib
+import re
+import shutil
+import sys
+import typing
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover, optional dependency
+    brotli = None
+
+
+FRONTEND = pathlib.Path(__file__).resolve().parents[2] / "frontend"
+
+COMPRESSIBLE_SUFFIXES = {".css", ".html", ".js", ".json", ".svg", ".txt"}
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=5).hexdigest()
+
+
+def hashed_name(name: str, data: bytes) -> str:
+    """ Hashed Name
+
+    e.g. styles.css -> styles.<hash>.css
+    """
+    path = pathlib.PurePosixPath(name)
+    stem = f"{path.stem}.{content_hash(data)}"
+    return str(path.with_name(stem + path.suffix))
+
+
+def gzip_compress(data: bytes) -> bytes:
+    # mtime 0 keeps the output the same from build to build,
+    # gzip.compress only takes it from Python 3.8
+    buffer = io.BytesIO()
+    with gzip.GzipFile(
+        fileobj=buffer, mode="wb", compresslevel=9, mtime=0
+    ) as compressed:
+        compressed.write(data)
+
+    return buffer.getvalue()
+
+
+def precompress(path: pathlib.Path) -> typing.List[pathlib.Path]:
+    """ Precompress
+
+    Write the gzip (and brotli) copies of a file that are smaller than it,
+    return their paths
+    """
+    if path.suffix not in COMPRESSIBLE_SUFFIXES:
+        return []
+
+    data = path.read_bytes()
+    copies = {".gz": gzip_compress(data)}
+    if brotli is not None:
+        copies[".br"] = brotli.compress(data, quality=11)
+
+    written = []
+    for suffix, compressed in copies.items():
+        if len(compressed) < len(data):
+            target = path.with_name(path.name + suffix)
+            target.write_bytes(compressed)
+            written.append(target)
+
+    return written
+
+
+def rewrite_references(text: str, manifest: typing.Dict[str, str]) -> str:
+    """ Rewrite References
+
+    Point /static/<name> references at the hashed names
+    """
+
+    def replace(match):
+        name = match.group(1)
+        return "/static/" + manifest.get(name, name)
+
+    return re.sub(r"/static/([\w./-]+)", replace, text)
+
+
+def build(source: pathlib.Path, output: pathlib.Path) -> dict:
+    """ Build
+
+    Write the hashed, precompressed static files and the home page of
+    `source` to `output`, replacing a previous build
+
+    Returns:
+        dict: hashed name of every static file, by its original name
+    """
+    for directory in ("static", "home"):
+        shutil.rmtree(output / directory, ignore_errors=True)
+
+    manifest = {}
+    for path in sorted((source / "static").rglob("*")):
+        if not path.is_file():
+            continue
+
+        name = path.relative_to(source / "static").as_posix()
+        data = path.read_bytes()
+        manifest[name] = hashed_name(name, data)
+
+        target = output / "static" / manifest[name]
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(data)
+        precompress(target)
+
+    for path in sorted((source / "home").glob("*.html")):
+        target = output / "home" / path.name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(
+            rewrite_references(path.read_text(encoding="utf-8"), manifest),
+            encoding="utf-8",
+        )
+        precompress(target)
+
+    (output / "manifest.json").write_text(
+        json.dumps(manifest, indent=2, sort_keys=True)
+    )
+    return manifest
+
+
+def main(argv: typing.List[str] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.assets",
+        description="Build hashed and precompressed frontend assets",
+    )
+    parser.add_argument("--source", type=pathlib.Path, default=FRONTEND)
+    parser.add_argument("--output", type=pathlib.Path, default=None)
+    args = parser.parse_args(argv)
+
+    output = args.output or args.source / "dist"
+    manifest = build(args.source, output)
+    for name, hashed in manifest.items():
+        print(f"{name} -> {hashed}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
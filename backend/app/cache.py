@@ -0,0 +1,552 @@
+""" Cache
+
+This module holds the caches used to avoid hitting the database on hot
+paths, in process or on a local key-value store shared by the workers
+"""
+
+import collections
+import itertools
+import json
+import pickle
+import sqlite3
+import threading
+import time
+import typing
+
+
+CacheInfo = collections.namedtuple(
+    "CacheInfo", "hits misses maxsize currsize ttl"
+)
+
+
+def _refill(
+    bucket: typing.Optional[typing.Tuple[float, float]],
+    capacity: float,
+    rate: float,
+    now: float,
+) -> float:
+    # A bucket never seen, or evicted, is full
+    if bucket is None:
+        return capacity
+
+    tokens, updated_at = bucket
+    return min(capacity, tokens + max(now - updated_at, 0.0) * rate)
+
+
+def _spend(
+    tokens: float, cost: float, rate: float
+) -> typing.Tuple[float, float]:
+    """ Spend
+
+    Returns:
+        tuple: (tokens left, seconds to wait), the tokens are only spent
+         when there is no wait
+    """
+    if tokens >= cost:
+        return tokens - cost, 0.0
+
+    return tokens, (cost - tokens) / rate
+
+
+class TTLCache:
+    """ TTL Cache
+
+    Bounded LRU mapping where every entry expires ``ttl`` seconds after
+    it was stored. It is safe to share between the threads of a worker.
+
+    Args:
+        maxsize (int): maximum number of entries, the least recently used
+         entry is evicted when it is full
+        ttl (float): seconds an entry stays valid
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard_where(self, predicate: typing.Callable) -> int:
+        """ Discard Where
+
+        Remove every entry for which ``predicate(key, value)`` is true and
+        return how many entries were removed
+        """
+        with self._lock:
+            keys = [
+                key
+                for key, (_, value) in self._data.items()
+                if predicate(key, value)
+            ]
+            for key in keys:
+                del self._data[key]
+
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(
+                hits=self.hits,
+                misses=self.misses,
+                maxsize=self.maxsize,
+                currsize=len(self._data),
+                ttl=self.ttl,
+            )
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemoryKV(TTLCache):
+    """ Memory KV
+
+    `TTLCache` with counters, a counter not incremented for `ttl` twice is
+    dropped. Every entry that was stored while it had an older value
+    expired by then, and when it comes back it starts above the highest
+    dropped value, so no entry of the old values is ever read again.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        # key -> (value, incremented at), oldest increment first
+        self._counters = collections.OrderedDict()
+        self._counter_floor = 0
+        self._buckets = collections.OrderedDict()
+
+    def _purge_counters(self, now: float):
+        horizon = now - 2 * self.ttl
+        while self._counters:
+            key, (value, updated_at) = next(iter(self._counters.items()))
+            if updated_at > horizon:
+                break
+
+            del self._counters[key]
+            self._counter_floor = max(self._counter_floor, value)
+
+    def counter(self, key) -> int:
+        with self._lock:
+            self._purge_counters(time.monotonic())
+            return self._counters.get(key, (0, None))[0]
+
+    def incr(self, key, amount: int = 1) -> int:
+        now = time.monotonic()
+        with self._lock:
+            self._purge_counters(now)
+            value, _ = self._counters.get(key, (self._counter_floor, None))
+            self._counters[key] = (value + amount, now)
+            self._counters.move_to_end(key)
+            return value + amount
+
+    def take(
+        self, key, capacity: float, rate: float, cost: float = 1.0
+    ) -> float:
+        """ Take
+
+        Spend `cost` tokens of the token bucket `key`, which holds up to
+        `capacity` tokens and gains `rate` tokens per second. The least
+        recently used buckets are dropped beyond `maxsize`.
+
+        Returns:
+            float: 0 when the tokens were spent, otherwise the seconds
+             until the bucket has them
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens = _refill(self._buckets.get(key), capacity, rate, now)
+            tokens, wait = _spend(tokens, cost, rate)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > max(self.maxsize, 1):
+                self._buckets.popitem(last=False)
+
+        return wait
+
+    def clear(self):
+        super().clear()
+        with self._lock:
+            self._counters.clear()
+            self._counter_floor = 0
+            self._buckets.clear()
+
+
+class SQLiteKV:
+    """ SQLite KV
+
+    Key-value store on a local SQLite file, a stand-in for a shared store
+    like Redis: every worker of the host sees the same entries and
+    counters. Values are pickled, the file must only be writable by the
+    application. Counters are dropped like the ones of `MemoryKV`.
+
+    Args:
+        path (str): file of the store, created when missing
+        maxsize (int): entries kept when expired ones are purged
+        ttl (float): seconds an entry stays valid
+    """
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY,"
+        " value BLOB NOT NULL, expires_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_entries_expires_at"
+        " ON entries (expires_at)",
+        "CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY,"
+        " value INTEGER NOT NULL, updated_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_counters_updated_at"
+        " ON counters (updated_at)",
+        # Highest value of the dropped counters, new ones start above it
+        "CREATE TABLE IF NOT EXISTS counter_floor ("
+        " id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO counter_floor VALUES (0, 0)",
+        "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY,"
+        " tokens REAL NOT NULL, updated_at REAL NOT NULL)",
+    )
+    # Expired entries are purged once every that many writes
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str, maxsize: int = 65536, ttl: float = 60.0):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = itertools.count(1)
+
+        with self._connection() as connection:
+            columns = {
+                row[1]
+                for row in connection.execute("PRAGMA table_info(counters)")
+            }
+            if columns and "updated_at" not in columns:
+                # Files of before counters were dropped, keep them as if
+                # they were just incremented
+                connection.execute(
+                    "ALTER TABLE counters ADD COLUMN updated_at REAL"
+                    " NOT NULL DEFAULT 0"
+                )
+                connection.execute(
+                    "UPDATE counters SET updated_at = ?", (time.time(),)
+                )
+
+            for statement in self._SCHEMA:
+                connection.execute(statement)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can not be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+
+        return connection
+
+    @staticmethod
+    def _key(key) -> str:
+        return key if isinstance(key, str) else json.dumps(key)
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, default=None):
+        row = (
+            self._connection()
+            .execute(
+                "SELECT value FROM entries WHERE key = ? AND expires_at > ?",
+                (self._key(key), time.time()),
+            )
+            .fetchone()
+        )
+        self._count(row is not None)
+        return default if row is None else pickle.loads(row[0])
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                (
+                    self._key(key),
+                    pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                    time.time() + self.ttl,
+                ),
+            )
+
+        if next(self._writes) % self.PURGE_EVERY == 0:
+            self.purge()
+
+    def discard(self, key):
+        with self._connection() as connection:
+            connection.execute(
+                "DELETE FROM entries WHERE key = ?", (self._key(key),)
+            )
+
+    def purge(self) -> int:
+        """ Purge
+
+        Remove the expired entries, and the ones closest to expire when
+        there are more than `maxsize`, return how many were removed
+        """
+        with self._connection() as connection:
+            removed = connection.execute(
+                "DELETE FROM entries WHERE expires_at <= ?", (time.time(),)
+            ).rowcount
+            removed += connection.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries"
+                " ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (max(self.maxsize, 0),),
+            ).rowcount
+            # Buckets left alone for `ttl` are full again
+            removed += connection.execute(
+                "DELETE FROM buckets WHERE updated_at <= ?",
+                (time.time() - self.ttl,),
+            ).rowcount
+            horizon = time.time() - 2 * self.ttl
+            connection.execute(
+                "UPDATE counter_floor SET value = max(value, coalesce("
+                "(SELECT max(value) FROM counters WHERE updated_at <= ?), 0))",
+                (horizon,),
+            )
+            removed += connection.execute(
+                "DELETE FROM counters WHERE updated_at <= ?", (horizon,)
+            ).rowcount
+
+        return removed
+
+    def counter(self, key) -> int:
+        row = (
+            self._connection()
+            .execute(
+                "SELECT value FROM counters WHERE key = ?", (self._key(key),)
+            )
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def incr(self, key, amount: int = 1) -> int:
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT INTO counters VALUES"
+                " (?, (SELECT value FROM counter_floor) + ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET value = value + ?,"
+                " updated_at = excluded.updated_at",
+                (self._key(key), amount, time.time(), amount),
+            )
+            value = connection.execute(
+                "SELECT value FROM counters WHERE key = ?", (self._key(key),)
+            ).fetchone()[0]
+
+        if next(self._writes) % self.PURGE_EVERY == 0:
+            self.purge()
+
+        return value
+
+    def take(
+        self, key, capacity: float, rate: float, cost: float = 1.0
+    ) -> float:
+        """ Take
+
+        Same as `MemoryKV.take`, the bucket is shared by every process
+        """
+        key = self._key(key)
+        connection = self._connection()
+        # Taken before reading, so no other worker spends the same tokens
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            bucket = connection.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens = _refill(bucket, capacity, rate, now)
+            tokens, wait = _spend(tokens, cost, rate)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+        except BaseException:
+            connection.rollback()
+            raise
+
+        connection.commit()
+        if next(self._writes) % self.PURGE_EVERY == 0:
+            self.purge()
+
+        return wait
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM entries")
+            connection.execute("DELETE FROM counters")
+            connection.execute("UPDATE counter_floor SET value = 0")
+            connection.execute("DELETE FROM buckets")
+
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(
+            hits=self.hits,
+            misses=self.misses,
+            maxsize=self.maxsize,
+            currsize=len(self),
+            ttl=self.ttl,
+        )
+
+    def __len__(self):
+        return (
+            self._connection()
+            .execute(
+                "SELECT count(*) FROM entries WHERE expires_at > ?",
+                (time.time(),),
+            )
+            .fetchone()[0]
+        )
+
+
+def create_kv(
+    backend: str, maxsize: int, ttl: float, path: str = None
+) -> typing.Optional[typing.Union[MemoryKV, SQLiteKV]]:
+    """ Create KV
+
+    Args:
+        backend (str): "memory", "sqlite" for a `SQLiteKV` on `path`, or
+         "none" to not cache at all
+
+    Returns:
+        None when the backend is "none"
+    """
+    if backend == "memory":
+        return MemoryKV(maxsize=maxsize, ttl=ttl)
+
+    if backend == "sqlite":
+        return SQLiteKV(path, maxsize=maxsize, ttl=ttl)
+
+    if backend == "none":
+        return None
+
+    raise ValueError(f"Unknown cache backend {backend!r}")
+
+
+class TaggedCache:
+    """ Tagged Cache
+
+    Entries depend on tags e.g. "creditor:<cpf_cnpj>". Each tag has a
+    generation on the backend, it is part of the keys of the entries that
+    depend on the tag, so invalidating a tag only bumps its generation and
+    the old entries are never read again, they expire or are evicted.
+
+    Args:
+        backend: `MemoryKV`, `SQLiteKV` or None to turn the cache off
+        namespace (str): prefix of the keys, backends can be shared
+    """
+
+    def __init__(self, backend, namespace: str):
+        self.backend = backend
+        self.namespace = namespace
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def _generation_key(self, tag: str) -> str:
+        return f"{self.namespace}:generation:{tag}"
+
+    def key(self, tags: typing.Iterable[str], *parts) -> str:
+        """ Key
+
+        Key of an entry identified by `parts` that depends on `tags`
+        """
+        generations = [
+            (tag, self.backend.counter(self._generation_key(tag)))
+            for tag in sorted(tags)
+        ]
+        return f"{self.namespace}:" + json.dumps(
+            [generations, parts], default=str, sort_keys=True
+        )
+
+    def get(self, key: str, default=None):
+        return self.backend.get(key, default)
+
+    def set(self, key: str, value):
+        self.backend.set(key, value)
+
+    def invalidate(self, tags: typing.Iterable[str]):
+        if not self.enabled:
+            return
+
+        for tag in set(tags):
+            self.backend.incr(self._generation_key(tag))
+            with self._lock:
+                self.invalidations += 1
+
+    def clear(self):
+        self.invalidations = 0
+        if self.enabled:
+            self.backend.clear()
+
+    def statistics(self) -> dict:
+        statistics = {
+            "backend": "none",
+            "hits": 0,
+            "misses": 0,
+            "size": 0,
+            "maxsize": 0,
+            "invalidations": self.invalidations,
+        }
+        if self.enabled:
+            info = self.backend.cache_info()
+            statistics.update(
+                backend=type(self.backend).__name__,
+                hits=info.hits,
+                misses=info.misses,
+                size=info.currsize,
+                maxsize=info.maxsize,
+            )
+
+        return statistics
@@ -0,0 +1,208 @@
+""" Compression
+
+Negotiated compression of API responses. Bodies of JSON, CSV and other
+text above a minimum size are sent with the encoding the client prefers
+among brotli and gzip. Brotli needs the optional `brotli` package, gzip
+is always there.
+
+Streamed responses, e.g. the charge export, are compressed chunk by chunk
+and every chunk is flushed, the client does not wait for the end of the
+stream to start decoding.
+"""
+
+import os
+import typing
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover, optional dependency
+    brotli = None
+
+
+# Bodies smaller than that are sent as they are, bytes
+COMPRESSION_MINIMUM_SIZE = int(
+    os.environ.get("COMPRESSION_MINIMUM_SIZE", 1024)
+)
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+# 0 to 11, the high ones are for static files, too slow per request
+COMPRESSION_BROTLI_QUALITY = int(
+    os.environ.get("COMPRESSION_BROTLI_QUALITY", 4)
+)
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "image/svg+xml",
+)
+
+
+class _GzipEncoder:
+    def __init__(self, level: int):
+        # wbits 16 + 15 writes the gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _BrotliEncoder:
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+def available_encodings() -> typing.Tuple[str, ...]:
+    """ Available Encodings
+
+    In order of preference when the client likes them equally
+    """
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate(
+    accept_encoding: typing.Optional[str],
+    encodings: typing.Sequence[str] = None,
+) -> typing.Optional[str]:
+    """ Negotiate
+
+    Pick the encoding of the response from an Accept-Encoding header, the
+    one with the highest q value, None when the client takes none of them
+    """
+    encodings = encodings or available_encodings()
+    weights = {}
+    for item in (accept_encoding or "").split(","):
+        name, _, parameters = item.strip().partition(";")
+        if not name:
+            continue
+
+        quality = 1.0
+        parameter, _, value = parameters.strip().partition("=")
+        if parameter.strip() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+
+        weights[name.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = weights.get(encoding, weights.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+
+    return best
+
+
+def create_encoder(encoding: str):
+    if encoding == "br":
+        return _BrotliEncoder(COMPRESSION_BROTLI_QUALITY)
+
+    return _GzipEncoder(COMPRESSION_GZIP_LEVEL)
+
+
+def is_compressible(headers: Headers) -> bool:
+    if "content-encoding" in headers:
+        return False
+
+    content_type = headers.get("content-type", "")
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def _weaken_etag(headers: MutableHeaders):
+    etag = headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        headers["ETag"] = "W/" + etag
+
+
+class CompressionMiddleware:
+    """ Compression Middleware
+
+    Compress response bodies of at least `minimum_size` bytes with the
+    encoding negotiated from Accept-Encoding. Compressed responses keep
+    their ETag as a weak one, the bytes differ but the content is the same.
+    """
+
+    def __init__(self, app, minimum_size: int = None):
+        self.app = app
+        self.minimum_size = (
+            COMPRESSION_MINIMUM_SIZE if minimum_size is None else minimum_size
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        encoder = None
+
+        async def send_wrapper(message):
+            nonlocal start_message, encoder
+
+            if message["type"] == "http.response.start":
+                # Held back until the first body tells the size
+                start_message = message
+                return
+
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if start_message is not None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                if is_compressible(headers) and (
+                    more_body or len(body) >= self.minimum_size
+                ):
+                    encoder = create_encoder(encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    del headers["Content-Length"]
+                    _weaken_etag(headers)
+
+                    body = encoder.compress(body)
+                    body += encoder.flush() if more_body else encoder.finish()
+                    if not more_body:
+                        headers["Content-Length"] = str(len(body))
+                elif is_compressible(headers):
+                    headers.add_vary_header("Accept-Encoding")
+
+                await send(start_message)
+                start_message = None
+                await send({**message, "body": body})
+                return
+
+            if encoder is not None:
+                body = encoder.compress(body)
+                body += encoder.flush() if more_body else encoder.finish()
+
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_wrapper)
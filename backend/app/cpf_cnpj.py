@@ -0,0 +1,138 @@
+""" CPF / CNPJ
+
+Validation of brazilian documents, CPF for people (pf) and CNPJ for
+companies (pj). Check digits are computed with plain integer arithmetic and
+parsed documents are memoized, the same handful of documents is validated
+over and over on every request.
+"""
+
+import collections
+import functools
+import os
+import random
+import typing
+
+
+CPF_LENGTH = 11
+CNPJ_LENGTH = 14
+
+_CPF_WEIGHTS = tuple(range(11, 1, -1))
+_CNPJ_WEIGHTS = (6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+_DIGITS = frozenset("0123456789")
+
+Document = collections.namedtuple("Document", "cpf_cnpj type_entity")
+
+
+def only_digits(value: str) -> str:
+    return "".join(char for char in value if char in _DIGITS)
+
+
+def _check_digit(numbers: typing.Sequence[int], weights: tuple) -> int:
+    # The weights are aligned by their end, the second digit uses one more
+    weights = weights[len(weights) - len(numbers):]
+    total = sum(number * weight for number, weight in zip(numbers, weights))
+    rest = total % 11
+    return 0 if rest < 2 else 11 - rest
+
+
+def check_digits(base: str, weights: tuple) -> str:
+    """ Check Digits
+
+    Return the two verification digits of the document body `base`
+    """
+    numbers = [ord(char) - 48 for char in base]
+    first = _check_digit(numbers, weights)
+    second = _check_digit(numbers + [first], weights)
+    return f"{first}{second}"
+
+
+def _is_valid(digits: str, length: int, weights: tuple) -> bool:
+    if len(digits) != length or digits == digits[0] * length:
+        return False
+
+    return check_digits(digits[:-2], weights) == digits[-2:]
+
+
+def with_check_digits(base: str) -> str:
+    """ With Check Digits
+
+    Complete a CPF body of 9 digits or a CNPJ body of 12 digits
+    """
+    weights = _CPF_WEIGHTS if len(base) == CPF_LENGTH - 2 else _CNPJ_WEIGHTS
+    return base + check_digits(base, weights)
+
+
+def _random_document(length: int, rng) -> str:
+    while True:
+        base = "".join(str(rng.randrange(10)) for _ in range(length - 2))
+        digits = with_check_digits(base)
+        if digits != digits[0] * length:
+            return digits
+
+
+def random_cpf(rng: random.Random = random) -> str:
+    """ Random CPF
+
+    Valid CPF, only digits, drawn from `rng` so it can be seeded
+    """
+    return _random_document(CPF_LENGTH, rng)
+
+
+def random_cnpj(rng: random.Random = random) -> str:
+    return _random_document(CNPJ_LENGTH, rng)
+
+
+def is_valid_cpf(digits: str) -> bool:
+    return _is_valid(digits, CPF_LENGTH, _CPF_WEIGHTS)
+
+
+def is_valid_cnpj(digits: str) -> bool:
+    return _is_valid(digits, CNPJ_LENGTH, _CNPJ_WEIGHTS)
+
+
+@functools.lru_cache(
+    maxsize=int(os.environ.get("CPF_CNPJ_CACHE_SIZE", 65536))
+)
+def parse(value: str) -> typing.Optional[Document]:
+    """ Parse
+
+    Normalize a CPF / CNPJ, masked or not, and detect its type
+
+    Returns:
+        Document: only digits `cpf_cnpj` and `type_entity` "pf" or "pj",
+         None when the value is not a valid CPF / CNPJ
+    """
+    digits = only_digits(value)
+    if is_valid_cpf(digits):
+        return Document(digits, "pf")
+
+    if is_valid_cnpj(digits):
+        return Document(digits, "pj")
+
+    return None
+
+
+def is_valid(value: str) -> bool:
+    return parse(value) is not None
+
+
+def document_type(value: str) -> typing.Optional[str]:
+    document = parse(value)
+    return document.type_entity if document else None
+
+
+def validate_many(
+    values: typing.Iterable[str],
+) -> typing.Dict[str, typing.Optional[Document]]:
+    """ Validate Many
+
+    Parse several documents at once, each distinct value is parsed once
+
+    Returns:
+        dict: value -> `Document`, or None for the invalid ones
+    """
+    return {value: parse(value) for value in set(values)}
+
+
+def cache_info():
+    return parse.cache_info()
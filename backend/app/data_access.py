@@ -3,12 +3,70 @@
 This module is reponsible to handle all interactions to the database
 """
 
+import asyncio
+import base64
+import collections
+import contextvars
+import functools
+import json
+import os
+import uuid
+import sqlalchemy.exc
+import sqlalchemy.ext.asyncio
 import sqlalchemy.orm
 import typing
 import datetime
 import secrets
 import hashlib
-from . import models, schemas, security
+from . import cache, cpf_cnpj as docs, database, models, schemas, security
+from . import tracing
+
+
+API_KEY_CACHE_TTL = float(os.environ.get("API_KEY_CACHE_TTL", 60))
+
+# Verified API keys, (identifier, verifier_hash) -> (Principal, revocation
+# generation of the key when it was looked up)
+api_key_cache = cache.TTLCache(
+    maxsize=int(os.environ.get("API_KEY_CACHE_SIZE", 4096)),
+    ttl=API_KEY_CACHE_TTL,
+)
+
+# Revocation generation per API key, bumped when the key is deleted so the
+# cached copies of every worker sharing the backend are looked up again.
+# "sqlite" is shared by the workers of the host, with "memory" or "none"
+# the other workers keep accepting a deleted key for API_KEY_CACHE_TTL
+api_key_revocations = cache.create_kv(
+    os.environ.get("API_KEY_REVOCATION_BACKEND", "memory"),
+    maxsize=int(os.environ.get("API_KEY_CACHE_SIZE", 4096)),
+    ttl=API_KEY_CACHE_TTL,
+    path=os.environ.get(
+        "API_KEY_REVOCATION_PATH", "./api_key_revocations.db"
+    ),
+)
+
+# Pages of `filter_charge`, invalidated by the charges of their creditor or
+# debtor. "memory" is per worker, "sqlite" is shared by the workers of the
+# host, "none" turns it off
+charge_page_cache = cache.TaggedCache(
+    cache.create_kv(
+        os.environ.get("CHARGE_CACHE_BACKEND", "memory"),
+        maxsize=int(os.environ.get("CHARGE_CACHE_SIZE", 4096)),
+        ttl=float(os.environ.get("CHARGE_CACHE_TTL", 30)),
+        path=os.environ.get("CHARGE_CACHE_PATH", "./charge_cache.db"),
+    ),
+    namespace="charge_page",
+)
+
+# Seconds a response is replayed for retries with the same Idempotency-Key
+IDEMPOTENCY_KEY_TTL = float(os.environ.get("IDEMPOTENCY_KEY_TTL", 86400))
+# Seconds a key is held by a request that did not answer, past it the
+# request is taken as dead and a retry runs again
+IDEMPOTENCY_CLAIM_LEASE = float(os.environ.get("IDEMPOTENCY_CLAIM_LEASE", 60))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# Owner of the API key of a request, `entity` is a `schemas.Entity`, None
+# for admin keys
+Principal = collections.namedtuple("Principal", "api_key_id cpf_cnpj entity")
 
 
 class DataAccessException(Exception):
@@ -36,19 +94,103 @@ class DoesNotExisit(DataAccessException):
     pass
 
 
+class Conflict(DataAccessException):
+    """ Conflict
+
+    This error is raised when a row changed between reading and writing it
+    """
+    pass
+
+
+class IdempotencyKeyInUse(DataAccessException):
+    """ Idempotency Key In Use
+
+    This error is raised when a request with the same Idempotency-Key is
+    still running
+    """
+    pass
+
+
+class IdempotencyKeyMismatch(DataAccessException):
+    """ Idempotency Key Mismatch
+
+    This error is raised when an Idempotency-Key is sent again with a
+    different body
+    """
+    pass
+
+
+# SESSION THINGS
+
+
+async def run(db: database.AnySession, function: typing.Callable, **kwargs):
+    """ Run
+
+    Call a data access function from async code. With an `AsyncSession`
+    the function runs on the event loop through `AsyncSession.run_sync`,
+    otherwise a blocking `Session` is driven from the default executor.
+
+    Args:
+        db (Session | AsyncSession): session given by `api.get_db`
+        function (callable): data access function, db is its first arg
+    """
+    if isinstance(db, sqlalchemy.ext.asyncio.AsyncSession):
+        return await db.run_sync(function, **kwargs)
+
+    # Executor threads do not inherit the context of the request
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None,
+        functools.partial(
+            contextvars.copy_context().run, function, db, **kwargs
+        ),
+    )
+
+
+async def stream(
+    db: database.AnySession,
+    statement: sqlalchemy.sql.Select,
+    batch_size: int = 1000,
+) -> typing.AsyncIterator[typing.List[typing.Mapping]]:
+    """ Stream
+
+    Execute the statement with a server side cursor and yield its rows in
+    lists of at most `batch_size`, only one list is kept in memory
+    """
+    statement = statement.execution_options(stream_results=True)
+    if isinstance(db, sqlalchemy.ext.asyncio.AsyncSession):
+        result = await db.stream(statement)
+        async for partition in result.mappings().partitions(batch_size):
+            yield partition
+        return
+
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    result = await loop.run_in_executor(
+        None, context.run, db.execute, statement
+    )
+    partitions = result.mappings().partitions(batch_size)
+    try:
+        while True:
+            partition = await loop.run_in_executor(
+                None, context.run, next, partitions, None
+            )
+            if partition is None:
+                break
+            yield partition
+    finally:
+        result.close()
+
+
 # ENTITY THINGS
 
 
+@tracing.traced
 def get_entity_by_cpf_cnpj(
     db: sqlalchemy.orm.Session,
     cpf_cnpj: str,
-    api_key: str = None,
-    validate_api_key=True,
     raise_error=False,
 ) -> models.Entity:
-    if validate_api_key or api_key:
-        check_api_key(db, api_key=api_key)
-
     db_entity = db.query(models.Entity).get(cpf_cnpj)
     if not db_entity:
         if raise_error:
@@ -59,28 +201,29 @@ def get_entity_by_cpf_cnpj(
     return db_entity
 
 
-def get_entity_by_api_key(
-    db: sqlalchemy.orm.Session, api_key: str
-) -> models.Entity:
-    db_api_key = check_api_key(db, api_key=api_key)
-    return get_entity_by_cpf_cnpj(
-        db, db_api_key.cpf_cnpj, validate_api_key=False, raise_error=True
-    )
-
-
+@tracing.traced
 def get_entity_by_cpf_cnpj_and_password(
     db: sqlalchemy.orm.Session, cpf_cnpj: str, password: str
 ) -> models.Entity:
-    entity = get_entity_by_cpf_cnpj(db, cpf_cnpj, validate_api_key=False)
+    entity = get_entity_by_cpf_cnpj(db, cpf_cnpj)
     if not entity:
         raise ValidationError("Invalid Credentials")
 
-    if not security.verify_password(password, entity.hashed_password):
+    is_valid, new_hash = security.verify_and_update(
+        password, entity.hashed_password
+    )
+    if not is_valid:
         raise ValidationError("Invalid Credentials")
 
+    if new_hash:
+        entity.hashed_password = new_hash
+        db.add(entity)
+        db.commit()
+
     return entity
 
 
+@tracing.traced
 def create_entity(
     db: sqlalchemy.orm.Session,
     entity: schemas.Entity,
@@ -88,15 +231,14 @@ def create_entity(
     persist: bool = True,
 ) -> models.Entity:
 
-    db_entity = get_entity_by_cpf_cnpj(
-        db, cpf_cnpj=entity.cpf_cnpj, validate_api_key=False,
-    )
+    db_entity = get_entity_by_cpf_cnpj(db, cpf_cnpj=entity.cpf_cnpj)
     if db_entity and db_entity.hashed_password:
         raise ValidationError("Entity already exist")
 
     db_entity = db_entity or models.Entity()
     db_entity.cpf_cnpj = entity.cpf_cnpj
     db_entity.name = entity.name
+    db_entity.type_entity = docs.document_type(entity.cpf_cnpj)
 
     if password:
         entity_set_password(
@@ -115,33 +257,24 @@ def create_entity(
     return db_entity
 
 
-def get_entity_api_key_by_id(
-    db: sqlalchemy.orm.Session, api_key: str
-) -> models.APIKey:
-    if not api_key:
-        return None
-
-    return db.query(models.APIKey).get(api_key)
-
-
+@tracing.traced
 def filter_entity_by_type(
     db: sqlalchemy.orm.Session,
     type_entity: str,
-    api_key: str,
     limit: int = 100,
 ) -> typing.List[models.Entity]:
-    check_api_key(db, api_key=api_key)
-
     query = (
         db.query(models.Entity).filter_by(type_entity=type_entity).limit(limit)
     )
 
-    if not query.all():
+    entities = query.all()
+    if not entities:
         raise DoesNotExisit("Entities not found")
 
-    return query.all()
+    return entities
 
 
+@tracing.traced
 def entity_set_password(
     db: sqlalchemy.orm.Session,
     cpf_cnpj: str,
@@ -149,9 +282,7 @@ def entity_set_password(
     entity: models.Entity = None,
     persist=True,
 ) -> models.Entity:
-    entity = entity or get_entity_by_cpf_cnpj(
-        db, cpf_cnpj, validate_api_key=False
-    )
+    entity = entity or get_entity_by_cpf_cnpj(db, cpf_cnpj)
 
     if not entity:
         raise DoesNotExisit("Entity does not exist")
@@ -179,6 +310,7 @@ def split_api_key(api_key: str) -> typing.Tuple[str]:
         raise APIKeyNotFound()
 
 
+@tracing.traced
 def create_api_key(
     db: sqlalchemy.orm.Session, cpf_cnpj: str, persist=True
 ) -> str:
@@ -192,26 +324,46 @@ def create_api_key(
     db.flush()
     if persist:
         db.commit()
+
+    # An identifier is never reused, but make sure no stale entry survives
+    api_key_cache.discard_where(lambda key, _: key[0] == db_api_key.id)
     return generate_api_key(db_api_key.id, verifier)
 
 
-def delete_api_key(db: sqlalchemy.orm.Session, api_key: str) -> models.APIKey:
-    db_api_key = check_api_key(db, api_key=api_key)
+def _api_key_generation(identifier: str) -> int:
+    if api_key_revocations is None:
+        return 0
+
+    return api_key_revocations.counter(f"api_key:{identifier}")
+
 
+@tracing.traced
+def delete_api_key(db: sqlalchemy.orm.Session, principal: Principal):
     filter_api_key = (
-        db.query(models.APIKey).filter_by(cpf_cnpj=db_api_key.cpf_cnpj).all()
+        db.query(models.APIKey).filter_by(cpf_cnpj=principal.cpf_cnpj).all()
     )
-
+    identifiers = [item.id for item in filter_api_key]
     for item in filter_api_key:
         db.delete(item)
-
     db.commit()
-    return db_api_key
+
+    if api_key_revocations is not None:
+        for identifier in identifiers:
+            api_key_revocations.incr(f"api_key:{identifier}")
+
+    api_key_cache.discard_where(
+        lambda _, cached: cached[0].cpf_cnpj == principal.cpf_cnpj
+    )
 
 
-def check_api_key(db: sqlalchemy.orm.Session, api_key: str) -> models.APIKey:
-    """ Check API Key
-    This method is used to verify API Key is valid
+@tracing.traced
+def get_principal(db: sqlalchemy.orm.Session, api_key: str) -> Principal:
+    """ Get Principal
+    This method is used to verify API Key is valid and find its owner
+
+    The key and its entity come from a single query. Verified keys are
+    kept on `api_key_cache`, so a hit does not touch the database, only
+    the revocation generation of the key on `api_key_revocations`.
 
     Args:
         api_key (str): identifier.verifier e.g RaNdomString.Verifier
@@ -221,25 +373,51 @@ def check_api_key(db: sqlalchemy.orm.Session, api_key: str) -> models.APIKey:
          when API Key not exist.
     """
     indentifier, verifier = split_api_key(api_key)
+    verifier_hash = hashlib.sha256(verifier.encode("utf-8")).hexdigest()
 
-    db_api_key = get_entity_api_key_by_id(db, api_key=indentifier)
-    if not db_api_key:
+    # Read before the query, a key deleted in between is cached as stale
+    generation = _api_key_generation(indentifier)
+    cached = api_key_cache.get((indentifier, verifier_hash))
+    if cached is not None and cached[1] == generation:
+        return cached[0]
+
+    row = (
+        db.query(models.APIKey, models.Entity)
+        .outerjoin(
+            models.Entity, models.Entity.cpf_cnpj == models.APIKey.cpf_cnpj
+        )
+        .filter(models.APIKey.id == indentifier)
+        .first()
+    )
+    if not row:
         raise APIKeyNotFound()
 
-    verifier_hash = hashlib.sha256(verifier.encode("utf-8")).hexdigest()
+    db_api_key, db_entity = row
     if verifier_hash != db_api_key.verifier_hash:
         raise APIKeyNotFound()
 
-    return db_api_key
+    principal = Principal(
+        api_key_id=db_api_key.id,
+        cpf_cnpj=db_api_key.cpf_cnpj,
+        entity=schemas.Entity.from_orm(db_entity) if db_entity else None,
+    )
+    # The endpoint goes on with the session, it starts a transaction of
+    # its own instead of writing on top of this read
+    db.rollback()
+    if principal.cpf_cnpj is not None:
+        api_key_cache.set(
+            (indentifier, verifier_hash), (principal, generation)
+        )
+    return principal
 
 
 # CHARGE THINGS
 
 
+@tracing.traced
 def get_charge_by_id(
-    db: sqlalchemy.orm.Session, charge_id: str, api_key: str
+    db: sqlalchemy.orm.Session, charge_id: str
 ) -> models.Charge:
-    check_api_key(db, api_key=api_key)
     db_charge = db.query(models.Charge).get(charge_id)
 
     if not db_charge:
@@ -248,27 +426,33 @@ def get_charge_by_id(
     return db_charge
 
 
+@tracing.traced
 def get_charge_by_creditor_cpf_cnpj(
     db: sqlalchemy.orm.Session, creditor_cpf_cnpj: str
 ) -> models.Charge:
     return db.query(models.Charge).get(creditor_cpf_cnpj)
 
 
-def filter_charge(
-    db: sqlalchemy.orm.Session,
-    charge_filter: schemas.ChargeFilter,
-    api_key: str,
-) -> typing.List[schemas.ChargeFullInfo]:
-    check_api_key(db, api_key=api_key)
+def encode_charge_cursor(charge: models.Charge) -> str:
+    position = [charge.created_at.isoformat(), charge.id]
+    return base64.urlsafe_b64encode(
+        json.dumps(position).encode("utf-8")
+    ).decode("ascii")
 
-    Debitor = sqlalchemy.orm.aliased(models.Entity)
-    Creditor = sqlalchemy.orm.aliased(models.Entity)
-    query = (
-        db.query(models.Charge, Debitor, Creditor,)
-        .join(Debitor, Debitor.cpf_cnpj == models.Charge.debtor_cpf_cnpj)
-        .join(Creditor, Creditor.cpf_cnpj == models.Charge.creditor_cpf_cnpj)
-    )
 
+def decode_charge_cursor(cursor: str) -> typing.Tuple[datetime.datetime, str]:
+    try:
+        created_at, charge_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.datetime.fromisoformat(created_at), str(charge_id)
+    except (ValueError, TypeError):
+        raise ValidationError("Invalid cursor")
+
+
+def apply_charge_filter(query, charge_filter: schemas.ChargeFilter):
+    """ Apply Charge Filter
+
+    Narrow a charge `Query` or `Select` down to the given filter
+    """
     if charge_filter.debtor_cpf_cnpj:
         query = query.filter(
             models.Charge.debtor_cpf_cnpj == charge_filter.debtor_cpf_cnpj
@@ -284,78 +468,642 @@ def filter_charge(
             models.Charge.is_active == charge_filter.is_active
         )
 
-    rows = query.all()
-    if not rows:
-        raise DoesNotExisit("Charge not found")
+    return query
+
+
+def charge_filter_tags(
+    charge_filter: schemas.ChargeFilter,
+) -> typing.List[str]:
+    # Filters without cpf_cnpj change with every charge
+    tags = []
+    if charge_filter.creditor_cpf_cnpj:
+        tags.append(f"creditor:{charge_filter.creditor_cpf_cnpj}")
+    if charge_filter.debtor_cpf_cnpj:
+        tags.append(f"debtor:{charge_filter.debtor_cpf_cnpj}")
+
+    return tags or ["all"]
 
-    full_charges_info = []
-    for charge_db, debitor_db, creditor_db in rows:
-        charge_info = schemas.ChargeFullInfo(
-            id=charge_db.id,
-            debtor=debitor_db,
-            creditor=creditor_db,
-            debito=charge_db.debito,
-            is_active=charge_db.is_active,
-            created_at=charge_db.created_at,
-            payed_at=charge_db.payed_at,
+
+def invalidate_charge_pages(charges: typing.Iterable[models.Charge]):
+    """ Invalidate Charge Pages
+
+    Drop the cached pages that may hold the given charges, to be called
+    after they are committed
+    """
+    tags = set()
+    for charge in charges:
+        tags.add(f"creditor:{charge.creditor_cpf_cnpj}")
+        tags.add(f"debtor:{charge.debtor_cpf_cnpj}")
+
+    if tags:
+        tags.add("all")
+
+    charge_page_cache.invalidate(tags)
+
+
+@tracing.traced
+def filter_charge(
+    db: sqlalchemy.orm.Session,
+    charge_filter: schemas.ChargeFilter,
+    principal: Principal,
+    limit: int = 100,
+    cursor: str = None,
+) -> schemas.ChargePage:
+    """ Filter Charge
+
+    Charges are returned in pages of `schemas.charge_full_info_dict`
+    ordered by (created_at, id). The position
+    after the last item is given back as `next_cursor`, passing it on the
+    next call seeks straight to the following page, so every page costs
+    the same no matter how deep it is.
+
+    Pages are kept on `charge_page_cache` until a charge of the creditor
+    or debtor they filter on is created or paid.
+
+    Args:
+        limit (int): max number of charges on the page
+        cursor (str): `next_cursor` of the previous page
+    """
+    if charge_page_cache.enabled:
+        key = charge_page_cache.key(
+            charge_filter_tags(charge_filter),
+            principal.cpf_cnpj,
+            charge_filter.dict(),
+            limit,
+            cursor,
         )
-        full_charges_info.append(charge_info)
+        page = charge_page_cache.get(key)
+        if page is not None:
+            return page
+
+    Debitor = sqlalchemy.orm.aliased(models.Entity)
+    Creditor = sqlalchemy.orm.aliased(models.Entity)
+    query = (
+        db.query(models.Charge, Debitor, Creditor,)
+        .join(Debitor, Debitor.cpf_cnpj == models.Charge.debtor_cpf_cnpj)
+        .join(Creditor, Creditor.cpf_cnpj == models.Charge.creditor_cpf_cnpj)
+    )
 
-    return full_charges_info
+    query = apply_charge_filter(query, charge_filter)
 
+    if cursor:
+        created_at, charge_id = decode_charge_cursor(cursor)
+        query = query.filter(
+            sqlalchemy.or_(
+                models.Charge.created_at > created_at,
+                sqlalchemy.and_(
+                    models.Charge.created_at == created_at,
+                    models.Charge.id > charge_id,
+                ),
+            )
+        )
 
-def create_charge(
-    db: sqlalchemy.orm.Session, charge: schemas.ChargeCreate, api_key: str
-) -> models.Charge:
+    query = query.order_by(models.Charge.created_at, models.Charge.id)
+
+    # One extra row tells whether there is a next page
+    rows = query.limit(limit + 1).all()
+    if not rows:
+        raise DoesNotExisit("Charge not found")
 
-    db_api_key = check_api_key(db, api_key=api_key)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_charge_cursor(rows[-1][0])
 
-    debtor_db = get_entity_by_cpf_cnpj(
-        db, charge.debtor.cpf_cnpj, validate_api_key=False
+    # Rows come from the database, they are not validated again
+    page = schemas.ChargePage.construct(
+        items=[schemas.charge_full_info_dict(*row) for row in rows],
+        versions=[row[0].version for row in rows],
+        next_cursor=next_cursor,
     )
-    creditor_db = get_entity_by_cpf_cnpj(
-        db, charge.creditor_cpf_cnpj, validate_api_key=False
+    if charge_page_cache.enabled:
+        charge_page_cache.set(key, page)
+
+    return page
+
+
+def charge_export_statement(
+    charge_filter: schemas.ChargeFilter,
+) -> sqlalchemy.sql.Select:
+    """ Charge Export Statement
+
+    Flat charge rows with debtor and creditor names, meant to be read with
+    `stream` so the rows are never loaded all at once
+    """
+    Debitor = sqlalchemy.orm.aliased(models.Entity)
+    Creditor = sqlalchemy.orm.aliased(models.Entity)
+    statement = (
+        sqlalchemy.select(
+            models.Charge.id,
+            models.Charge.debtor_cpf_cnpj,
+            Debitor.name.label("debtor_name"),
+            models.Charge.creditor_cpf_cnpj,
+            Creditor.name.label("creditor_name"),
+            models.Charge.debito,
+            models.Charge.is_active,
+            models.Charge.created_at,
+            models.Charge.payed_at,
+        )
+        .join_from(
+            models.Charge,
+            Debitor,
+            Debitor.cpf_cnpj == models.Charge.debtor_cpf_cnpj,
+        )
+        .join(Creditor, Creditor.cpf_cnpj == models.Charge.creditor_cpf_cnpj)
+        .order_by(models.Charge.created_at, models.Charge.id)
     )
+    return apply_charge_filter(statement, charge_filter)
+
 
-    if creditor_db.cpf_cnpj != db_api_key.cpf_cnpj:
+@tracing.traced
+def create_charge(
+    db: sqlalchemy.orm.Session,
+    charge: schemas.ChargeCreate,
+    principal: Principal,
+) -> models.Charge:
+    # The creditor is the owner of the API key, it is not read again
+    if charge.creditor_cpf_cnpj != principal.cpf_cnpj:
         raise ValidationError("CPF / CNPJ is not the same as the creditor")
 
+    debtor_db = get_entity_by_cpf_cnpj(db, charge.debtor.cpf_cnpj)
     if not debtor_db:
         debtor_db = create_entity(db, charge.debtor, persist=False)
 
     db_charge = models.Charge(
         debtor_cpf_cnpj=debtor_db.cpf_cnpj,
-        creditor_cpf_cnpj=creditor_db.cpf_cnpj,
+        creditor_cpf_cnpj=principal.cpf_cnpj,
         debito=charge.debito,
         is_active=True,
     )
     db.add(db_charge)
+    db.flush()
+    update_balance_summaries(db, [db_charge])
     db.commit()
+    invalidate_charge_pages([db_charge])
     return db_charge
 
 
+@tracing.traced
+def get_entities_by_cpf_cnpj(
+    db: sqlalchemy.orm.Session,
+    cpf_cnpjs: typing.Iterable[str],
+    chunk_size: int = 500,
+) -> typing.Dict[str, models.Entity]:
+    # Chunks keep the IN list below the SQLite bound parameters limit
+    cpf_cnpjs = sorted(set(cpf_cnpjs))
+    entities = {}
+    for start in range(0, len(cpf_cnpjs), chunk_size):
+        chunk = cpf_cnpjs[start:start + chunk_size]
+        query = db.query(models.Entity).filter(
+            models.Entity.cpf_cnpj.in_(chunk)
+        )
+        entities.update((entity.cpf_cnpj, entity) for entity in query)
+
+    return entities
+
+
+@tracing.traced
+def create_charges(
+    db: sqlalchemy.orm.Session,
+    charges: typing.List[schemas.ChargeCreate],
+    principal: Principal,
+) -> schemas.ChargeBatchResult:
+    """ Create Charges
+
+    Batch version of `create_charge`, the debtors are fetched together and
+    every new debtor and charge is inserted in a single transaction.
+    Charges that can not be created are reported on their item instead of
+    failing the whole batch.
+    """
+    documents = docs.validate_many(
+        charge.debtor.cpf_cnpj for charge in charges
+    )
+    debtors = get_entities_by_cpf_cnpj(db, documents)
+
+    results, new_debtors, new_charges = [], [], []
+    created_at = datetime.datetime.utcnow()
+    for index, charge in enumerate(charges):
+        if charge.creditor_cpf_cnpj != principal.cpf_cnpj:
+            results.append(
+                schemas.ChargeBatchItem(
+                    index=index,
+                    status_code=400,
+                    detail="CPF / CNPJ is not the same as the creditor",
+                )
+            )
+            continue
+
+        if charge.debtor.cpf_cnpj not in debtors:
+            debtor_db = models.Entity(
+                cpf_cnpj=charge.debtor.cpf_cnpj,
+                name=charge.debtor.name,
+                type_entity=documents[charge.debtor.cpf_cnpj].type_entity,
+            )
+            debtors[debtor_db.cpf_cnpj] = debtor_db
+            new_debtors.append(debtor_db)
+
+        db_charge = models.Charge(
+            id=str(uuid.uuid4()),
+            debtor_cpf_cnpj=charge.debtor.cpf_cnpj,
+            creditor_cpf_cnpj=charge.creditor_cpf_cnpj,
+            debito=charge.debito,
+            is_active=True,
+            created_at=created_at,
+        )
+        new_charges.append(db_charge)
+        results.append(
+            schemas.ChargeBatchItem(
+                index=index,
+                status_code=201,
+                charge=schemas.ChargeDatabase.from_orm(db_charge),
+            )
+        )
+
+    db.bulk_save_objects(new_debtors)
+    db.bulk_save_objects(new_charges)
+    update_balance_summaries(db, new_charges)
+    db.commit()
+    invalidate_charge_pages(new_charges)
+    return schemas.ChargeBatchResult(
+        created=len(new_charges), results=results
+    )
+
+
+@tracing.traced
 def payment_charge(
     db: sqlalchemy.orm.Session,
     payment_info: schemas.ChargePayment,
-    api_key: str,
+    principal: Principal,
 ) -> models.Charge:
-    db_api_key = check_api_key(db, api_key=api_key)
+    """ Payment Charge
 
-    db_charge = get_charge_by_id(
-        db, charge_id=payment_info.id, api_key=api_key
+    A single conditional UPDATE pays the charge, only while it is open and
+    belongs to the creditor of the API key. Of two concurrent payments only
+    one updates the row, the other one sees no row and fails.
+    """
+    charges = models.Charge.__table__
+    result = db.execute(
+        charges.update()
+        .where(charges.c.id == payment_info.id)
+        .where(charges.c.creditor_cpf_cnpj == principal.cpf_cnpj)
+        .where(charges.c.creditor_cpf_cnpj == payment_info.creditor_cpf_cnpj)
+        .where(charges.c.is_active == sqlalchemy.true())
+        .values(
+            is_active=False,
+            payed_at=datetime.datetime.utcnow(),
+            version=charges.c.version + 1,
+        )
     )
+    if result.rowcount != 1:
+        db.rollback()
+        _raise_payment_error(db, payment_info, principal)
 
-    if not db_charge:
+    db_charge = db.get(models.Charge, payment_info.id, populate_existing=True)
+    update_balance_summaries(db, [db_charge], paid=True)
+    db.commit()
+    invalidate_charge_pages([db_charge])
+    return db_charge
+
+
+def _raise_payment_error(
+    db: sqlalchemy.orm.Session,
+    payment_info: schemas.ChargePayment,
+    principal: Principal,
+):
+    # Only on failed payments, tell why the UPDATE matched no row
+    charges = models.Charge.__table__
+    row = db.execute(
+        sqlalchemy.select(
+            charges.c.creditor_cpf_cnpj, charges.c.is_active
+        ).where(charges.c.id == payment_info.id)
+    ).first()
+
+    if not row:
         raise DoesNotExisit("Charge not found to pay")
 
-    if db_charge.creditor_cpf_cnpj != db_api_key.cpf_cnpj:
+    if row.creditor_cpf_cnpj != principal.cpf_cnpj:
         raise ValidationError("CPF/CNPJ is not the same on charge")
 
-    if db_charge.creditor_cpf_cnpj != payment_info.creditor_cpf_cnpj:
+    if row.creditor_cpf_cnpj != payment_info.creditor_cpf_cnpj:
         raise ValidationError("CPF / CNPJ is not the same as the creditor")
 
-    db_charge.payed_at = datetime.datetime.utcnow()
-    db_charge.is_active = False
-    db.add(db_charge)
+    if not row.is_active:
+        raise ValidationError("Charge is already paid")
+
+    raise Conflict("Charge changed during the payment, try again")
+
+
+# BALANCE THINGS
+
+
+BALANCE_ROLES = ("creditor", "debtor")
+
+
+def _balance_deltas(
+    charges: typing.Iterable[models.Charge], paid: bool
+) -> typing.Dict[typing.Tuple[str, str], list]:
+    # (cpf_cnpj, role) -> [open_count, open_total, paid_total]
+    deltas = collections.defaultdict(lambda: [0, 0.0, 0.0])
+    for charge in charges:
+        for role, cpf_cnpj in zip(
+            BALANCE_ROLES, (charge.creditor_cpf_cnpj, charge.debtor_cpf_cnpj)
+        ):
+            delta = deltas[cpf_cnpj, role]
+            if paid:
+                delta[0] -= 1
+                delta[1] -= charge.debito
+                delta[2] += charge.debito
+            else:
+                delta[0] += 1
+                delta[1] += charge.debito
+
+    return deltas
+
+
+@tracing.traced
+def update_balance_summaries(
+    db: sqlalchemy.orm.Session,
+    charges: typing.Iterable[models.Charge],
+    paid: bool = False,
+):
+    """ Update Balance Summaries
+
+    Add new charges, or the payment of open charges with `paid`, to the
+    summaries of their creditors and debtors. It runs in the transaction of
+    the caller, the summaries are committed along with the charges.
+    """
+    summaries = models.BalanceSummary.__table__
+    deltas = _balance_deltas(charges, paid)
+
+    # Always the same order, concurrent transactions do not deadlock
+    for (cpf_cnpj, role), delta in sorted(deltas.items()):
+        open_count, open_total, paid_total = delta
+        update = (
+            summaries.update()
+            .where(summaries.c.cpf_cnpj == cpf_cnpj)
+            .where(summaries.c.role == role)
+            .values(
+                open_count=summaries.c.open_count + open_count,
+                open_total=summaries.c.open_total + open_total,
+                paid_total=summaries.c.paid_total + paid_total,
+            )
+        )
+        if db.execute(update).rowcount:
+            continue
+
+        try:
+            with db.begin_nested():
+                db.execute(
+                    summaries.insert().values(
+                        cpf_cnpj=cpf_cnpj,
+                        role=role,
+                        open_count=open_count,
+                        open_total=open_total,
+                        paid_total=paid_total,
+                    )
+                )
+        except sqlalchemy.exc.IntegrityError:
+            # Another transaction created it in the meantime
+            db.execute(update)
+
+
+@tracing.traced
+def get_balance(
+    db: sqlalchemy.orm.Session, principal: Principal
+) -> schemas.Balance:
+    query = db.query(models.BalanceSummary).filter(
+        models.BalanceSummary.cpf_cnpj == principal.cpf_cnpj
+    )
+    totals = {summary.role: summary for summary in query}
+
+    return schemas.Balance(
+        cpf_cnpj=principal.cpf_cnpj,
+        **{
+            role: schemas.BalanceTotals.from_orm(totals[role])
+            if role in totals
+            else schemas.BalanceTotals()
+            for role in BALANCE_ROLES
+        },
+    )
+
+
+@tracing.traced
+def rebuild_balance_summaries(db: sqlalchemy.orm.Session) -> int:
+    """ Rebuild Balance Summaries
+
+    Compute every summary again from the charges, in case they ever drift
+
+    Returns:
+        int: number of summaries
+    """
+    summaries = models.BalanceSummary.__table__
+    charges = models.Charge.__table__
+    is_open = charges.c.is_active == sqlalchemy.true()
+
+    db.execute(summaries.delete())
+    for role in BALANCE_ROLES:
+        column = charges.c[f"{role}_cpf_cnpj"]
+        select = sqlalchemy.select(
+            column,
+            sqlalchemy.literal(role),
+            sqlalchemy.func.sum(sqlalchemy.case((is_open, 1), else_=0)),
+            sqlalchemy.func.sum(
+                sqlalchemy.case((is_open, charges.c.debito), else_=0.0)
+            ),
+            sqlalchemy.func.sum(
+                sqlalchemy.case((is_open, 0.0), else_=charges.c.debito)
+            ),
+        ).group_by(column)
+        db.execute(
+            summaries.insert().from_select(
+                ["cpf_cnpj", "role", "open_count", "open_total", "paid_total"],
+                select,
+            )
+        )
+
     db.commit()
-    return db_charge
+    return db.query(models.BalanceSummary).count()
+
+
+# IDEMPOTENCY THINGS
+
+
+def idempotency_digest(*parts: str) -> bytes:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x1f")
+
+    return digest.digest()
+
+
+def _idempotency_key_hash(principal: Principal, route: str, key: str) -> bytes:
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise ValidationError(
+            f"Idempotency-Key must have 1 to {IDEMPOTENCY_KEY_MAX_LENGTH}"
+            " characters"
+        )
+
+    return idempotency_digest(principal.cpf_cnpj or "", route, key)
+
+
+@tracing.traced
+def claim_idempotency_key(
+    db: sqlalchemy.orm.Session,
+    principal: Principal,
+    route: str,
+    key: str,
+    request_hash: bytes,
+    claimed_at: datetime.datetime,
+) -> typing.Optional[models.IdempotencyKey]:
+    """ Claim Idempotency Key
+
+    Claim `key` of the principal on `route` for this request,
+    the claim is committed so retries running at the same time see it.
+    A claim older than `IDEMPOTENCY_CLAIM_LEASE` is taken over.
+
+    Args:
+        claimed_at (datetime): start of the request, it identifies the
+         claim on `save_idempotent_response` and `release_idempotency_key`
+
+    Returns:
+        models.IdempotencyKey: the response of the first request when it
+         already finished, None when the key was claimed
+
+    Raises:
+        IdempotencyKeyInUse: the first request is still running
+        IdempotencyKeyMismatch: the first request had another body
+    """
+    key_hash = _idempotency_key_hash(principal, route, key)
+
+    db_key = db.get(models.IdempotencyKey, key_hash)
+    if db_key is not None and db_key.expires_at <= claimed_at:
+        db.delete(db_key)
+        db.flush()
+        db_key = None
+
+    if db_key is None:
+        db.add(
+            models.IdempotencyKey(
+                key_hash=key_hash,
+                request_hash=request_hash,
+                expires_at=claimed_at
+                + datetime.timedelta(seconds=IDEMPOTENCY_KEY_TTL),
+                claimed_at=claimed_at,
+            )
+        )
+        try:
+            db.commit()
+            return None
+        except sqlalchemy.exc.IntegrityError:
+            # A retry claimed it first
+            db.rollback()
+            db_key = db.get(models.IdempotencyKey, key_hash)
+
+    if db_key.request_hash != request_hash:
+        raise IdempotencyKeyMismatch(
+            "Idempotency-Key was already used with another request"
+        )
+
+    if db_key.status_code is None:
+        lease = datetime.timedelta(seconds=IDEMPOTENCY_CLAIM_LEASE)
+        stale = db_key.claimed_at is None or (
+            db_key.claimed_at <= claimed_at - lease
+        )
+        if stale and _take_over_claim(db, db_key, claimed_at):
+            return None
+
+        raise IdempotencyKeyInUse(
+            "A request with this Idempotency-Key is in progress"
+        )
+
+    return db_key
+
+
+def _take_over_claim(
+    db: sqlalchemy.orm.Session,
+    db_key: models.IdempotencyKey,
+    claimed_at: datetime.datetime,
+) -> bool:
+    # Retries racing for a stale claim, only the first one still finds it
+    previous = models.IdempotencyKey.claimed_at
+    taken = db.execute(
+        sqlalchemy.update(models.IdempotencyKey)
+        .where(
+            models.IdempotencyKey.key_hash == db_key.key_hash,
+            models.IdempotencyKey.status_code.is_(None),
+            previous.is_(None)
+            if db_key.claimed_at is None
+            else previous == db_key.claimed_at,
+        )
+        .values(claimed_at=claimed_at)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.commit()
+    return taken == 1
+
+
+@tracing.traced
+def save_idempotent_response(
+    db: sqlalchemy.orm.Session,
+    principal: Principal,
+    route: str,
+    key: str,
+    claimed_at: datetime.datetime,
+    status_code: int,
+    body: bytes,
+):
+    key_hash = _idempotency_key_hash(principal, route, key)
+    # A request that lost its claim to a retry leaves the key to it
+    db.execute(
+        sqlalchemy.update(models.IdempotencyKey)
+        .where(
+            models.IdempotencyKey.key_hash == key_hash,
+            models.IdempotencyKey.claimed_at == claimed_at,
+        )
+        .values(status_code=status_code, body=body)
+    )
+    db.commit()
+
+
+@tracing.traced
+def release_idempotency_key(
+    db: sqlalchemy.orm.Session,
+    principal: Principal,
+    route: str,
+    key: str,
+    claimed_at: datetime.datetime,
+):
+    """ Release Idempotency Key
+
+    Drop the claim of a request that failed, a retry runs it again
+    """
+    # The failed request may have left the session in a transaction
+    db.rollback()
+    key_hash = _idempotency_key_hash(principal, route, key)
+    db.execute(
+        sqlalchemy.delete(models.IdempotencyKey).where(
+            models.IdempotencyKey.key_hash == key_hash,
+            models.IdempotencyKey.status_code.is_(None),
+            models.IdempotencyKey.claimed_at == claimed_at,
+        )
+    )
+    db.commit()
+
+
+@tracing.traced
+def purge_idempotency_keys(
+    db: sqlalchemy.orm.Session, now: datetime.datetime = None
+) -> int:
+    """ Purge Idempotency Keys
+
+    Delete the expired keys, return how many were deleted
+    """
+    now = now or datetime.datetime.utcnow()
+    result = db.execute(
+        sqlalchemy.delete(models.IdempotencyKey).where(
+            models.IdempotencyKey.expires_at <= now
+        )
+    )
+    db.commit()
+    return result.rowcount
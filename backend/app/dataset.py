@@ -0,0 +1,256 @@
+""" Dataset
+
+Synthetic entities and charges for benchmarks. Datasets are reproducible,
+the same seed gives the same rows, and skewed like the real traffic: a few
+creditors hold most of the charges and a long tail holds a few each.
+
+Rows go straight to the tables of the models with executemany inserts,
+there are no ORM objects or per row validation on the way. The secondary
+indexes are dropped while loading and built once at the end, which is
+much cheaper than keeping them sorted row after row.
+"""
+
+import contextlib
+import datetime
+import itertools
+import random
+import time
+import typing
+import uuid
+
+import sqlalchemy
+import sqlalchemy.orm
+
+from . import cpf_cnpj as docs, data_access, models, security
+
+
+DEFAULT_PASSWORD = "dataset"
+
+
+def document_bases(length: int, rng: random.Random) -> typing.Iterator[str]:
+    """ Document Bases
+
+    Distinct document bodies of `length` digits in a seeded order. It is a
+    permutation of every body, so no two generated documents collide.
+    """
+    size = 10 ** length
+    start = rng.randrange(size)
+    # Coprime with 10 ** length, every body is visited once
+    stride = rng.randrange(size // 3, size // 2) | 1
+    while stride % 5 == 0:
+        stride += 2
+
+    for index in range(size):
+        yield str((start + index * stride) % size).zfill(length)
+
+
+def iter_documents(
+    rng: random.Random, companies: float = 0.2
+) -> typing.Iterator[docs.Document]:
+    """ Iter Documents
+
+    Valid CPF / CNPJ, about `companies` of them are CNPJ
+    """
+    cpf_bases = document_bases(docs.CPF_LENGTH - 2, rng)
+    cnpj_bases = document_bases(docs.CNPJ_LENGTH - 2, rng)
+    while True:
+        if rng.random() < companies:
+            digits = docs.with_check_digits(next(cnpj_bases))
+            if docs.is_valid_cnpj(digits):
+                yield docs.Document(digits, "pj")
+        else:
+            digits = docs.with_check_digits(next(cpf_bases))
+            if docs.is_valid_cpf(digits):
+                yield docs.Document(digits, "pf")
+
+
+def iter_entities(
+    count: int,
+    rng: random.Random,
+    hashed_password: str,
+    companies: float = 0.2,
+) -> typing.Iterator[dict]:
+    documents = itertools.islice(iter_documents(rng, companies), count)
+    for index, document in enumerate(documents):
+        yield {
+            "cpf_cnpj": document.cpf_cnpj,
+            "name": f"entity-{index}",
+            "type_entity": document.type_entity,
+            "hashed_password": hashed_password,
+        }
+
+
+def iter_charges(
+    count: int,
+    cpf_cnpjs: typing.Sequence[str],
+    rng: random.Random,
+    creditors: int,
+    skew: float = 1.1,
+    open_ratio: float = 0.7,
+    days: int = 365,
+    now: datetime.datetime = None,
+) -> typing.Iterator[dict]:
+    """ Iter Charges
+
+    Creditors are the first `creditors` entities, the one of rank i gets
+    charges in proportion to 1 / i ** `skew` (Zipf). Debtors are drawn
+    uniformly from every entity.
+
+    Args:
+        open_ratio (float): share of charges still open
+        days (int): charges are created over that many days before `now`
+    """
+    now = now or datetime.datetime(2020, 1, 1)
+    span = days * 86400
+    creditors = cpf_cnpjs[: max(min(creditors, len(cpf_cnpjs)), 1)]
+    cum_weights = list(
+        itertools.accumulate(
+            1 / (rank ** skew) for rank in range(1, len(creditors) + 1)
+        )
+    )
+
+    for _ in range(count):
+        creditor = rng.choices(creditors, cum_weights=cum_weights)[0]
+        debtor_index = rng.randrange(len(cpf_cnpjs))
+        if cpf_cnpjs[debtor_index] == creditor and len(cpf_cnpjs) > 1:
+            debtor_index -= 1
+
+        created_at = now - datetime.timedelta(seconds=rng.random() * span)
+        is_active = rng.random() < open_ratio
+        payed_at = None
+        if not is_active:
+            payed_at = created_at + (now - created_at) * rng.random()
+
+        yield {
+            "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "debtor_cpf_cnpj": cpf_cnpjs[debtor_index],
+            "creditor_cpf_cnpj": creditor,
+            "debito": round(rng.lognormvariate(4.5, 1.2), 2),
+            "is_active": is_active,
+            "created_at": created_at,
+            "payed_at": payed_at,
+        }
+
+
+def _batches(rows: typing.Iterable[dict], size: int):
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+@contextlib.contextmanager
+def _without_indexes(
+    engine: sqlalchemy.engine.Engine, table: sqlalchemy.Table
+):
+    existing = {
+        index["name"]
+        for index in sqlalchemy.inspect(engine).get_indexes(table.name)
+    }
+    indexes = [index for index in table.indexes if index.name in existing]
+    for index in indexes:
+        index.drop(engine)
+
+    try:
+        yield
+    finally:
+        for index in indexes:
+            index.create(engine)
+
+
+def _insert(
+    engine: sqlalchemy.engine.Engine,
+    table: sqlalchemy.Table,
+    rows: typing.Iterable[dict],
+    batch_size: int,
+    progress: typing.Callable = None,
+) -> int:
+    total = 0
+    statement = table.insert()
+    with _without_indexes(engine, table):
+        for batch in _batches(rows, batch_size):
+            with engine.begin() as connection:
+                connection.execute(statement, batch)
+
+            total += len(batch)
+            if progress:
+                progress(table.name, total)
+
+    return total
+
+
+def generate(
+    engine: sqlalchemy.engine.Engine,
+    entities: int,
+    charges: int,
+    creditors: int = None,
+    skew: float = 1.1,
+    seed: int = 0,
+    companies: float = 0.2,
+    open_ratio: float = 0.7,
+    password: str = DEFAULT_PASSWORD,
+    batch_size: int = 10000,
+    progress: typing.Callable = None,
+) -> dict:
+    """ Generate
+
+    Load `entities` entities and `charges` charges into an empty database
+    and rebuild the balance summaries. Every entity logs in with
+    `password`, it is hashed once for all of them.
+
+    Args:
+        creditors (int): entities that issue charges, a tenth of them by
+         default
+        skew (float): Zipf exponent of the charges per creditor, 0 is
+         uniform
+        progress (callable): called with (table name, rows so far) after
+         every batch
+
+    Returns:
+        dict: rows inserted per table and seconds taken
+    """
+    rng = random.Random(seed)
+    creditors = creditors or max(entities // 10, 1)
+    start = time.perf_counter()
+
+    cpf_cnpjs = []
+
+    # Hashed once here, the process pool is not worth it for one hash
+    hashed_password = security.get_pwd_context().hash(password)
+
+    def entity_rows():
+        for row in iter_entities(entities, rng, hashed_password, companies):
+            cpf_cnpjs.append(row["cpf_cnpj"])
+            yield row
+
+    result = {
+        "entities": _insert(
+            engine,
+            models.Entity.__table__,
+            entity_rows(),
+            batch_size,
+            progress,
+        )
+    }
+    result["charges"] = _insert(
+        engine,
+        models.Charge.__table__,
+        iter_charges(
+            charges,
+            cpf_cnpjs,
+            rng,
+            creditors=creditors,
+            skew=skew,
+            open_ratio=open_ratio,
+        ),
+        batch_size,
+        progress,
+    )
+
+    with sqlalchemy.orm.Session(engine) as db:
+        result["balance_summaries"] = data_access.rebuild_balance_summaries(db)
+
+    result["seconds"] = time.perf_counter() - start
+    return result
@@ -0,0 +1,81 @@
+""" Export
+
+This module encodes streams of charge rows, each chunk of rows read from
+the database becomes one chunk of the response body
+"""
+
+import csv
+import datetime
+import io
+import json
+import typing
+
+from . import schemas
+
+
+CHARGE_FIELDS = (
+    "id",
+    "debtor_cpf_cnpj",
+    "debtor_name",
+    "creditor_cpf_cnpj",
+    "creditor_name",
+    "debito",
+    "is_active",
+    "created_at",
+    "payed_at",
+)
+
+MEDIA_TYPES = {
+    schemas.ExportFormatEnum.ndjson: "application/x-ndjson",
+    schemas.ExportFormatEnum.csv: "text/csv",
+}
+
+
+def _to_primitive(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+
+    return value
+
+
+async def to_ndjson(
+    partitions: typing.AsyncIterator[typing.List[typing.Mapping]],
+) -> typing.AsyncIterator[bytes]:
+    async for rows in partitions:
+        lines = (
+            json.dumps(
+                {field: _to_primitive(row[field]) for field in CHARGE_FIELDS}
+            )
+            for row in rows
+        )
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+async def to_csv(
+    partitions: typing.AsyncIterator[typing.List[typing.Mapping]],
+) -> typing.AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CHARGE_FIELDS)
+
+    async for rows in partitions:
+        writer.writerows(
+            [_to_primitive(row[field]) for field in CHARGE_FIELDS]
+            for row in rows
+        )
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def encode(
+    export_format: schemas.ExportFormatEnum,
+    partitions: typing.AsyncIterator[typing.List[typing.Mapping]],
+) -> typing.AsyncIterator[bytes]:
+    if export_format == schemas.ExportFormatEnum.csv:
+        return to_csv(partitions)
+
+    return to_ndjson(partitions)
@@ -0,0 +1,526 @@
+""" Load Test
+
+Drive the API with the mix of calls its clients make and report the
+throughput and the latency per route, e.g.
+
+    python -m app.loadtest --users 16 --duration 30
+    python -m app.loadtest --url http://localhost:8000 --mix login=1,payment=4
+
+Without `--url` the ASGI app runs inside this process, there is no server
+or network in the way. It writes to the configured database, point
+SQLALCHEMY_DATABASE_URL to a scratch one first.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import math
+import random
+import sys
+import time
+import typing
+import urllib.parse
+
+from . import cpf_cnpj as docs
+
+
+VERSION = "/api/v.1"
+PASSWORD = "loadtest"
+DEFAULT_MIX = {
+    "login": 1,
+    "create_charge": 3,
+    "list_charges": 6,
+    "payment": 2,
+}
+PERCENTILES = (50, 95, 99)
+
+Response = collections.namedtuple("Response", "status headers body")
+
+
+def _encode(body) -> bytes:
+    return b"" if body is None else json.dumps(body).encode()
+
+
+class ASGITransport:
+    """ ASGI Transport
+
+    Call the ASGI app directly, every user shares it. Each user comes from
+    an address of its own, the routes without API key are rate limited
+    per client address as they are for real clients.
+    """
+
+    def __init__(self, app, client: str = "127.0.0.1"):
+        self.app = app
+        self.client = client
+        self._sessions = 0
+
+    async def start(self):
+        await self.app.router.startup()
+
+    async def close(self):
+        await self.app.router.shutdown()
+
+    def session(self) -> "ASGITransport":
+        self._sessions += 1
+        number = self._sessions
+        return ASGITransport(
+            self.app, client=f"10.0.{number // 256 % 256}.{number % 256}"
+        )
+
+    async def request(self, method: str, path: str, body=None) -> Response:
+        path, _, query = path.partition("?")
+        payload = _encode(body)
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": query.encode(),
+            "headers": [
+                (b"host", b"loadtest"),
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(payload)).encode()),
+            ],
+            "client": (self.client, 0),
+            "server": ("loadtest", 80),
+        }
+        done = asyncio.Event()
+        messages = [{"type": "http.request", "body": payload}]
+        start, chunks = {}, []
+
+        async def receive():
+            if messages:
+                return messages.pop()
+
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body"):
+                    done.set()
+
+        await self.app(scope, receive, send)
+        headers = {
+            name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in start.get("headers", [])
+        }
+        return Response(start["status"], headers, b"".join(chunks))
+
+
+class _HTTPConnection:
+    """ HTTP Connection
+
+    Minimal keep-alive HTTP/1.1 client, enough for the JSON of the API
+    """
+
+    def __init__(self, host: str, port: int, prefix: str):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method: str, path: str, body=None) -> Response:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+
+        payload = _encode(body)
+        head = (
+            f"{method} {self.prefix}{path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n\r\n"
+        )
+        self.writer.write(head.encode("latin-1") + payload)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding") == "chunked":
+            body = await self._read_chunked()
+        else:
+            length = int(headers.get("content-length", 0))
+            body = await self.reader.readexactly(length)
+
+        if headers.get("connection") == "close":
+            await self.close()
+
+        return Response(status, headers, body)
+
+    async def _read_chunked(self) -> bytes:
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b";")[0], 16)
+            chunk = await self.reader.readexactly(size + 2)
+            if not size:
+                return b"".join(chunks)
+            chunks.append(chunk[:-2])
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = self.reader = None
+
+
+class HTTPTransport:
+    """ HTTP Transport
+
+    Talk to a running server, e.g. uvicorn, one connection per user
+    """
+
+    def __init__(self, url: str):
+        url = urllib.parse.urlsplit(url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.prefix = url.path.rstrip("/")
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def session(self) -> _HTTPConnection:
+        return _HTTPConnection(self.host, self.port, self.prefix)
+
+
+def percentile(values: typing.Sequence[float], rank: float) -> float:
+    """ Percentile
+
+    Nearest rank percentile of sorted `values`
+    """
+    if not values:
+        return 0.0
+
+    index = max(math.ceil(rank / 100 * len(values)) - 1, 0)
+    return values[index]
+
+
+class Report:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.statuses = collections.defaultdict(collections.Counter)
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.started = time.perf_counter()
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    def record(self, route: str, seconds: float, status: int):
+        self.latencies[route].append(seconds)
+        self.statuses[route][status] += 1
+
+    def summary(self) -> dict:
+        """ Summary
+
+        Requests, requests per second and latency percentiles in
+        milliseconds, per route and for all of them under "total"
+        """
+        routes = dict(self.latencies)
+        routes["total"] = [
+            seconds for values in self.latencies.values() for seconds in values
+        ]
+        statuses = dict(self.statuses)
+        statuses["total"] = sum(self.statuses.values(), collections.Counter())
+
+        summary = {}
+        for route, values in routes.items():
+            values = sorted(values)
+            item = {
+                "requests": len(values),
+                "rps": len(values) / self.elapsed if self.elapsed else 0.0,
+            }
+            for rank in PERCENTILES:
+                item[f"p{rank}_ms"] = percentile(values, rank) * 1000
+            item["max_ms"] = (values[-1] if values else 0.0) * 1000
+            item["statuses"] = {
+                str(status): count
+                for status, count in sorted(statuses[route].items())
+            }
+            summary[route] = item
+
+        return summary
+
+    def format(self) -> str:
+        columns = ("requests", "rps") + tuple(
+            f"p{rank}_ms" for rank in PERCENTILES
+        )
+        lines = [
+            f"{'route':<28}"
+            + "".join(f"{column:>10}" for column in columns)
+            + "  statuses"
+        ]
+        for route, item in self.summary().items():
+            lines.append(
+                f"{route:<28}"
+                + f"{item['requests']:>10}"
+                + "".join(
+                    f"{item[column]:>10.1f}" for column in columns[1:]
+                )
+                + "  "
+                + " ".join(f"{s}:{n}" for s, n in item["statuses"].items())
+            )
+
+        lines.append(f"elapsed {self.elapsed:.2f}s")
+        return "\n".join(lines)
+
+
+class VirtualUser:
+    """ Virtual User
+
+    A creditor that logs in, creates charges, lists and pays them
+    """
+
+    def __init__(self, session, rng: random.Random, report: Report):
+        self.session = session
+        self.rng = rng
+        self.report = report
+        self.cpf_cnpj = docs.random_cpf(rng)
+        self.api_key = None
+        self.open_charges = []
+
+    async def call(
+        self,
+        route: str,
+        method: str,
+        path: str,
+        body=None,
+        record=True,
+        retry_busy=False,
+    ) -> Response:
+        start = time.perf_counter()
+        response = await self.session.request(method, VERSION + path, body)
+        if record:
+            self.report.record(
+                route, time.perf_counter() - start, response.status
+            )
+
+        if retry_busy and response.status == 503:
+            # Every user signs up at once, the password hasher sheds some
+            await asyncio.sleep(float(response.headers.get("retry-after", 1)))
+            return await self.call(
+                route, method, path, body, record, retry_busy
+            )
+
+        return response
+
+    async def setup(self):
+        await self.call(
+            "POST /entity",
+            "POST",
+            "/entity",
+            {
+                "name": "loadtest",
+                "cpf_cnpj": self.cpf_cnpj,
+                "password": PASSWORD,
+            },
+            record=False,
+            retry_busy=True,
+        )
+        await self.login(record=False, retry_busy=True)
+        if not self.api_key:
+            raise RuntimeError(f"Could not log in as {self.cpf_cnpj}")
+
+    async def login(self, record=True, retry_busy=False):
+        response = await self.call(
+            "POST /authenticate",
+            "POST",
+            "/authenticate",
+            {"cpf_cnpj": self.cpf_cnpj, "password": PASSWORD},
+            record=record,
+            retry_busy=retry_busy,
+        )
+        if response.status == 200:
+            self.api_key = json.loads(response.body)["api_key"]
+
+    async def create_charge(self):
+        response = await self.call(
+            "POST /charge",
+            "POST",
+            f"/charge?api_key={self.api_key}",
+            {
+                "debtor": {
+                    "name": "debtor",
+                    "cpf_cnpj": docs.random_cpf(self.rng),
+                },
+                "creditor_cpf_cnpj": self.cpf_cnpj,
+                "debito": round(self.rng.uniform(1, 1000), 2),
+            },
+        )
+        if response.status == 201:
+            self.open_charges.append(json.loads(response.body)["id"])
+
+    async def list_charges(self):
+        is_active = self.rng.choice(("", "&is_active=true"))
+        await self.call(
+            "GET /charge",
+            "GET",
+            f"/charge?api_key={self.api_key}"
+            f"&creditor_cpf_cnpj={self.cpf_cnpj}{is_active}",
+        )
+
+    async def payment(self):
+        if not self.open_charges:
+            await self.create_charge()
+            return
+
+        charge_id = self.open_charges.pop(
+            self.rng.randrange(len(self.open_charges))
+        )
+        await self.call(
+            "POST /charge/payment",
+            "POST",
+            f"/charge/payment?api_key={self.api_key}",
+            {"id": charge_id, "creditor_cpf_cnpj": self.cpf_cnpj},
+        )
+
+
+async def run(
+    transport,
+    users: int = 16,
+    duration: float = 10.0,
+    requests: int = 0,
+    mix: typing.Dict[str, int] = None,
+    seed: int = 0,
+) -> Report:
+    """ Run
+
+    Set the users up, then keep them calling until `duration` seconds
+    passed or, when given, `requests` calls were made
+
+    Args:
+        mix (dict): operation of `VirtualUser` -> weight
+    """
+    mix = mix or DEFAULT_MIX
+    operations, weights = zip(*mix.items())
+    rng = random.Random(seed)
+    report = Report()
+    budget = [requests or math.inf]
+
+    await transport.start()
+    sessions = [transport.session() for _ in range(users)]
+    virtual_users = [
+        VirtualUser(session, random.Random(rng.random()), report)
+        for session in sessions
+    ]
+    try:
+        await asyncio.gather(*(user.setup() for user in virtual_users))
+
+        report.start()
+        deadline = time.perf_counter() + duration
+
+        async def loop(user: VirtualUser):
+            while budget[0] > 0 and time.perf_counter() < deadline:
+                budget[0] -= 1
+                operation = user.rng.choices(operations, weights)[0]
+                await getattr(user, operation)()
+
+        await asyncio.gather(*(loop(user) for user in virtual_users))
+        report.finish()
+    finally:
+        for session in sessions:
+            if session is not transport:
+                await session.close()
+        await transport.close()
+
+    return report
+
+
+def parse_mix(value: str) -> typing.Dict[str, int]:
+    """ Parse Mix
+
+    e.g. "login=1,list_charges=6" -> {"login": 1, "list_charges": 6}
+    """
+    mix = {}
+    for item in value.split(","):
+        operation, _, weight = item.partition("=")
+        operation = operation.strip()
+        if operation not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(
+                f"Unknown operation {operation!r}, "
+                f"use {', '.join(DEFAULT_MIX)}"
+            )
+        mix[operation] = int(weight or 1)
+
+    return mix
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m app.loadtest")
+    parser.add_argument(
+        "--url", help="Base URL of a running server, in process when unset"
+    )
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="Seconds to run"
+    )
+    parser.add_argument(
+        "--requests", type=int, default=0, help="Stop after that many calls"
+    )
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="Weights, e.g. login=1,create_charge=3,list_charges=6,payment=2",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--json", action="store_true", help="Print the summary as JSON"
+    )
+    return parser
+
+
+def main(argv: typing.List[str] = None):
+    args = build_parser().parse_args(argv)
+
+    if args.url:
+        transport = HTTPTransport(args.url)
+    else:
+        # Imported here, the app connects to the database on import
+        from . import api
+
+        transport = ASGITransport(api.app)
+
+    report = asyncio.run(
+        run(
+            transport,
+            users=args.users,
+            duration=args.duration,
+            requests=args.requests,
+            mix=args.mix,
+            seed=args.seed,
+        )
+    )
+    if args.json:
+        print(json.dumps(report.summary(), indent=2))
+    else:
+        print(report.format())
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,235 @@
+""" Manage
+
+Maintenance commands, run with `python -m app.manage <command>` e.g.
+
+    python -m app.manage migrate
+    python -m app.manage rebuild-summaries
+    python -m app.manage purge-idempotency-keys
+    python -m app.manage generate-dataset --entities 100000 --charges 1000000
+    python -m app.manage startup-benchmark --runs 10
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import statistics
+import subprocess
+import sys
+import time
+import typing
+
+
+# The app modules are imported by the commands that use them, the ones
+# below must not preload anything for cold-start
+
+
+def migrate(args: argparse.Namespace):
+    from . import database, migrations
+
+    applied = migrations.upgrade(database.engine)
+    for item in applied:
+        print(f"Applied {item.version:04d} {item.description}")
+
+    if not applied:
+        print("Database is up to date")
+
+
+def rebuild_summaries(args: argparse.Namespace):
+    from . import data_access, database
+
+    db = database.SessionLocal()
+    try:
+        count = data_access.rebuild_balance_summaries(db)
+    finally:
+        db.close()
+
+    print(f"Rebuilt {count} balance summaries")
+
+
+def purge_idempotency_keys(args: argparse.Namespace):
+    from . import data_access, database
+
+    db = database.SessionLocal()
+    try:
+        count = data_access.purge_idempotency_keys(db)
+    finally:
+        db.close()
+
+    print(f"Purged {count} expired idempotency keys")
+
+
+def generate_dataset(args: argparse.Namespace):
+    from . import database, dataset, migrations
+
+    migrations.upgrade(database.engine)
+
+    def progress(table_name: str, rows: int):
+        print(f"{table_name}: {rows} rows", end="\r", flush=True)
+
+    result = dataset.generate(
+        database.engine,
+        entities=args.entities,
+        charges=args.charges,
+        creditors=args.creditors,
+        skew=args.skew,
+        seed=args.seed,
+        companies=args.companies,
+        open_ratio=args.open_ratio,
+        password=args.password or dataset.DEFAULT_PASSWORD,
+        batch_size=args.batch_size,
+        progress=progress,
+    )
+    print(
+        f"Inserted {result['entities']} entities and {result['charges']} "
+        f"charges in {result['seconds']:.1f}s"
+    )
+
+
+def cold_start(args: argparse.Namespace):
+    """ Cold Start
+
+    Import the app, run its startup and serve one request, then print how
+    long each step took as JSON. Run in a fresh process by
+    `startup_benchmark`, nothing may be imported before.
+    """
+    start = time.perf_counter()
+    module_name, _, attribute = args.app.partition(":")
+    app = getattr(importlib.import_module(module_name), attribute)
+    imported = time.perf_counter()
+
+    from . import loadtest
+
+    async def first_request():
+        transport = loadtest.ASGITransport(app)
+        await transport.start()
+        started = time.perf_counter()
+        response = await transport.request("GET", args.path)
+        answered = time.perf_counter()
+        answered_at = time.time()
+        await transport.close()
+        return started, answered, answered_at, response.status
+
+    started, answered, answered_at, status = asyncio.run(first_request())
+    print(
+        json.dumps(
+            {
+                "import": imported - start,
+                "startup": started - imported,
+                "first_request": answered - started,
+                "answered_at": answered_at,
+                "status": status,
+            }
+        )
+    )
+
+
+def startup_benchmark(args: argparse.Namespace):
+    """ Startup Benchmark
+
+    Start the app `args.runs` times, each in a new interpreter, and report
+    the time to the first response from the moment the process is spawned
+    """
+    command = [sys.executable, "-m", f"{__package__}.manage", "cold-start"]
+    command += ["--app", args.app, "--path", args.path]
+    runs = []
+    for _ in range(args.runs):
+        spawned_at = time.time()
+        output = subprocess.run(
+            command, check=True, stdout=subprocess.PIPE, text=True
+        ).stdout
+        run = json.loads(output.splitlines()[-1])
+        run["total"] = run.pop("answered_at") - spawned_at
+        runs.append(run)
+
+    print(f"{args.app} GET {args.path} -> {runs[-1]['status']}")
+    print(f"{'step':<16}{'median':>10}{'min':>10}{'max':>10}")
+    for step in ("import", "startup", "first_request", "total"):
+        values = [run[step] * 1000 for run in runs]
+        print(
+            f"{step:<16}{statistics.median(values):>8.1f}ms"
+            f"{min(values):>8.1f}ms{max(values):>8.1f}ms"
+        )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m app.manage")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("migrate", help="Apply pending migrations")
+    command.set_defaults(handler=migrate)
+
+    command = commands.add_parser(
+        "rebuild-summaries",
+        help="Compute the balance summaries again from the charges",
+    )
+    command.set_defaults(handler=rebuild_summaries)
+
+    command = commands.add_parser(
+        "purge-idempotency-keys",
+        help="Delete the expired idempotency keys, run it periodically",
+    )
+    command.set_defaults(handler=purge_idempotency_keys)
+
+    command = commands.add_parser(
+        "generate-dataset",
+        help="Load a synthetic dataset for benchmarks, on an empty database",
+    )
+    command.add_argument("--entities", type=int, default=10000)
+    command.add_argument("--charges", type=int, default=100000)
+    command.add_argument(
+        "--creditors",
+        type=int,
+        default=None,
+        help="Entities that issue charges, a tenth of them by default",
+    )
+    command.add_argument(
+        "--skew",
+        type=float,
+        default=1.1,
+        help="Zipf exponent of the charges per creditor, 0 is uniform",
+    )
+    command.add_argument("--seed", type=int, default=0)
+    command.add_argument(
+        "--companies", type=float, default=0.2, help="Share of CNPJ"
+    )
+    command.add_argument(
+        "--open-ratio", type=float, default=0.7, help="Share of open charges"
+    )
+    command.add_argument(
+        "--password", help="Of every entity, 'dataset' by default"
+    )
+    command.add_argument("--batch-size", type=int, default=10000)
+    command.set_defaults(handler=generate_dataset)
+
+    default_app = f"{__package__}.api:app"
+    # Reaches the database, the API key is well formed so it is looked up,
+    # then refused
+    default_path = "/api/v.1/entity-logged?api_key=startup.benchmark"
+
+    command = commands.add_parser(
+        "startup-benchmark",
+        help="Time from process start to the first response of the app",
+    )
+    command.add_argument("--app", default=default_app)
+    command.add_argument("--path", default=default_path)
+    command.add_argument("--runs", type=int, default=5)
+    command.set_defaults(handler=startup_benchmark)
+
+    command = commands.add_parser(
+        "cold-start", help="One run of startup-benchmark"
+    )
+    command.add_argument("--app", default=default_app)
+    command.add_argument("--path", default=default_path)
+    command.set_defaults(handler=cold_start)
+
+    return parser
+
+
+def main(argv: typing.List[str] = None):
+    args = build_parser().parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,488 @@
+""" Metrics
+
+Counters and histograms of the service, exposed on /metrics in the
+Prometheus text format. Requests are measured by `MetricsMiddleware`, SQL
+statements by engine events and password hashing by `security`. Pool and
+cache usage is read when /metrics is scraped.
+
+Statements are also added up per request, the totals of the current
+request live on a context variable, so they follow the request into the
+executor threads and greenlets that run data access.
+
+The registry lives in the memory of the process: with several workers
+(e.g. `uvicorn --workers 4`) each scrape of /metrics shows the worker
+that answered it, not the whole service. Run a single worker per
+container and scrape every container to see all of them.
+"""
+
+import bisect
+import contextvars
+import threading
+import time
+import typing
+
+import sqlalchemy.engine
+import sqlalchemy.event
+
+from . import database, tracing
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+STATEMENT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+PASSWORD_HASH_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value))
+
+
+def _format_labels(labels: typing.Iterable[typing.Tuple[str, str]]) -> str:
+    items = [
+        '{}="{}"'.format(
+            name,
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\n", "\\n")
+            .replace('"', '\\"'),
+        )
+        for name, value in labels
+    ]
+    return "{" + ",".join(items) + "}" if items else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: typing.Sequence[str] = (),
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def header(self) -> typing.List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> typing.List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return self.header() + [
+            self.name
+            + _format_labels(zip(self.labelnames, key))
+            + f" {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0)
+            )
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+        return sum(counts)
+
+    def sum(self, **labels) -> float:
+        return self._values.get(self._key(labels), ([0], 0.0))[1]
+
+    def render(self) -> typing.List[str]:
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total))
+                for key, (counts, total) in self._values.items()
+            )
+
+        lines = self.header()
+        for key, (counts, total) in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket"
+                    + _format_labels(labels + [("le", _format_value(bound))])
+                    + f" {cumulative}"
+                )
+            lines.append(
+                f"{self.name}_sum{_format_labels(labels)} "
+                f"{_format_value(total)}"
+            )
+            lines.append(
+                f"{self.name}_count{_format_labels(labels)} {cumulative}"
+            )
+
+        return lines
+
+
+Sample = typing.Tuple[str, str, str, typing.List[typing.Tuple[dict, float]]]
+
+
+class Registry:
+    """ Registry
+
+    Metrics that record as things happen, and collectors that are called
+    on every scrape and return (name, kind, help, [(labels, value)])
+    """
+
+    def __init__(self):
+        self.metrics: typing.List[_Metric] = []
+        self.collectors: typing.List[typing.Callable] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: typing.Callable[[], typing.List]):
+        self.collectors.append(collector)
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        for collector in self.collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(
+                        name
+                        + _format_labels(sorted(labels.items()))
+                        + f" {_format_value(value)}"
+                    )
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HTTP_REQUESTS = registry.register(
+    Counter(
+        "http_requests_total",
+        "Requests served, by route and status",
+        ("method", "route", "status"),
+    )
+)
+HTTP_REQUEST_DURATION = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time to serve a request, by route",
+        ("method", "route"),
+    )
+)
+DB_STATEMENT_DURATION = registry.register(
+    Histogram(
+        "db_statement_duration_seconds",
+        "Time to execute a SQL statement, by operation",
+        ("operation",),
+        buckets=STATEMENT_BUCKETS,
+    )
+)
+DB_STATEMENTS_PER_REQUEST = registry.register(
+    Histogram(
+        "db_statements_per_request",
+        "SQL statements executed to serve a request, by route",
+        ("method", "route"),
+        buckets=COUNT_BUCKETS,
+    )
+)
+DB_SECONDS_PER_REQUEST = registry.register(
+    Histogram(
+        "db_seconds_per_request",
+        "Time spent executing SQL to serve a request, by route",
+        ("method", "route"),
+        buckets=STATEMENT_BUCKETS,
+    )
+)
+PASSWORD_HASH_DURATION = registry.register(
+    Histogram(
+        "password_hash_duration_seconds",
+        "Time to hash or verify a password, queue included",
+        ("operation",),
+        buckets=PASSWORD_HASH_BUCKETS,
+    )
+)
+PASSWORD_HASH_REJECTED = registry.register(
+    Counter(
+        "password_hash_rejected_total",
+        "Password hashing jobs refused because the queue was full",
+    )
+)
+
+
+# SQL STATEMENTS
+
+
+class RequestStatistics:
+    __slots__ = ("statements", "seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+
+_request_statistics: contextvars.ContextVar = contextvars.ContextVar(
+    "request_statistics", default=None
+)
+
+
+def current_request_statistics() -> typing.Optional[RequestStatistics]:
+    return _request_statistics.get()
+
+
+def _before_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+):
+    conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+):
+    started = conn.info.get("metrics_started")
+    if not started:
+        return
+
+    seconds = time.perf_counter() - started.pop()
+    operation = statement.lstrip().split(None, 1)[0].upper()
+    DB_STATEMENT_DURATION.observe(seconds, operation=operation)
+
+    statistics = _request_statistics.get()
+    if statistics is not None:
+        statistics.statements += 1
+        statistics.seconds += seconds
+
+
+def _handle_error(context):
+    started = context.connection.info.get("metrics_started")
+    if started:
+        started.pop()
+
+
+_installed = False
+
+
+def install_sql_listeners():
+    """ Install SQL Listeners
+
+    Time the statements of every engine, async engines included, it is
+    safe to call more than once
+    """
+    global _installed
+
+    if _installed:
+        return
+
+    engine_class = sqlalchemy.engine.Engine
+    sqlalchemy.event.listen(
+        engine_class, "before_cursor_execute", _before_cursor_execute
+    )
+    sqlalchemy.event.listen(
+        engine_class, "after_cursor_execute", _after_cursor_execute
+    )
+    sqlalchemy.event.listen(engine_class, "handle_error", _handle_error)
+    _installed = True
+
+
+# REQUESTS
+
+
+class MetricsMiddleware:
+    """ Metrics Middleware
+
+    Record the latency, status and SQL usage of every HTTP request
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        statistics = RequestStatistics()
+        token = _request_statistics.set(statistics)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            seconds = time.perf_counter() - start
+            _request_statistics.reset(token)
+
+            method = scope["method"]
+            # Templates, so ids do not become labels
+            route = tracing.route_path(scope, default="unmatched")
+            HTTP_REQUESTS.inc(method=method, route=route, status=status[0])
+            HTTP_REQUEST_DURATION.observe(seconds, method=method, route=route)
+            DB_STATEMENTS_PER_REQUEST.observe(
+                statistics.statements, method=method, route=route
+            )
+            DB_SECONDS_PER_REQUEST.observe(
+                statistics.seconds, method=method, route=route
+            )
+
+
+# COLLECTORS
+
+
+_POOL_GAUGES = (
+    ("size", "db_pool_size", "Connections the pool keeps open"),
+    ("checked_out", "db_pool_checked_out", "Connections in use"),
+    ("checked_in", "db_pool_checked_in", "Idle connections in the pool"),
+    ("overflow", "db_pool_overflow", "Connections open above the size"),
+)
+_POOL_COUNTERS = (
+    ("wait_count", "db_pool_checkouts_total", "Connections checked out"),
+    (
+        "wait_seconds_total",
+        "db_pool_wait_seconds_total",
+        "Time spent waiting for a free connection",
+    ),
+    ("timeouts", "db_pool_timeouts_total", "Checkouts that timed out"),
+)
+
+
+def collect_pools() -> typing.List[Sample]:
+    statistics = {
+        name: database.pool_statistics(engine)
+        for name, engine in database.engines().items()
+    }
+
+    samples = []
+    families = (("gauge", _POOL_GAUGES), ("counter", _POOL_COUNTERS))
+    for kind, metrics in families:
+        for key, name, documentation in metrics:
+            values = [
+                ({"engine": engine}, items[key])
+                for engine, items in statistics.items()
+                if key in items
+            ]
+            if values:
+                samples.append((name, kind, documentation, values))
+
+    return samples
+
+
+def cache_collector(
+    caches: typing.Dict[str, typing.Callable],
+) -> typing.Callable[[], typing.List[Sample]]:
+    """ Cache Collector
+
+    Args:
+        caches (dict): name -> function returning the statistics of the
+         cache, a `cache_info()` namedtuple or a dict with hits, misses and
+         size or currsize
+    """
+
+    def collect() -> typing.List[Sample]:
+        statistics = {}
+        for name, function in caches.items():
+            info = function()
+            info = info._asdict() if hasattr(info, "_asdict") else info
+            statistics[name] = info
+
+        return [
+            (
+                "cache_hits_total",
+                "counter",
+                "Lookups answered by the cache",
+                [({"cache": n}, s["hits"]) for n, s in statistics.items()],
+            ),
+            (
+                "cache_misses_total",
+                "counter",
+                "Lookups not found on the cache",
+                [({"cache": n}, s["misses"]) for n, s in statistics.items()],
+            ),
+            (
+                "cache_size",
+                "gauge",
+                "Entries on the cache",
+                [
+                    ({"cache": n}, s.get("size", s.get("currsize", 0)))
+                    for n, s in statistics.items()
+                ],
+            ),
+        ]
+
+    return collect
+
+
+registry.add_collector(collect_pools)
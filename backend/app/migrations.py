@@ -0,0 +1,290 @@
+""" Migrations
+
+This module owns the database schema. Every change to it is a numbered
+migration, the ones already applied are recorded on `schema_migrations`
+so `upgrade` only runs what is missing on a given database.
+
+Migrations must not import the current models, they describe the schema as
+it was when they were written.
+"""
+
+import collections
+import datetime
+import typing
+
+import sqlalchemy
+
+from . import cpf_cnpj as docs
+
+
+Migration = collections.namedtuple("Migration", "version description apply")
+
+MIGRATIONS: typing.List[Migration] = []
+
+_metadata = sqlalchemy.MetaData()
+
+schema_migrations = sqlalchemy.Table(
+    "schema_migrations",
+    _metadata,
+    sqlalchemy.Column("version", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("description", sqlalchemy.String),
+    sqlalchemy.Column("applied_at", sqlalchemy.DateTime),
+)
+
+
+def migration(version: int, description: str):
+    def register(function):
+        MIGRATIONS.append(Migration(version, description, function))
+        MIGRATIONS.sort(key=lambda item: item.version)
+        return function
+
+    return register
+
+
+def _reflect(connection, table_name: str) -> sqlalchemy.Table:
+    return sqlalchemy.Table(
+        table_name, sqlalchemy.MetaData(), autoload_with=connection
+    )
+
+
+def applied_versions(connection) -> typing.Set[int]:
+    schema_migrations.create(connection, checkfirst=True)
+    rows = connection.execute(sqlalchemy.select(schema_migrations.c.version))
+    return {version for version, in rows}
+
+
+def upgrade(engine: sqlalchemy.engine.Engine) -> typing.List[Migration]:
+    """ Upgrade
+
+    Apply every pending migration in order, each one in its own
+    transaction, and return the migrations that were applied
+    """
+    with engine.begin() as connection:
+        applied = applied_versions(connection)
+
+    pending = [item for item in MIGRATIONS if item.version not in applied]
+    for item in pending:
+        with engine.begin() as connection:
+            item.apply(connection)
+            connection.execute(
+                schema_migrations.insert().values(
+                    version=item.version,
+                    description=item.description,
+                    applied_at=datetime.datetime.utcnow(),
+                )
+            )
+
+    return pending
+
+
+@migration(1, "Initial schema")
+def _initial_schema(connection):
+    # Databases created before migrations existed already have these
+    # tables, creating with checkfirst adopts them as they are
+    metadata = sqlalchemy.MetaData()
+    sqlalchemy.Table(
+        "entities",
+        metadata,
+        sqlalchemy.Column(
+            "cpf_cnpj",
+            sqlalchemy.String,
+            primary_key=True,
+            unique=True,
+            index=True,
+        ),
+        sqlalchemy.Column("name", sqlalchemy.String),
+        sqlalchemy.Column("type_entity", sqlalchemy.String(2)),
+        sqlalchemy.Column("hashed_password", sqlalchemy.String, nullable=True),
+    )
+    sqlalchemy.Table(
+        "charges",
+        metadata,
+        sqlalchemy.Column(
+            "id", sqlalchemy.String, primary_key=True, unique=True, index=True
+        ),
+        sqlalchemy.Column(
+            "debtor_cpf_cnpj",
+            sqlalchemy.String,
+            sqlalchemy.ForeignKey("entities.cpf_cnpj"),
+        ),
+        sqlalchemy.Column(
+            "creditor_cpf_cnpj",
+            sqlalchemy.String,
+            sqlalchemy.ForeignKey("entities.cpf_cnpj"),
+        ),
+        sqlalchemy.Column("debito", sqlalchemy.Float),
+        sqlalchemy.Column("is_active", sqlalchemy.Boolean),
+        sqlalchemy.Column("created_at", sqlalchemy.DateTime),
+        sqlalchemy.Column("payed_at", sqlalchemy.DateTime, nullable=True),
+    )
+    sqlalchemy.Table(
+        "apikeys",
+        metadata,
+        sqlalchemy.Column(
+            "id",
+            sqlalchemy.String(32),
+            primary_key=True,
+            unique=True,
+            index=True,
+        ),
+        sqlalchemy.Column("verifier_hash", sqlalchemy.String(64)),
+        sqlalchemy.Column(
+            "cpf_cnpj",
+            sqlalchemy.String,
+            sqlalchemy.ForeignKey("entities.cpf_cnpj"),
+            nullable=True,
+        ),
+        sqlalchemy.Column("is_admin", sqlalchemy.Boolean),
+        sqlalchemy.Column("created_at", sqlalchemy.DateTime),
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+
+@migration(2, "Indexes for charge filters and API key lookups")
+def _performance_indexes(connection):
+    charges = _reflect(connection, "charges")
+    apikeys = _reflect(connection, "apikeys")
+    entities = _reflect(connection, "entities")
+
+    indexes = (
+        # GET /charge as a creditor, optionally only the open ones
+        sqlalchemy.Index(
+            "ix_charges_creditor_active_created",
+            charges.c.creditor_cpf_cnpj,
+            charges.c.is_active,
+            charges.c.created_at,
+        ),
+        # GET /charge as a debtor, optionally only the open ones
+        sqlalchemy.Index(
+            "ix_charges_debtor_active_created",
+            charges.c.debtor_cpf_cnpj,
+            charges.c.is_active,
+            charges.c.created_at,
+        ),
+        # Keyset pagination order when no cpf_cnpj is given
+        sqlalchemy.Index(
+            "ix_charges_created_id", charges.c.created_at, charges.c.id
+        ),
+        # Logout deletes every key of the entity
+        sqlalchemy.Index("ix_apikeys_cpf_cnpj", apikeys.c.cpf_cnpj),
+        sqlalchemy.Index("ix_entities_type_entity", entities.c.type_entity),
+    )
+    for index in indexes:
+        index.create(connection, checkfirst=True)
+
+
+@migration(3, "Balance summaries per creditor and debtor")
+def _balance_summaries(connection):
+    metadata = sqlalchemy.MetaData()
+    sqlalchemy.Table("entities", metadata, autoload_with=connection)
+    summaries = sqlalchemy.Table(
+        "balance_summaries",
+        metadata,
+        sqlalchemy.Column(
+            "cpf_cnpj",
+            sqlalchemy.String,
+            sqlalchemy.ForeignKey("entities.cpf_cnpj"),
+            primary_key=True,
+        ),
+        sqlalchemy.Column("role", sqlalchemy.String(8), primary_key=True),
+        sqlalchemy.Column("open_count", sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column("open_total", sqlalchemy.Float, nullable=False),
+        sqlalchemy.Column("paid_total", sqlalchemy.Float, nullable=False),
+    )
+    summaries.create(connection, checkfirst=True)
+
+    # Summaries of the charges that already exist
+    charges = _reflect(connection, "charges")
+    is_open = charges.c.is_active == sqlalchemy.true()
+    for role, column in (
+        ("creditor", charges.c.creditor_cpf_cnpj),
+        ("debtor", charges.c.debtor_cpf_cnpj),
+    ):
+        select = sqlalchemy.select(
+            column,
+            sqlalchemy.literal(role),
+            sqlalchemy.func.sum(sqlalchemy.case((is_open, 1), else_=0)),
+            sqlalchemy.func.sum(
+                sqlalchemy.case((is_open, charges.c.debito), else_=0.0)
+            ),
+            sqlalchemy.func.sum(
+                sqlalchemy.case((is_open, 0.0), else_=charges.c.debito)
+            ),
+        ).group_by(column)
+        connection.execute(
+            summaries.insert().from_select(
+                ["cpf_cnpj", "role", "open_count", "open_total", "paid_total"],
+                select,
+            )
+        )
+
+
+@migration(4, "Idempotency keys of charge writes")
+def _idempotency_keys(connection):
+    metadata = sqlalchemy.MetaData()
+    sqlalchemy.Table(
+        "idempotency_keys",
+        metadata,
+        sqlalchemy.Column(
+            "key_hash", sqlalchemy.LargeBinary(16), primary_key=True
+        ),
+        sqlalchemy.Column(
+            "request_hash", sqlalchemy.LargeBinary(16), nullable=False
+        ),
+        sqlalchemy.Column("status_code", sqlalchemy.SmallInteger),
+        sqlalchemy.Column("body", sqlalchemy.LargeBinary),
+        # Purged by `manage purge-idempotency-keys`
+        sqlalchemy.Column(
+            "expires_at", sqlalchemy.DateTime, nullable=False, index=True
+        ),
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+
+@migration(5, "Version of charges for optimistic concurrency")
+def _charge_version(connection):
+    # Databases made by create_all of the current models already have it
+    charges = _reflect(connection, "charges")
+    if "version" not in charges.c:
+        connection.execute(
+            sqlalchemy.text(
+                "ALTER TABLE charges "
+                "ADD COLUMN version INTEGER NOT NULL DEFAULT 1"
+            )
+        )
+
+
+@migration(6, "Claim time of idempotency keys")
+def _idempotency_key_claimed_at(connection):
+    idempotency_keys = _reflect(connection, "idempotency_keys")
+    if "claimed_at" not in idempotency_keys.c:
+        connection.execute(
+            sqlalchemy.text(
+                "ALTER TABLE idempotency_keys ADD COLUMN claimed_at TIMESTAMP"
+            )
+        )
+
+
+@migration(7, "Type of the entities created before it was stored")
+def _entity_type_backfill(connection):
+    entities = _reflect(connection, "entities")
+    rows = connection.execute(
+        sqlalchemy.select(entities.c.cpf_cnpj).where(
+            entities.c.type_entity.is_(None)
+        )
+    ).fetchall()
+
+    update = (
+        entities.update()
+        .where(entities.c.cpf_cnpj == sqlalchemy.bindparam("key"))
+        .values(type_entity=sqlalchemy.bindparam("type_entity"))
+    )
+    values = [
+        {"key": row.cpf_cnpj, "type_entity": docs.document_type(row.cpf_cnpj)}
+        for row in rows
+    ]
+    # Invalid documents have no type, they are left NULL
+    values = [item for item in values if item["type_entity"]]
+    for start in range(0, len(values), 1000):
+        end = start + 1000
+        connection.execute(update, values[start:end])
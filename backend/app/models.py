@@ -14,7 +14,7 @@ class Entity(Base):
         sqlalchemy.String, primary_key=True, unique=True, index=True
     )
     name = sqlalchemy.Column(sqlalchemy.String)
-    type_entity = sqlalchemy.Column(sqlalchemy.String(2))
+    type_entity = sqlalchemy.Column(sqlalchemy.String(2), index=True)
     hashed_password = sqlalchemy.Column(
         sqlalchemy.String, nullable=True, default=None
     )
@@ -22,6 +22,21 @@ class Entity(Base):
 
 class Charge(Base):
     __tablename__ = "charges"
+    __table_args__ = (
+        sqlalchemy.Index(
+            "ix_charges_creditor_active_created",
+            "creditor_cpf_cnpj",
+            "is_active",
+            "created_at",
+        ),
+        sqlalchemy.Index(
+            "ix_charges_debtor_active_created",
+            "debtor_cpf_cnpj",
+            "is_active",
+            "created_at",
+        ),
+        sqlalchemy.Index("ix_charges_created_id", "created_at", "id"),
+    )
 
     id = sqlalchemy.Column(
         sqlalchemy.String,
@@ -46,6 +61,13 @@ class Charge(Base):
     payed_at = sqlalchemy.Column(
         sqlalchemy.DateTime, nullable=True, default=None
     )
+    # Bumped by every update, a flush of a stale object fails instead of
+    # overwriting a concurrent payment
+    version = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=1, server_default="1"
+    )
+
+    __mapper_args__ = {"version_id_col": version}
 
 
 class APIKey(Base):
@@ -64,8 +86,61 @@ class APIKey(Base):
         sqlalchemy.ForeignKey("entities.cpf_cnpj"),
         nullable=True,
         default=None,
+        index=True,
     )
     is_admin = sqlalchemy.Column(sqlalchemy.Boolean, default=False)
     created_at = sqlalchemy.Column(
         sqlalchemy.DateTime, default=datetime.datetime.utcnow
     )
+
+
+class BalanceSummary(Base):
+    """ Balance Summary
+
+    Totals of the charges of an entity in one of its roles, "creditor" or
+    "debtor". They are kept up to date as charges are created and paid
+    """
+
+    __tablename__ = "balance_summaries"
+
+    cpf_cnpj = sqlalchemy.Column(
+        sqlalchemy.String,
+        sqlalchemy.ForeignKey("entities.cpf_cnpj"),
+        primary_key=True,
+    )
+    role = sqlalchemy.Column(sqlalchemy.String(8), primary_key=True)
+    open_count = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, default=0
+    )
+    open_total = sqlalchemy.Column(
+        sqlalchemy.Float, nullable=False, default=0.0
+    )
+    paid_total = sqlalchemy.Column(
+        sqlalchemy.Float, nullable=False, default=0.0
+    )
+
+
+class IdempotencyKey(Base):
+    """ Idempotency Key
+
+    First response of a write sent with an Idempotency-Key header, retries
+    with the same key get it back. The primary key is a digest of the
+    owner, the route and the header, status_code and body are NULL while
+    the first request runs. A claim older than the lease was left by a
+    request that died, a retry takes it over
+    """
+
+    __tablename__ = "idempotency_keys"
+
+    key_hash = sqlalchemy.Column(sqlalchemy.LargeBinary(16), primary_key=True)
+    request_hash = sqlalchemy.Column(
+        sqlalchemy.LargeBinary(16), nullable=False
+    )
+    status_code = sqlalchemy.Column(sqlalchemy.SmallInteger, nullable=True)
+    body = sqlalchemy.Column(sqlalchemy.LargeBinary, nullable=True)
+    expires_at = sqlalchemy.Column(
+        sqlalchemy.DateTime, nullable=False, index=True
+    )
+    # Start of the request holding the claim, NULL for claims of before the
+    # column, they are stale
+    claimed_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=True)
@@ -0,0 +1,164 @@
+""" Rate Limit
+
+Token buckets per client and route. A client is its verified API key, or
+its IP address on the routes without authentication and for keys that are
+not found, and every route has a budget e.g. "10/60": bursts of up to 10
+requests, refilled at 10 per 60 seconds.
+
+The IP address is the client of uvicorn, behind a proxy it comes from
+X-Forwarded-For only when the proxy is on FORWARDED_ALLOW_IPS, otherwise
+every client shares the budget of the proxy.
+
+Buckets live on a `cache.MemoryKV` for a single process, or on a
+`cache.SQLiteKV` shared by the workers of the host. Budgets are changed
+without a release through the environment e.g.
+
+    RATE_LIMITS=authenticate_login=5/60,filter_charge=240/60
+"""
+
+import collections
+import hashlib
+import math
+import os
+import typing
+
+from . import cache
+
+
+Budget = collections.namedtuple("Budget", "capacity seconds")
+
+# Routes that hash passwords or read many rows get tighter budgets
+ROUTE_BUDGETS = {
+    "authenticate_login": "10/60",
+    "create_entity": "10/60",
+    "export_charge": "10/60",
+    "create_charge_batch": "30/60",
+    "filter_charge": "120/60",
+}
+RATE_LIMIT_DEFAULT = os.environ.get("RATE_LIMIT_DEFAULT", "300/60")
+
+
+class RateLimitExceeded(Exception):
+    """ Rate Limit Exceeded
+
+    This error is raised when a client has spent the budget of a route
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(math.ceil(self.retry_after), 1))
+
+
+def parse_budget(value: str) -> Budget:
+    """ Parse Budget
+
+    e.g. "10/60" -> Budget(capacity=10, seconds=60.0)
+    """
+    capacity, _, seconds = value.partition("/")
+    budget = Budget(int(capacity), float(seconds or 1))
+    if budget.capacity <= 0 or budget.seconds <= 0:
+        raise ValueError(f"Invalid rate limit budget {value!r}")
+
+    return budget
+
+
+def parse_budgets(value: str) -> typing.Dict[str, Budget]:
+    """ Parse Budgets
+
+    e.g. "authenticate_login=5/60,filter_charge=240/60"
+    """
+    budgets = {}
+    for item in value.split(","):
+        if item.strip():
+            route, _, budget = item.partition("=")
+            budgets[route.strip()] = parse_budget(budget.strip())
+
+    return budgets
+
+
+def client_key(api_key_id: typing.Optional[str], ip_address: str) -> str:
+    """ Client Key
+
+    Bucket owner, `api_key_id` of a verified API key or None to use the IP
+    address. Never the key the client sent, an unchecked one is made up
+    for free.
+    """
+    if api_key_id:
+        # Only a digest, the shared backend must not hold key identifiers
+        digest = hashlib.blake2b(api_key_id.encode(), digest_size=16)
+        return "api_key:" + digest.hexdigest()
+
+    return "ip:" + ip_address
+
+
+class RateLimiter:
+    """ Rate Limiter
+
+    Args:
+        backend: `MemoryKV`, `SQLiteKV` or None to turn limits off
+        budgets (dict): `Budget` by route name
+        default (Budget): of the routes without one
+    """
+
+    def __init__(
+        self,
+        backend,
+        budgets: typing.Dict[str, Budget],
+        default: Budget,
+    ):
+        self.backend = backend
+        self.budgets = budgets
+        self.default = default
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def budget(self, route: str) -> Budget:
+        return self.budgets.get(route, self.default)
+
+    def hit(self, route: str, client: str):
+        """ Hit
+
+        Spend a token of the bucket of `client` on `route`
+
+        Raises:
+            RateLimitExceeded: the bucket is empty
+        """
+        if not self.enabled:
+            return
+
+        budget = self.budget(route)
+        wait = self.backend.take(
+            f"rate_limit:{route}:{client}",
+            capacity=budget.capacity,
+            rate=budget.capacity / budget.seconds,
+        )
+        if wait > 0:
+            raise RateLimitExceeded(wait)
+
+    def clear(self):
+        if self.enabled:
+            self.backend.clear()
+
+
+def create_rate_limiter() -> RateLimiter:
+    budgets = {
+        route: parse_budget(budget) for route, budget in ROUTE_BUDGETS.items()
+    }
+    budgets.update(parse_budgets(os.environ.get("RATE_LIMITS", "")))
+    return RateLimiter(
+        cache.create_kv(
+            os.environ.get("RATE_LIMIT_BACKEND", "memory"),
+            maxsize=int(os.environ.get("RATE_LIMIT_SIZE", 65536)),
+            # Idle buckets are full again long before that
+            ttl=3600,
+            path=os.environ.get("RATE_LIMIT_PATH", "./rate_limit.db"),
+        ),
+        budgets,
+        parse_budget(RATE_LIMIT_DEFAULT),
+    )
@@ -1,9 +1,10 @@
 import pydantic
 import enum
-import validate_docbr
 import typing
 import datetime
 
+from . import cpf_cnpj as docs
+
 
 class CpfOrCnpj(str):
     @classmethod
@@ -15,11 +16,11 @@ class CpfOrCnpj(str):
         if not isinstance(v, str):
             raise TypeError("string required")
 
-        cpf, cnpj = validate_docbr.CPF(), validate_docbr.CNPJ()
-        if not (cpf.validate(v) or cnpj.validate(v)):
+        document = docs.parse(v)
+        if not document:
             raise TypeError("Invalid CPF / CNPJ")
 
-        return "".join(filter(str.isdigit, v))
+        return document.cpf_cnpj
 
     def __repr__(self):
         return f"CpfOrCnpj({super().__repr__()})"
@@ -30,6 +31,11 @@ class EntityTypeEnum(str, enum.Enum):
     pf = "pf"
 
 
+class ExportFormatEnum(str, enum.Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
 class EntityBase(pydantic.BaseModel):
     class Config:
         orm_mode = True
@@ -49,16 +55,8 @@ class Entity(EntityBase):
         if "cpf_cnpj" not in values:
             return None
 
-        cpf_cnpj = values["cpf_cnpj"]
-
-        cpf, cnpj = validate_docbr.CPF(), validate_docbr.CNPJ()
-        if cpf.validate(cpf_cnpj):
-            return EntityTypeEnum.pf
-
-        if cnpj.validate(cpf_cnpj):
-            return EntityTypeEnum.pj
-
-        return None
+        type_entity = docs.document_type(values["cpf_cnpj"])
+        return EntityTypeEnum(type_entity) if type_entity else None
 
 
 class EntityCreate(EntityBase):
@@ -86,6 +84,15 @@ class ChargeCreate(pydantic.BaseModel):
         return creditor_cpf_cnpj
 
 
+CHARGE_BATCH_MAX_SIZE = 5000
+
+
+class ChargeBatchCreate(pydantic.BaseModel):
+    charges: pydantic.conlist(
+        ChargeCreate, min_items=1, max_items=CHARGE_BATCH_MAX_SIZE
+    )
+
+
 class ChargeDatabase(pydantic.BaseModel):
     class Config:
         orm_mode = True
@@ -99,6 +106,18 @@ class ChargeDatabase(pydantic.BaseModel):
     payed_at: datetime.datetime = None
 
 
+class ChargeBatchItem(pydantic.BaseModel):
+    index: int
+    status_code: int
+    charge: typing.Optional[ChargeDatabase] = None
+    detail: typing.Optional[str] = None
+
+
+class ChargeBatchResult(pydantic.BaseModel):
+    created: int
+    results: typing.List[ChargeBatchItem]
+
+
 class ChargeFullInfo(pydantic.BaseModel):
     class Config:
         orm_mode = True
@@ -112,6 +131,52 @@ class ChargeFullInfo(pydantic.BaseModel):
     payed_at: datetime.datetime = None
 
 
+class ChargePage(pydantic.BaseModel):
+    items: typing.List[ChargeFullInfo]
+    # `Charge.version` of each item, for the ETag of the page
+    versions: typing.List[int] = []
+    next_cursor: typing.Optional[str] = None
+
+
+class BalanceTotals(pydantic.BaseModel):
+    class Config:
+        orm_mode = True
+
+    open_count: int = 0
+    open_total: float = 0.0
+    paid_total: float = 0.0
+
+
+class Balance(pydantic.BaseModel):
+    cpf_cnpj: str
+    creditor: BalanceTotals
+    debtor: BalanceTotals
+
+
+# Output of DB-trusted rows built as plain dicts, they match `Entity` and
+# `ChargeFullInfo` without paying for their validation
+
+
+def entity_dict(db_entity) -> dict:
+    return {
+        "name": db_entity.name,
+        "cpf_cnpj": db_entity.cpf_cnpj,
+        "type_entity": docs.document_type(db_entity.cpf_cnpj),
+    }
+
+
+def charge_full_info_dict(db_charge, db_debtor, db_creditor) -> dict:
+    return {
+        "id": db_charge.id,
+        "debtor": entity_dict(db_debtor),
+        "creditor": entity_dict(db_creditor),
+        "debito": db_charge.debito,
+        "is_active": db_charge.is_active,
+        "created_at": db_charge.created_at,
+        "payed_at": db_charge.payed_at,
+    }
+
+
 class ChargeFilter(pydantic.BaseModel):
     debtor_cpf_cnpj: typing.Optional[CpfOrCnpj] = None
     creditor_cpf_cnpj: typing.Optional[CpfOrCnpj] = None
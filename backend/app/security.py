@@ -1,14 +1,152 @@
-import passlib.context
+""" Security
 
+Password hashing. bcrypt is slow on purpose, so the work is sent to a
+process pool instead of holding the worker that serves the request.
+"""
 
-pwd_context = passlib.context.CryptContext(
-    schemes=["bcrypt"], deprecated="auto"
+import asyncio
+import concurrent.futures
+import functools
+import os
+import threading
+import time
+import typing
+
+import sqlalchemy.util
+
+from . import metrics
+
+if typing.TYPE_CHECKING:
+    import passlib.context
+
+
+# Number of processes hashing passwords, 0 hashes on the calling thread
+PASSWORD_HASH_WORKERS = int(
+    os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1)
+)
+# Jobs running or waiting for a process, more than that are refused
+PASSWORD_HASH_QUEUE_SIZE = int(
+    os.environ.get("PASSWORD_HASH_QUEUE_SIZE", 8 * PASSWORD_HASH_WORKERS)
 )
+# Hashes made with other rounds are replaced on the next login
+PASSWORD_BCRYPT_ROUNDS = int(os.environ.get("PASSWORD_BCRYPT_ROUNDS", 12))
+
+
+@functools.lru_cache(maxsize=None)
+def get_pwd_context() -> "passlib.context.CryptContext":
+    # passlib and bcrypt load on the first hash, not when a worker starts
+    import passlib.context
+
+    return passlib.context.CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__rounds=PASSWORD_BCRYPT_ROUNDS,
+    )
+
+
+class PasswordHasherBusy(Exception):
+    """ Password Hasher Busy
+
+    This error is raised when the password hashing queue is full
+    """
+    pass
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(PASSWORD_HASH_QUEUE_SIZE, 1))
+
+
+def _get_executor() -> concurrent.futures.ProcessPoolExecutor:
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            import multiprocessing
+
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PASSWORD_HASH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    return _executor
+
+
+def shutdown():
+    global _executor
+
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+
+def _wait(future: concurrent.futures.Future):
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return future.result()
+
+    # On the event loop thread data access runs inside the greenlet of
+    # AsyncSession.run_sync, so wait without blocking the loop
+    return sqlalchemy.util.await_only(asyncio.wrap_future(future, loop=loop))
+
+
+def _run(function: typing.Callable, *args):
+    if PASSWORD_HASH_WORKERS <= 0:
+        return function(*args)
+
+    if not _slots.acquire(blocking=False):
+        metrics.PASSWORD_HASH_REJECTED.inc()
+        raise PasswordHasherBusy()
+
+    try:
+        future = _get_executor().submit(function, *args)
+    except BaseException:
+        _slots.release()
+        raise
+
+    future.add_done_callback(lambda _: _slots.release())
+    return _wait(future)
+
+
+def _submit(function: typing.Callable, *args):
+    start = time.perf_counter()
+    result = _run(function, *args)
+    metrics.PASSWORD_HASH_DURATION.observe(
+        time.perf_counter() - start, operation=function.__name__.lstrip("_")
+    )
+    return result
+
+
+def _verify_password(plain_password: str, hashed_password: str) -> bool:
+    return get_pwd_context().verify(plain_password, hashed_password)
+
+
+def _verify_and_update(
+    plain_password: str, hashed_password: str
+) -> typing.Tuple[bool, typing.Optional[str]]:
+    return get_pwd_context().verify_and_update(plain_password, hashed_password)
+
+
+def _get_password_hash(password: str) -> str:
+    return get_pwd_context().hash(password)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return _submit(_verify_password, plain_password, hashed_password)
+
+
+def verify_and_update(
+    plain_password: str, hashed_password: str
+) -> typing.Tuple[bool, typing.Optional[str]]:
+    """ Verify And Update
+
+    Verify the password and, when the hash was made with settings that
+    are no longer the current ones, also return a new hash for it
+    """
+    return _submit(_verify_and_update, plain_password, hashed_password)
 
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return _submit(_get_password_hash, password)
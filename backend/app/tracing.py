@@ -0,0 +1,610 @@
+""" Tracing
+
+Lightweight spans for requests, data access functions and SQL
+statements. The trace of a request follows the W3C `traceparent` header,
+an incoming one is continued and the response gives it back.
+
+Finished spans are exported on a background thread, as JSON lines to a
+file or in the OTLP/HTTP JSON format to a collector, e.g.
+
+    TRACING_EXPORTER=file TRACING_FILE=./traces.jsonl
+    TRACING_EXPORTER=otlp TRACING_OTLP_ENDPOINT=http://collector:4318/v1/traces
+
+For local work `python -m app.tracing --port 4318` runs a stand-in
+collector that prints what it receives.
+"""
+
+import abc
+import argparse
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import typing
+
+import sqlalchemy.engine
+import sqlalchemy.event
+import sqlalchemy.orm
+from starlette.routing import Match
+
+
+# "none", "file" or "otlp"
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "none")
+TRACING_FILE = os.environ.get("TRACING_FILE", "./traces.jsonl")
+TRACING_OTLP_ENDPOINT = os.environ.get(
+    "TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces"
+)
+# Share of new traces recorded, incoming ones keep their sampled flag
+TRACING_SAMPLE_RATE = float(os.environ.get("TRACING_SAMPLE_RATE", 1.0))
+SERVICE_NAME = os.environ.get("TRACING_SERVICE_NAME", "xyzcreditos-api")
+
+# Longer statements are cut on the span
+STATEMENT_MAX_LENGTH = 1000
+
+_TRACEPARENT = re.compile(
+    r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$"
+)
+_SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+
+class Span:
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "kind",
+        "sampled",
+        "attributes",
+        "start_ns",
+        "end_ns",
+        "error",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: str = None,
+        kind: str = "internal",
+        sampled: bool = True,
+        attributes: dict = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.kind = kind
+        self.sampled = sampled
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-0{int(self.sampled)}"
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def end(self, error: BaseException = None):
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+        if self.sampled:
+            exporter.export(self)
+
+    def to_otlp(self) -> dict:
+        """ To OTLP
+
+        The span as in the OTLP JSON encoding
+        """
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": _SPAN_KINDS[self.kind],
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error}
+            if self.error
+            else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+
+        return span
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+# EXPORTERS
+
+
+class _BatchExporter(abc.ABC):
+    """ Batch Exporter
+
+    Queue finished spans and write them in batches on a daemon thread, the
+    request never waits for the export. Spans are dropped when the queue
+    is full.
+    """
+
+    def __init__(self, max_queue_size: int = 10000, batch_size: int = 512):
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._worker, name="tracing-exporter", daemon=True
+                )
+                self._thread.start()
+
+    def _worker(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=0.5))
+                except queue.Empty:
+                    break
+
+            self._export_batch(batch)
+
+    def _export_batch(self, batch: typing.List[Span]):
+        try:
+            self.write(batch)
+        except Exception as error:
+            # Exporting must never fail
+            print(f"Could not export spans: {error}", file=sys.stderr)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        """ Flush
+
+        Wait until every queued span is written
+        """
+        if self._thread is not None:
+            self._queue.join()
+
+    @abc.abstractmethod
+    def write(self, spans: typing.List[Span]):
+        pass
+
+
+class NoneExporter:
+    dropped = 0
+
+    def export(self, span: Span):
+        pass
+
+    def flush(self):
+        pass
+
+
+class MemoryExporter:
+    """ Memory Exporter
+
+    Keep finished spans on a list, for tests
+    """
+
+    dropped = 0
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span: Span):
+        self.spans.append(span)
+
+    def flush(self):
+        pass
+
+
+class FileExporter(_BatchExporter):
+    """ File Exporter
+
+    Append spans as JSON lines, one OTLP span per line
+    """
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def write(self, spans: typing.List[Span]):
+        with open(self.path, "a") as output:
+            for span in spans:
+                output.write(json.dumps(span.to_otlp()) + "\n")
+
+
+class OTLPExporter(_BatchExporter):
+    """ OTLP Exporter
+
+    POST spans to an OTLP/HTTP collector with the JSON encoding
+    """
+
+    def __init__(self, endpoint: str, timeout: float = 5.0, **kwargs):
+        super().__init__(**kwargs)
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def write(self, spans: typing.List[Span]):
+        import urllib.request
+
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": _otlp_value(SERVICE_NAME),
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__},
+                            "spans": [span.to_otlp() for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        request = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(body).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+def create_exporter(name: str):
+    if name == "file":
+        return FileExporter(TRACING_FILE)
+
+    if name == "otlp":
+        return OTLPExporter(TRACING_OTLP_ENDPOINT)
+
+    if name == "none":
+        return NoneExporter()
+
+    raise ValueError(f"Unknown tracing exporter {name!r}")
+
+
+exporter = create_exporter(TRACING_EXPORTER)
+
+
+def enabled() -> bool:
+    return not isinstance(exporter, NoneExporter)
+
+
+# SPANS
+
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+def current_span() -> typing.Optional[Span]:
+    return _current_span.get()
+
+
+def parse_traceparent(
+    value: typing.Optional[str],
+) -> typing.Optional[typing.Tuple[str, str, bool]]:
+    """ Parse Traceparent
+
+    Returns:
+        tuple: (trace id, parent span id, sampled), None when the header
+         is missing or malformed
+    """
+    match = _TRACEPARENT.match((value or "").strip().lower())
+    if not match or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+
+    trace_id, parent_id, flags = match.groups()
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def begin_span(
+    name: str,
+    kind: str = "internal",
+    attributes: dict = None,
+    traceparent: str = None,
+) -> Span:
+    """ Begin Span
+
+    Child of the current span, or of `traceparent`, or the root of a new
+    trace. The caller must `end` it.
+    """
+    parent = _current_span.get()
+    if parent is not None:
+        return Span(
+            name,
+            parent.trace_id,
+            parent.span_id,
+            kind,
+            parent.sampled,
+            attributes,
+        )
+
+    incoming = parse_traceparent(traceparent)
+    if incoming:
+        trace_id, parent_id, sampled = incoming
+        return Span(name, trace_id, parent_id, kind, sampled, attributes)
+
+    return Span(
+        name,
+        f"{random.getrandbits(128):032x}",
+        kind=kind,
+        sampled=random.random() < TRACING_SAMPLE_RATE,
+        attributes=attributes,
+    )
+
+
+@contextlib.contextmanager
+def span(name: str, kind: str = "internal", **attributes):
+    """ Span
+
+    Run the block inside a new span, the current one while the block runs
+    """
+    item = begin_span(name, kind, attributes)
+    token = _current_span.set(item)
+    try:
+        yield item
+    except BaseException as error:
+        item.end(error)
+        raise
+    else:
+        item.end()
+    finally:
+        _current_span.reset(token)
+
+
+def traced(function: typing.Callable) -> typing.Callable:
+    """ Traced
+
+    Decorator, calls of the function get a span named after it
+    """
+    name = f"{function.__module__.rpartition('.')[2]}.{function.__name__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return function(*args, **kwargs)
+
+        with span(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+# SQL
+
+
+def _before_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+):
+    if _current_span.get() is None:
+        return
+
+    item = begin_span(
+        "SQL " + statement.lstrip().split(None, 1)[0].upper(),
+        kind="client",
+        attributes={
+            "db.system": conn.dialect.name,
+            "db.statement": statement[:STATEMENT_MAX_LENGTH],
+        },
+    )
+    conn.info.setdefault("tracing_spans", []).append(item)
+
+
+def _after_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+):
+    spans = conn.info.get("tracing_spans")
+    if spans:
+        item = spans.pop()
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            item.set_attribute("db.rowcount", cursor.rowcount)
+        item.end()
+
+
+def _handle_error(context):
+    spans = context.connection.info.get("tracing_spans")
+    if spans:
+        spans.pop().end(context.original_exception)
+
+
+def _before_commit(session):
+    if _current_span.get() is not None:
+        session.info["tracing_commit"] = begin_span("db.commit")
+
+
+def _after_commit(session):
+    item = session.info.pop("tracing_commit", None)
+    if item is not None:
+        item.end()
+
+
+def _after_soft_rollback(session, previous_transaction):
+    item = session.info.pop("tracing_commit", None)
+    if item is not None:
+        item.end(RuntimeError("Rolled back"))
+
+
+_installed = False
+
+
+def install_sql_listeners():
+    """ Install SQL Listeners
+
+    A span per SQL statement and per commit, under the span of the
+    request, it is safe to call more than once
+    """
+    global _installed
+
+    if _installed:
+        return
+
+    engine_class = sqlalchemy.engine.Engine
+    sqlalchemy.event.listen(
+        engine_class, "before_cursor_execute", _before_cursor_execute
+    )
+    sqlalchemy.event.listen(
+        engine_class, "after_cursor_execute", _after_cursor_execute
+    )
+    sqlalchemy.event.listen(engine_class, "handle_error", _handle_error)
+
+    session_class = sqlalchemy.orm.Session
+    sqlalchemy.event.listen(session_class, "before_commit", _before_commit)
+    sqlalchemy.event.listen(session_class, "after_commit", _after_commit)
+    sqlalchemy.event.listen(
+        session_class, "after_soft_rollback", _after_soft_rollback
+    )
+    _installed = True
+
+
+# REQUESTS
+
+
+class TracingMiddleware:
+    """ Tracing Middleware
+
+    Open the server span of every HTTP request, continue the trace of its
+    `traceparent` header and give the header of the span back
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not enabled():
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        traceparent = headers.get(b"traceparent", b"").decode("latin-1")
+        item = begin_span(
+            f"{scope['method']} {route_path(scope)}",
+            kind="server",
+            attributes={
+                "http.method": scope["method"],
+                "http.target": scope["path"],
+            },
+            traceparent=traceparent,
+        )
+        token = _current_span.set(item)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                item.set_attribute("http.status_code", message["status"])
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (b"traceparent", item.traceparent.encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as error:
+            item.end(error)
+            raise
+        else:
+            item.end()
+        finally:
+            _current_span.reset(token)
+
+
+def route_path(scope: dict, default: str = None) -> str:
+    """ Route Path
+
+    Path template of the route that serves the request, e.g.
+    /api/v.1/charge/{charge_id}, or `default` when no route matches, the
+    path itself when there is none. Span names and the route label of
+    `metrics` both come from it
+    """
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+
+    return scope["path"] if default is None else default
+
+
+# STAND-IN COLLECTOR
+
+
+def main(argv: typing.List[str] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.tracing",
+        description="Stand-in OTLP/HTTP collector, prints spans as JSON",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4318)
+    args = parser.parse_args(argv)
+
+    import http.server
+
+    class CollectorHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length))
+            for resource in body.get("resourceSpans", []):
+                for scope in resource.get("scopeSpans", []):
+                    for item in scope.get("spans", []):
+                        print(json.dumps(item), flush=True)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b"{}")
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        (args.host, args.port), CollectorHandler
+    )
+    print(f"Collecting on http://{args.host}:{args.port}/v1/traces")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
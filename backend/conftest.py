@@ -2,29 +2,71 @@ import os
 import unittest.mock
 import pytest
 
+import app.api
 import app.models
 import app.database
+import app.data_access
+import app.metrics
+import app.migrations
 
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
-@pytest.fixture
-def use_db():
+@pytest.fixture(params=["sync", "async"])
+def use_db(request):
     db_path = "./sql_app_test.db"
-    engine = create_engine(
-        f"sqlite:///{db_path}", connect_args={"check_same_thread": False}
+    url = f"sqlite:///{db_path}"
+    async_url = app.database.to_async_url(url)
+
+    engine = app.database.create_engine_from_url(url)
+    read_engine = app.database.create_engine_from_url(url, read_only=True)
+    async_engine = app.database.create_async_engine_from_url(async_url)
+    async_read_engine = app.database.create_async_engine_from_url(
+        async_url, read_only=True
     )
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-    with unittest.mock.patch("app.database.engine", engine):
-        with unittest.mock.patch("app.database.SessionLocal", SessionLocal):
-            app.models.Base.metadata.create_all(engine)
-            yield None
-            app.models.Base.metadata.drop_all(engine)
+    def async_sessionmaker(bind):
+        return sessionmaker(
+            autocommit=False,
+            autoflush=False,
+            expire_on_commit=False,
+            class_=AsyncSession,
+            bind=bind,
+        )
+
+    app.data_access.api_key_cache.clear()
+    if app.data_access.api_key_revocations is not None:
+        app.data_access.api_key_revocations.clear()
+    app.data_access.charge_page_cache.clear()
+    app.api.recent_writers.clear()
+    app.api.rate_limiter.clear()
+    app.metrics.registry.clear()
+    with unittest.mock.patch.multiple(
+        "app.database",
+        SQLALCHEMY_ASYNC=request.param == "async",
+        engine=engine,
+        SessionLocal=sessionmaker(
+            autocommit=False, autoflush=False, bind=engine
+        ),
+        read_engine=read_engine,
+        ReadSessionLocal=sessionmaker(
+            autocommit=False, autoflush=False, bind=read_engine
+        ),
+        async_engine=async_engine,
+        AsyncSessionLocal=async_sessionmaker(async_engine),
+        async_read_engine=async_read_engine,
+        AsyncReadSessionLocal=async_sessionmaker(async_read_engine),
+    ):
+        app.migrations.upgrade(engine)
+        yield None
+        app.models.Base.metadata.drop_all(engine)
 
-    if os.path.exists(db_path):
-        os.remove(db_path)
+    engine.dispose()
+    read_engine.dispose()
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
 
 
 @pytest.fixture
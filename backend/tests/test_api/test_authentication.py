@@ -1,9 +1,16 @@
 import pytest
+import threading
+import unittest.mock
+import passlib.context
+import sqlalchemy.event
 from fastapi.testclient import TestClient
 
 from app import api
+from app import cache
+from app import database
 from app import models
 from app import data_access
+from app import security
 
 client = TestClient(api.app)
 
@@ -99,6 +106,68 @@ class TestLogin:
         response.status_code == 422
         response.json().get("msg") == "Invalid Crendentials"
 
+    def test_hash_with_old_rounds_is_updated(
+        self, payload, db_entity_fixture_with_password, session_maker
+    ):
+        old_context = passlib.context.CryptContext(
+            schemes=["bcrypt"], bcrypt__rounds=4
+        )
+        session = session_maker()
+        entity = session.query(models.Entity).first()
+        entity.hashed_password = old_context.hash(payload["password"])
+        session.commit()
+
+        response = client.post(
+            self.build_url(),
+            json={
+                "cpf_cnpj": entity.cpf_cnpj,
+                "password": payload["password"],
+            },
+        )
+        assert response.status_code == 200
+
+        db_entity = session_maker().query(models.Entity).first()
+        assert db_entity.hashed_password.startswith(
+            f"$2b${security.PASSWORD_BCRYPT_ROUNDS:02d}$"
+        )
+        assert security.verify_password(
+            payload["password"], db_entity.hashed_password
+        )
+
+    def test_current_hash_is_kept(
+        self, payload, db_entity_fixture_with_password, session_maker
+    ):
+        hashed_password = db_entity_fixture_with_password.hashed_password
+        client.post(
+            self.build_url(),
+            json={
+                "cpf_cnpj": db_entity_fixture_with_password.cpf_cnpj,
+                "password": payload["password"],
+            },
+        )
+
+        db_entity = session_maker().query(models.Entity).first()
+        assert db_entity.hashed_password == hashed_password
+
+    def test_when_hash_queue_is_full_returns_service_unavailable(
+        self, payload, db_entity_fixture_with_password
+    ):
+        full_slots = threading.BoundedSemaphore(1)
+        full_slots.acquire()
+        with unittest.mock.patch.multiple(
+            security, PASSWORD_HASH_WORKERS=1, _slots=full_slots
+        ):
+            response = client.post(
+                self.build_url(),
+                json={
+                    "cpf_cnpj": db_entity_fixture_with_password.cpf_cnpj,
+                    "password": payload["password"],
+                },
+            )
+
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
 
 @pytest.mark.usefixtures("use_db")
 class TestLogout:
@@ -117,3 +186,144 @@ class TestLogout:
     def test_when_invalid_api_key_returns_forbidden(self, db_entity_fixture):
         response = client.delete(self.build_url("fake"))
         assert response.status_code == 403
+
+    def test_after_logout_api_key_returns_forbidden(self, db_entity_fixture):
+        url = f"/api/v.1/entity-logged?api_key={db_entity_fixture.api_key}"
+        assert client.get(url).status_code == 200
+
+        client.delete(self.build_url(db_entity_fixture.api_key))
+        assert client.get(url).status_code == 403
+
+
+@pytest.mark.usefixtures("use_db")
+class TestAPIKeyCache:
+    def build_url(self, api_key):
+        return f"/api/v.1/entity-logged?api_key={api_key}"
+
+    def test_second_request_is_a_cache_hit(self, db_entity_fixture):
+        client.get(self.build_url(db_entity_fixture.api_key))
+        client.get(self.build_url(db_entity_fixture.api_key))
+
+        info = data_access.api_key_cache.cache_info()
+        assert info.misses == 1
+        assert info.hits == 1
+        assert info.currsize == 1
+
+    def test_invalid_verifier_is_not_cached(self, db_entity_fixture):
+        identifier, _ = data_access.split_api_key(db_entity_fixture.api_key)
+        response = client.get(self.build_url(f"{identifier}.fake"))
+        assert response.status_code == 403
+        assert data_access.api_key_cache.cache_info().currsize == 0
+
+    def test_logout_invalidates_every_key_of_entity(
+        self, db_entity_fixture, session_maker
+    ):
+        other_api_key = data_access.create_api_key(
+            session_maker(), db_entity_fixture.entity.cpf_cnpj
+        )
+        client.get(self.build_url(db_entity_fixture.api_key))
+        client.get(self.build_url(other_api_key))
+        assert data_access.api_key_cache.cache_info().currsize == 2
+
+        client.delete(f"/api/v.1/authenticate?api_key={other_api_key}")
+        assert data_access.api_key_cache.cache_info().currsize == 0
+        response = client.get(self.build_url(db_entity_fixture.api_key))
+        assert response.status_code == 403
+
+    def test_logout_on_another_worker_revokes_cached_keys(
+        self, db_entity_fixture, session_maker
+    ):
+        url = self.build_url(db_entity_fixture.api_key)
+        assert client.get(url).status_code == 200
+        principal = data_access.get_principal(
+            session_maker(), db_entity_fixture.api_key
+        )
+
+        # The other worker has a cache of its own and shares the revocations
+        with unittest.mock.patch.object(
+            data_access, "api_key_cache", cache.TTLCache()
+        ):
+            data_access.delete_api_key(session_maker(), principal)
+
+        assert data_access.api_key_cache.cache_info().currsize == 1
+        assert client.get(url).status_code == 403
+
+
+@pytest.mark.usefixtures("use_db")
+class TestCurrentPrincipal:
+    def test_principal_joins_the_entity(
+        self, db_entity_fixture, session_maker
+    ):
+        principal = data_access.get_principal(
+            session_maker(), db_entity_fixture.api_key
+        )
+        assert principal.cpf_cnpj == db_entity_fixture.entity.cpf_cnpj
+        assert principal.entity.name == db_entity_fixture.entity.name
+
+    def test_write_resolves_the_api_key_once(self, db_entity_fixture):
+        api_key = db_entity_fixture.api_key
+        with unittest.mock.patch.object(
+            data_access, "get_principal", wraps=data_access.get_principal
+        ) as get_principal:
+            response = client.post(
+                f"/api/v.1/charge?api_key={api_key}",
+                json={
+                    "debtor": {"name": "debtor", "cpf_cnpj": "03497961786765"},
+                    "creditor_cpf_cnpj": db_entity_fixture.entity.cpf_cnpj,
+                    "debito": 100,
+                },
+                headers={"Idempotency-Key": "once"},
+            )
+
+        assert response.status_code == 201
+        assert get_principal.call_count == 1
+
+    def test_write_holds_one_connection(self, db_entity_fixture):
+        engine = (
+            database.async_engine.sync_engine
+            if database.SQLALCHEMY_ASYNC
+            else database.engine
+        )
+        url = f"/api/v.1/charge?api_key={db_entity_fixture.api_key}"
+        charge = {
+            "debtor": {"name": "debtor", "cpf_cnpj": "03497961786765"},
+            "creditor_cpf_cnpj": db_entity_fixture.entity.cpf_cnpj,
+            "debito": 100,
+        }
+        held, most = [0], [0]
+
+        def checkout(*args):
+            held[0] += 1
+            most[0] = max(most[0], held[0])
+
+        def checkin(*args):
+            held[0] -= 1
+
+        sqlalchemy.event.listen(engine.pool, "checkout", checkout)
+        sqlalchemy.event.listen(engine.pool, "checkin", checkin)
+        try:
+            response = client.post(url, json=charge)
+        finally:
+            sqlalchemy.event.remove(engine.pool, "checkout", checkout)
+            sqlalchemy.event.remove(engine.pool, "checkin", checkin)
+
+        assert response.status_code == 201
+        assert most[0] == 1
+
+    def test_session_cookie_is_a_principal(self, db_entity_fixture):
+        response = client.get(
+            "/api/v.1/balance",
+            cookies={"api_key": db_entity_fixture.api_key},
+        )
+        assert response.status_code == 200
+        assert response.json()["cpf_cnpj"] == db_entity_fixture.entity.cpf_cnpj
+
+    def test_admin_key_has_no_entity(self, session_maker):
+        session = session_maker()
+        api_key = data_access.create_api_key(session, None)
+
+        principal = data_access.get_principal(session, api_key)
+        assert principal.cpf_cnpj is None
+        assert principal.entity is None
+        response = client.get(f"/api/v.1/entity-logged?api_key={api_key}")
+        assert response.status_code == 404
@@ -0,0 +1,138 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app import api
+from app import data_access
+from app import models
+
+
+client = TestClient(api.app)
+
+DEBTOR = {"name": "debtor", "cpf_cnpj": "03497961786765"}
+
+
+def summary_rows(session):
+    return {
+        (row.cpf_cnpj, row.role): (
+            row.open_count,
+            row.open_total,
+            row.paid_total,
+        )
+        for row in session.query(models.BalanceSummary)
+    }
+
+
+@pytest.mark.usefixtures("use_db")
+class TestBalance:
+    @pytest.fixture
+    def create_charge(self, db_entity_fixture):
+        def _create(debito=100):
+            response = client.post(
+                f"/api/v.1/charge?api_key={db_entity_fixture.api_key}",
+                json={
+                    "debtor": DEBTOR,
+                    "creditor_cpf_cnpj": db_entity_fixture.entity.cpf_cnpj,
+                    "debito": debito,
+                },
+            )
+            assert response.status_code == 201
+            return response.json()
+
+        return _create
+
+    def pay(self, db_entity_fixture, charge):
+        return client.post(
+            f"/api/v.1/charge/payment?api_key={db_entity_fixture.api_key}",
+            json={
+                "id": charge["id"],
+                "creditor_cpf_cnpj": charge["creditor_cpf_cnpj"],
+            },
+        )
+
+    def build_url(self, api_key=None):
+        return f"/api/v.1/balance?api_key={api_key}"
+
+    def test_without_api_key_returns_forbidden(self):
+        response = client.get(self.build_url())
+        assert response.status_code == 403
+
+    def test_without_charges_returns_zeros(self, db_entity_fixture):
+        response = client.get(self.build_url(db_entity_fixture.api_key))
+        assert response.status_code == 200
+        assert response.json() == {
+            "cpf_cnpj": db_entity_fixture.entity.cpf_cnpj,
+            "creditor": {"open_count": 0, "open_total": 0, "paid_total": 0},
+            "debtor": {"open_count": 0, "open_total": 0, "paid_total": 0},
+        }
+
+    def test_create_charge_adds_to_open(
+        self, create_charge, db_entity_fixture, session_maker
+    ):
+        create_charge(100)
+        create_charge(50)
+
+        response = client.get(self.build_url(db_entity_fixture.api_key))
+        assert response.json()["creditor"] == {
+            "open_count": 2,
+            "open_total": 150,
+            "paid_total": 0,
+        }
+        assert summary_rows(session_maker())[
+            DEBTOR["cpf_cnpj"], "debtor"
+        ] == (2, 150, 0)
+
+    def test_payment_moves_open_to_paid(
+        self, create_charge, db_entity_fixture, session_maker
+    ):
+        charge = create_charge(100)
+        create_charge(50)
+        assert self.pay(db_entity_fixture, charge).status_code == 200
+
+        response = client.get(self.build_url(db_entity_fixture.api_key))
+        assert response.json()["creditor"] == {
+            "open_count": 1,
+            "open_total": 50,
+            "paid_total": 100,
+        }
+        assert summary_rows(session_maker())[
+            DEBTOR["cpf_cnpj"], "debtor"
+        ] == (1, 50, 100)
+
+    def test_paying_twice_counts_once(self, create_charge, db_entity_fixture):
+        charge = create_charge(100)
+        self.pay(db_entity_fixture, charge)
+        self.pay(db_entity_fixture, charge)
+
+        response = client.get(self.build_url(db_entity_fixture.api_key))
+        assert response.json()["creditor"]["paid_total"] == 100
+        assert response.json()["creditor"]["open_count"] == 0
+
+    def test_batch_adds_to_open(self, db_entity_fixture, session_maker):
+        charge = {
+            "debtor": DEBTOR,
+            "creditor_cpf_cnpj": db_entity_fixture.entity.cpf_cnpj,
+            "debito": 10,
+        }
+        response = client.post(
+            f"/api/v.1/charge/batch?api_key={db_entity_fixture.api_key}",
+            json={"charges": [charge] * 3},
+        )
+        assert response.status_code == 200
+
+        response = client.get(self.build_url(db_entity_fixture.api_key))
+        assert response.json()["creditor"]["open_count"] == 3
+        assert response.json()["creditor"]["open_total"] == 30
+
+    def test_rebuild_matches_incremental(
+        self, create_charge, db_entity_fixture, session_maker
+    ):
+        self.pay(db_entity_fixture, create_charge(100))
+        create_charge(50)
+        incremental = summary_rows(session_maker())
+
+        session = session_maker()
+        session.query(models.BalanceSummary).delete()
+        session.commit()
+
+        assert data_access.rebuild_balance_summaries(session) == 2
+        assert summary_rows(session_maker()) == incremental
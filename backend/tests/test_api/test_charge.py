@@ -1,10 +1,17 @@
 import pytest
 import collections
+import csv
 import datetime
+import io
+import json
+import unittest.mock
+import sqlalchemy.orm
 from fastapi.testclient import TestClient
 
 from app import api
+from app import export
 from app import models
+from app import schemas
 from app import data_access
 
 
@@ -385,6 +392,24 @@ class TestFilterCharge:
         )
         assert request.json().pop(0).get("payed_at") == db_charge.payed_at
 
+    def test_body_matches_charge_full_info_schema(self, create_db_charge):
+        request = client.get(
+            self.build_url(
+                api_key=create_db_charge.api_key,
+                debtor_cpf_cnpj=create_db_charge.charge.debtor_cpf_cnpj,
+            )
+        )
+        expected = schemas.ChargeFullInfo(
+            id=create_db_charge.charge.id,
+            debtor=create_db_charge.debtor,
+            creditor=create_db_charge.creditor,
+            debito=create_db_charge.charge.debito,
+            is_active=create_db_charge.charge.is_active,
+            created_at=create_db_charge.charge.created_at,
+            payed_at=create_db_charge.charge.payed_at,
+        )
+        assert request.json() == [json.loads(expected.json())]
+
     def test_invalid_debtor_cpf_cnpj_returns_unprocessable_entity(
         self, create_db_charge
     ):
@@ -522,3 +547,541 @@ class TestPayment:
             },
         )
         assert response.status_code == 404
+
+    def test_paid_charge_is_not_paid_again(
+        self, create_db_charge, session_maker
+    ):
+        json = {
+            "id": create_db_charge.charge.id,
+            "creditor_cpf_cnpj": create_db_charge.charge.creditor_cpf_cnpj,
+        }
+        first = client.post(
+            self.build_url(create_db_charge.api_key), json=json
+        )
+        second = client.post(
+            self.build_url(create_db_charge.api_key), json=json
+        )
+
+        assert first.status_code == 200
+        assert second.status_code == 400
+        assert second.json() == {"detail": "Charge is already paid"}
+
+        summary = session_maker().query(models.BalanceSummary).get(
+            (create_db_charge.charge.creditor_cpf_cnpj, "creditor")
+        )
+        assert summary.paid_total == 100
+
+    def test_another_creditor_returns_bad_request(self, create_db_charge):
+        response = client.post(
+            self.build_url(create_db_charge.api_key),
+            json={
+                "id": create_db_charge.charge.id,
+                "creditor_cpf_cnpj": create_db_charge.charge.debtor_cpf_cnpj,
+            },
+        )
+        assert response.status_code == 400
+
+    def test_payment_bumps_version(self, create_db_charge, session_maker):
+        assert create_db_charge.charge.version == 1
+        client.post(
+            self.build_url(create_db_charge.api_key),
+            json={
+                "id": create_db_charge.charge.id,
+                "creditor_cpf_cnpj": create_db_charge.charge.creditor_cpf_cnpj,
+            },
+        )
+
+        db_charge = session_maker().query(models.Charge).first()
+        assert db_charge.version == 2
+
+    def test_stale_charge_is_not_flushed(
+        self, create_db_charge, session_maker
+    ):
+        session = session_maker()
+        stale = session.query(models.Charge).first()
+        client.post(
+            self.build_url(create_db_charge.api_key),
+            json={
+                "id": create_db_charge.charge.id,
+                "creditor_cpf_cnpj": create_db_charge.charge.creditor_cpf_cnpj,
+            },
+        )
+
+        stale.debito = 200
+        with pytest.raises(sqlalchemy.orm.exc.StaleDataError):
+            session.commit()
+
+
+@pytest.mark.usefixtures("use_db")
+class TestFilterChargePagination:
+    @pytest.fixture
+    def create_db_charges(self, create_db_charge, session_maker):
+        session = session_maker()
+        created_at = create_db_charge.charge.created_at
+        for days in range(1, 5):
+            session.add(
+                models.Charge(
+                    debtor_cpf_cnpj=create_db_charge.debtor.cpf_cnpj,
+                    creditor_cpf_cnpj=create_db_charge.creditor.cpf_cnpj,
+                    debito=100 + days,
+                    is_active=True,
+                    created_at=created_at + datetime.timedelta(days=days),
+                )
+            )
+        session.commit()
+        return create_db_charge
+
+    def build_url(self, api_key, limit=None, cursor=None):
+        url = f"/api/v.1/charge?api_key={api_key}"
+        if limit:
+            url += f"&limit={limit}"
+
+        if cursor:
+            url += f"&cursor={cursor}"
+
+        return url
+
+    def test_first_page_returns_next_cursor(self, create_db_charges):
+        response = client.get(
+            self.build_url(create_db_charges.api_key, limit=2)
+        )
+        assert response.status_code == 200
+        assert len(response.json()) == 2
+        assert response.headers.get("X-Next-Cursor")
+
+    def test_follow_cursor_returns_all_charges_in_order(
+        self, create_db_charges
+    ):
+        debits, cursor = [], None
+        while True:
+            response = client.get(
+                self.build_url(
+                    create_db_charges.api_key, limit=2, cursor=cursor
+                )
+            )
+            assert response.status_code == 200
+            debits += [item["debito"] for item in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+
+        assert debits == [100, 101, 102, 103, 104]
+
+    def test_web_client_gets_more_than_the_default_page(
+        self, create_db_charge, session_maker
+    ):
+        session = session_maker()
+        created_at = create_db_charge.charge.created_at
+        session.add_all(
+            models.Charge(
+                debtor_cpf_cnpj=create_db_charge.debtor.cpf_cnpj,
+                creditor_cpf_cnpj=create_db_charge.creditor.cpf_cnpj,
+                debito=1,
+                is_active=True,
+                created_at=created_at + datetime.timedelta(seconds=index),
+            )
+            for index in range(1, 150)
+        )
+        session.commit()
+
+        # Same requests as getCharges of frontend/static/main.js
+        charges, params = [], {
+            "api_key": create_db_charge.api_key,
+            "debtor_cpf_cnpj": create_db_charge.debtor.cpf_cnpj,
+            "is_active": "true",
+        }
+        while True:
+            response = client.get("/api/v.1/charge", params=params)
+            assert response.status_code == 200
+            charges += response.json()
+            params["cursor"] = response.headers.get("X-Next-Cursor")
+            if not params["cursor"]:
+                break
+
+        assert len(charges) == 150
+        assert len({charge["id"] for charge in charges}) == 150
+
+    def test_last_page_has_no_next_cursor(self, create_db_charges):
+        response = client.get(
+            self.build_url(create_db_charges.api_key, limit=5)
+        )
+        assert len(response.json()) == 5
+        assert "X-Next-Cursor" not in response.headers
+
+    def test_invalid_cursor_returns_bad_request(self, create_db_charges):
+        response = client.get(
+            self.build_url(create_db_charges.api_key, cursor="fake")
+        )
+        assert response.status_code == 400
+        assert response.json().get("detail") == "Invalid cursor"
+
+    def test_limit_above_max_returns_unprocessable_entity(
+        self, create_db_charges
+    ):
+        response = client.get(
+            self.build_url(create_db_charges.api_key, limit=1001)
+        )
+        assert response.status_code == 422
+
+
+@pytest.mark.usefixtures("use_db")
+class TestExportCharge:
+    def build_url(self, api_key, export_format=None, is_active=None):
+        url = f"/api/v.1/charge/export?api_key={api_key}"
+        if export_format:
+            url += f"&format={export_format}"
+
+        if is_active is not None:
+            url += f"&is_active={is_active}"
+
+        return url
+
+    def test_default_format_returns_ndjson(self, create_db_charge):
+        response = client.get(self.build_url(create_db_charge.api_key))
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert rows == [
+            {
+                "id": create_db_charge.charge.id,
+                "debtor_cpf_cnpj": create_db_charge.debtor.cpf_cnpj,
+                "debtor_name": create_db_charge.debtor.name,
+                "creditor_cpf_cnpj": create_db_charge.creditor.cpf_cnpj,
+                "creditor_name": create_db_charge.creditor.name,
+                "debito": create_db_charge.charge.debito,
+                "is_active": True,
+                "created_at": create_db_charge.charge.created_at.isoformat(),
+                "payed_at": None,
+            }
+        ]
+
+    def test_csv_format_returns_header_and_rows(self, create_db_charge):
+        response = client.get(
+            self.build_url(create_db_charge.api_key, export_format="csv")
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert len(rows) == 1
+        assert rows[0]["id"] == create_db_charge.charge.id
+        assert rows[0]["creditor_name"] == create_db_charge.creditor.name
+
+    def test_filter_without_match_returns_only_csv_header(
+        self, create_db_charge
+    ):
+        response = client.get(
+            self.build_url(
+                create_db_charge.api_key, export_format="csv", is_active=False
+            )
+        )
+        assert response.status_code == 200
+        assert response.text.splitlines() == [",".join(export.CHARGE_FIELDS)]
+
+    def test_export_streams_every_batch(self, create_db_charge, session_maker):
+        session = session_maker()
+        for _ in range(4):
+            session.add(
+                models.Charge(
+                    debtor_cpf_cnpj=create_db_charge.debtor.cpf_cnpj,
+                    creditor_cpf_cnpj=create_db_charge.creditor.cpf_cnpj,
+                    debito=10,
+                    is_active=True,
+                )
+            )
+        session.commit()
+
+        with unittest.mock.patch("app.api._EXPORT_BATCH_SIZE", 2):
+            response = client.get(self.build_url(create_db_charge.api_key))
+
+        assert len(response.text.splitlines()) == 5
+
+    def test_when_api_key_is_empty_returns_forbidden(self, create_db_charge):
+        response = client.get(self.build_url(""))
+        assert response.status_code == 403
+
+    def test_invalid_format_returns_unprocessable_entity(
+        self, create_db_charge
+    ):
+        response = client.get(
+            self.build_url(create_db_charge.api_key, export_format="xml")
+        )
+        assert response.status_code == 422
+
+
+@pytest.mark.usefixtures("use_db")
+class TestCreateChargeBatch:
+    @pytest.fixture
+    def payload_batch(self, db_entity_fixture):
+        debtors = [
+            {"name": "debtor-1", "cpf_cnpj": "03497961786765"},
+            {"name": "debtor-2", "cpf_cnpj": "65665387040797"},
+        ]
+        return {
+            "charges": [
+                {
+                    "debtor": debtor,
+                    "creditor_cpf_cnpj": db_entity_fixture.entity.cpf_cnpj,
+                    "debito": 100 + index,
+                }
+                for index, debtor in enumerate(debtors + debtors[:1])
+            ]
+        }
+
+    def build_url(self, api_key=None):
+        return f"/api/v.1/charge/batch?api_key={api_key}"
+
+    def test_valid_returns_ok_per_item(self, payload_batch, db_entity_fixture):
+        response = client.post(
+            self.build_url(db_entity_fixture.api_key), json=payload_batch
+        )
+        assert response.status_code == 200
+
+        data = response.json()
+        assert data["created"] == 3
+        assert [item["status_code"] for item in data["results"]] == [201] * 3
+        assert [item["charge"]["debito"] for item in data["results"]] == [
+            100,
+            101,
+            102,
+        ]
+
+    def test_valid_saves_charges_and_debtors_on_db(
+        self, payload_batch, db_entity_fixture, session_maker
+    ):
+        response = client.post(
+            self.build_url(db_entity_fixture.api_key), json=payload_batch
+        )
+        ids = {item["charge"]["id"] for item in response.json()["results"]}
+
+        session = session_maker()
+        assert {charge.id for charge in session.query(models.Charge)} == ids
+        assert session.query(models.Entity).count() == 3
+
+    def test_other_creditor_is_reported_on_item(
+        self, payload_batch, db_entity_fixture, session_maker
+    ):
+        payload_batch["charges"][1]["creditor_cpf_cnpj"] = "65665387040797"
+        payload_batch["charges"][1]["debtor"]["cpf_cnpj"] = "03497961786765"
+        response = client.post(
+            self.build_url(db_entity_fixture.api_key), json=payload_batch
+        )
+        data = response.json()
+        assert data["created"] == 2
+        assert data["results"][1] == {
+            "index": 1,
+            "status_code": 400,
+            "charge": None,
+            "detail": "CPF / CNPJ is not the same as the creditor",
+        }
+        assert session_maker().query(models.Charge).count() == 2
+
+    def test_invalid_item_returns_unprocessable_entity(
+        self, payload_batch, db_entity_fixture, session_maker
+    ):
+        payload_batch["charges"][2]["debito"] = -1
+        response = client.post(
+            self.build_url(db_entity_fixture.api_key), json=payload_batch
+        )
+        assert response.status_code == 422
+        assert session_maker().query(models.Charge).count() == 0
+
+    def test_empty_batch_returns_unprocessable_entity(
+        self, db_entity_fixture
+    ):
+        response = client.post(
+            self.build_url(db_entity_fixture.api_key), json={"charges": []}
+        )
+        assert response.status_code == 422
+
+    def test_when_api_key_is_empty_returns_forbidden(self, payload_batch):
+        response = client.post(self.build_url(""), json=payload_batch)
+        assert response.status_code == 403
+
+
+@pytest.mark.usefixtures("use_db")
+class TestConditionalGet:
+    def read_url(self, create_db_charge):
+        return (
+            f"/api/v.1/charge/{create_db_charge.charge.id}"
+            f"?api_key={create_db_charge.api_key}"
+        )
+
+    def filter_url(self, create_db_charge):
+        return f"/api/v.1/charge?api_key={create_db_charge.api_key}"
+
+    def pay(self, create_db_charge):
+        response = client.post(
+            f"/api/v.1/charge/payment?api_key={create_db_charge.api_key}",
+            json={
+                "id": create_db_charge.charge.id,
+                "creditor_cpf_cnpj": create_db_charge.charge.creditor_cpf_cnpj,
+            },
+        )
+        assert response.status_code == 200
+
+    @pytest.mark.parametrize("url", ["read_url", "filter_url"])
+    def test_returns_etag(self, create_db_charge, url):
+        response = client.get(getattr(self, url)(create_db_charge))
+        assert response.status_code == 200
+        assert response.headers["ETag"].startswith('"')
+        assert response.headers["Cache-Control"] == "private, no-cache"
+
+    @pytest.mark.parametrize("url", ["read_url", "filter_url"])
+    def test_matching_etag_returns_not_modified(self, create_db_charge, url):
+        url = getattr(self, url)(create_db_charge)
+        etag = client.get(url).headers["ETag"]
+
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["ETag"] == etag
+
+    @pytest.mark.parametrize("url", ["read_url", "filter_url"])
+    def test_weak_etag_in_list_matches(self, create_db_charge, url):
+        url = getattr(self, url)(create_db_charge)
+        etag = client.get(url).headers["ETag"]
+
+        response = client.get(
+            url, headers={"If-None-Match": f'"other", W/{etag}'}
+        )
+        assert response.status_code == 304
+
+    @pytest.mark.parametrize("url", ["read_url", "filter_url"])
+    def test_payment_changes_etag(self, create_db_charge, url):
+        url = getattr(self, url)(create_db_charge)
+        etag = client.get(url).headers["ETag"]
+        self.pay(create_db_charge)
+
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert response.json()
+
+    @pytest.mark.parametrize("url", ["read_url", "filter_url"])
+    def test_any_update_changes_etag(
+        self, create_db_charge, session_maker, url
+    ):
+        url = getattr(self, url)(create_db_charge)
+        etag = client.get(url).headers["ETag"]
+        session = session_maker()
+        charge = session.query(models.Charge).get(create_db_charge.charge.id)
+        charge.debito = 50
+        session.commit()
+        data_access.charge_page_cache.clear()
+
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+    def test_debtor_name_changes_page_etag(
+        self, create_db_charge, session_maker
+    ):
+        url = self.filter_url(create_db_charge)
+        etag = client.get(url).headers["ETag"]
+        session = session_maker()
+        debtor = session.query(models.Entity).get(
+            create_db_charge.debtor.cpf_cnpj
+        )
+        debtor.name = "renamed"
+        session.commit()
+        data_access.charge_page_cache.clear()
+
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert response.json()[0]["debtor"]["name"] == "renamed"
+
+    def test_not_modified_page_keeps_next_cursor(
+        self, create_db_charge, session_maker
+    ):
+        session = session_maker()
+        session.add(
+            models.Charge(
+                debtor_cpf_cnpj=create_db_charge.debtor.cpf_cnpj,
+                creditor_cpf_cnpj=create_db_charge.creditor.cpf_cnpj,
+                debito=10,
+                is_active=True,
+            )
+        )
+        session.commit()
+        url = self.filter_url(create_db_charge) + "&limit=1"
+        first = client.get(url)
+
+        response = client.get(
+            url, headers={"If-None-Match": first.headers["ETag"]}
+        )
+        assert response.status_code == 304
+        assert (
+            response.headers["X-Next-Cursor"]
+            == first.headers["X-Next-Cursor"]
+        )
+
+
+@pytest.mark.usefixtures("use_db")
+class TestFilterChargeCache:
+    def build_url(self, api_key, **params):
+        query = "".join(f"&{name}={value}" for name, value in params.items())
+        return f"/api/v.1/charge?api_key={api_key}{query}"
+
+    def create_charge(self, create_db_charge, debtor_cpf_cnpj):
+        response = client.post(
+            f"/api/v.1/charge?api_key={create_db_charge.api_key}",
+            json={
+                "debtor": {"name": "other", "cpf_cnpj": debtor_cpf_cnpj},
+                "creditor_cpf_cnpj": create_db_charge.creditor.cpf_cnpj,
+                "debito": 10,
+            },
+        )
+        assert response.status_code == 201
+
+    def test_repeated_filter_is_served_from_cache(self, create_db_charge):
+        url = self.build_url(create_db_charge.api_key)
+        first = client.get(url)
+
+        with unittest.mock.patch.object(
+            data_access.schemas, "charge_full_info_dict"
+        ) as build_item:
+            second = client.get(url)
+
+        assert not build_item.called
+        assert second.json() == first.json()
+        assert data_access.charge_page_cache.statistics()["hits"] == 1
+
+    def test_create_charge_invalidates_creditor_pages(self, create_db_charge):
+        url = self.build_url(
+            create_db_charge.api_key,
+            creditor_cpf_cnpj=create_db_charge.creditor.cpf_cnpj,
+        )
+        assert len(client.get(url).json()) == 1
+
+        self.create_charge(create_db_charge, "65665387040797")
+        assert len(client.get(url).json()) == 2
+
+    def test_payment_invalidates_debtor_pages(self, create_db_charge):
+        url = self.build_url(
+            create_db_charge.api_key,
+            debtor_cpf_cnpj=create_db_charge.debtor.cpf_cnpj,
+        )
+        assert client.get(url).json()[0]["is_active"]
+
+        client.post(
+            f"/api/v.1/charge/payment?api_key={create_db_charge.api_key}",
+            json={
+                "id": create_db_charge.charge.id,
+                "creditor_cpf_cnpj": create_db_charge.creditor.cpf_cnpj,
+            },
+        )
+        assert not client.get(url).json()[0]["is_active"]
+
+    def test_other_debtor_keeps_cached_pages(self, create_db_charge):
+        url = self.build_url(
+            create_db_charge.api_key,
+            debtor_cpf_cnpj=create_db_charge.debtor.cpf_cnpj,
+        )
+        client.get(url)
+
+        self.create_charge(create_db_charge, "65665387040797")
+        client.get(url)
+        assert data_access.charge_page_cache.statistics()["hits"] == 1
@@ -113,6 +113,16 @@ class TestReadEntity:
             == "Invalid CPF / CNPJ"
         )
 
+    def test_matching_etag_returns_not_modified(self, db_entity_fixture):
+        url = self.build_url(
+            db_entity_fixture.entity.cpf_cnpj, db_entity_fixture.api_key
+        )
+        etag = client.get(url).headers["ETag"]
+
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
 
 @pytest.mark.usefixtures("use_db")
 class TestReadEntityLogged:
@@ -143,3 +153,32 @@ class TestReadEntityLogged:
             "cpf_cnpj": db_entity.cpf_cnpj,
             "type_entity": db_entity.type_entity,
         }
+
+
+@pytest.mark.usefixtures("use_db")
+class TestFilterEntity:
+    def build_url(self, api_key, type_entity):
+        return f"/api/v.1/entity?api_key={api_key}&type_entity={type_entity}"
+
+    def test_created_entity_is_found_by_type(self, payload):
+        client.post("/api/v.1/entity", json=payload)
+        login = client.post(
+            "/api/v.1/authenticate",
+            json={"cpf_cnpj": payload["cpf_cnpj"], "password": "123"},
+        )
+
+        response = client.get(
+            self.build_url(login.json()["api_key"], type_entity="pf")
+        )
+        assert response.status_code == 200
+        assert [item["cpf_cnpj"] for item in response.json()] == [
+            payload["cpf_cnpj"]
+        ]
+
+    def test_without_entities_of_type_returns_not_found(
+        self, db_entity_fixture
+    ):
+        response = client.get(
+            self.build_url(db_entity_fixture.api_key, type_entity="pj")
+        )
+        assert response.status_code == 404
@@ -0,0 +1,221 @@
+import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import api
+from app import data_access
+from app import models
+from app import schemas
+
+
+client = TestClient(api.app)
+
+DEBTOR_CPF_CNPJ = "03497961786765"
+
+
+@pytest.fixture
+def payload_charge(db_entity_fixture):
+    return {
+        "debtor": {"name": "debtor", "cpf_cnpj": DEBTOR_CPF_CNPJ},
+        "creditor_cpf_cnpj": db_entity_fixture.entity.cpf_cnpj,
+        "debito": 100,
+    }
+
+
+@pytest.mark.usefixtures("use_db")
+class TestIdempotencyKey:
+    def create_charge(self, api_key, payload, key=None):
+        headers = {"Idempotency-Key": key} if key else {}
+        return client.post(
+            f"/api/v.1/charge?api_key={api_key}", json=payload, headers=headers
+        )
+
+    def pay(self, api_key, charge, key=None):
+        headers = {"Idempotency-Key": key} if key else {}
+        return client.post(
+            f"/api/v.1/charge/payment?api_key={api_key}",
+            json={
+                "id": charge["id"],
+                "creditor_cpf_cnpj": charge["creditor_cpf_cnpj"],
+            },
+            headers=headers,
+        )
+
+    def test_retry_replays_first_response(
+        self, db_entity_fixture, payload_charge, session_maker
+    ):
+        api_key = db_entity_fixture.api_key
+        first = self.create_charge(api_key, payload_charge, "retry-1")
+        retry = self.create_charge(api_key, payload_charge, "retry-1")
+
+        assert first.status_code == retry.status_code == 201
+        assert retry.json() == first.json()
+        assert retry.headers["Idempotent-Replayed"] == "true"
+        assert "Idempotent-Replayed" not in first.headers
+        assert session_maker().query(models.Charge).count() == 1
+
+    def test_idempotent_writes_set_read_primary_cookie(
+        self, db_entity_fixture, payload_charge
+    ):
+        api_key = db_entity_fixture.api_key
+        first = self.create_charge(api_key, payload_charge, "cookie-1")
+        retry = self.create_charge(api_key, payload_charge, "cookie-1")
+        payment = self.pay(api_key, first.json(), "cookie-2")
+
+        for response in (first, retry, payment):
+            assert api._READ_PRIMARY_COOKIE in response.cookies
+            assert len(response.raw.headers.getlist("set-cookie")) == 1
+
+    def test_other_keys_create_other_charges(
+        self, db_entity_fixture, payload_charge, session_maker
+    ):
+        api_key = db_entity_fixture.api_key
+        first = self.create_charge(api_key, payload_charge, "first")
+        second = self.create_charge(api_key, payload_charge, "second")
+        third = self.create_charge(api_key, payload_charge)
+
+        assert len({first.json()["id"], second.json()["id"]}) == 2
+        assert third.status_code == 201
+        assert session_maker().query(models.Charge).count() == 3
+
+    def test_payment_retry_replays_payment(
+        self, db_entity_fixture, payload_charge
+    ):
+        api_key = db_entity_fixture.api_key
+        charge = self.create_charge(api_key, payload_charge).json()
+
+        first = self.pay(api_key, charge, "pay-1")
+        retry = self.pay(api_key, charge, "pay-1")
+        assert first.status_code == retry.status_code == 200
+        assert retry.json()["payed_at"] == first.json()["payed_at"]
+
+        balance = client.get(f"/api/v.1/balance?api_key={api_key}").json()
+        assert balance["creditor"]["paid_total"] == 100
+
+    def test_same_key_with_another_body_is_refused(
+        self, db_entity_fixture, payload_charge
+    ):
+        api_key = db_entity_fixture.api_key
+        self.create_charge(api_key, payload_charge, "reused")
+
+        payload_charge["debito"] = 200
+        response = self.create_charge(api_key, payload_charge, "reused")
+        assert response.status_code == 422
+
+    def claim(self, session, cpf_cnpj, payload, key, claimed_at):
+        session.add(
+            models.IdempotencyKey(
+                key_hash=data_access.idempotency_digest(
+                    cpf_cnpj, "create_charge", key
+                ),
+                request_hash=data_access.idempotency_digest(
+                    schemas.ChargeCreate(**payload).json()
+                ),
+                expires_at=datetime.datetime.utcnow()
+                + datetime.timedelta(hours=1),
+                claimed_at=claimed_at,
+            )
+        )
+        session.commit()
+
+    def test_key_in_progress_is_a_conflict(
+        self, db_entity_fixture, payload_charge, session_maker
+    ):
+        session = session_maker()
+        self.claim(
+            session,
+            db_entity_fixture.entity.cpf_cnpj,
+            payload_charge,
+            "running",
+            datetime.datetime.utcnow(),
+        )
+
+        response = self.create_charge(
+            db_entity_fixture.api_key, payload_charge, "running"
+        )
+        assert response.status_code == 409
+        assert response.headers["Retry-After"] == "1"
+        assert session.query(models.Charge).count() == 0
+
+    @pytest.mark.parametrize("age", [datetime.timedelta(minutes=2), None])
+    def test_stale_claim_is_taken_over(
+        self, db_entity_fixture, payload_charge, session_maker, age
+    ):
+        # The request of the claim died, None are claims of before the lease
+        session = session_maker()
+        self.claim(
+            session,
+            db_entity_fixture.entity.cpf_cnpj,
+            payload_charge,
+            "crashed",
+            age and datetime.datetime.utcnow() - age,
+        )
+
+        api_key = db_entity_fixture.api_key
+        first = self.create_charge(api_key, payload_charge, "crashed")
+        retry = self.create_charge(api_key, payload_charge, "crashed")
+
+        assert first.status_code == retry.status_code == 201
+        assert retry.headers["Idempotent-Replayed"] == "true"
+        assert session.query(models.Charge).count() == 1
+
+    def test_failed_request_releases_the_key(
+        self,
+        db_entity_fixture,
+        payload_charge,
+        session_maker,
+        create_db_entity,
+    ):
+        api_key = db_entity_fixture.api_key
+        other = create_db_entity(cpf_cnpj="65665387040797", name="other")
+        payload_charge["creditor_cpf_cnpj"] = other.cpf_cnpj
+        response = self.create_charge(api_key, payload_charge, "k")
+        assert response.status_code == 400
+        assert session_maker().query(models.IdempotencyKey).count() == 0
+
+    def test_expired_key_runs_again(
+        self, db_entity_fixture, payload_charge, session_maker, monkeypatch
+    ):
+        monkeypatch.setattr(data_access, "IDEMPOTENCY_KEY_TTL", -1)
+        api_key = db_entity_fixture.api_key
+        first = self.create_charge(api_key, payload_charge, "expiring")
+        second = self.create_charge(api_key, payload_charge, "expiring")
+
+        assert first.json()["id"] != second.json()["id"]
+
+    def test_keys_are_per_owner(self, db_entity_fixture, payload_charge):
+        api_key = db_entity_fixture.api_key
+        self.create_charge(api_key, payload_charge, "shared")
+
+        response = self.create_charge("invalid.key", payload_charge, "shared")
+        assert response.status_code == 403
+
+    def test_too_long_key_is_refused(self, db_entity_fixture, payload_charge):
+        response = self.create_charge(
+            db_entity_fixture.api_key, payload_charge, "k" * 256
+        )
+        assert response.status_code == 400
+
+
+@pytest.mark.usefixtures("use_db")
+def test_purge_deletes_expired_keys(session_maker):
+    session = session_maker()
+    now = datetime.datetime.utcnow()
+    for name, expires_at in (
+        ("old", now - datetime.timedelta(seconds=1)),
+        ("new", now + datetime.timedelta(hours=1)),
+    ):
+        session.add(
+            models.IdempotencyKey(
+                key_hash=data_access.idempotency_digest(name),
+                request_hash=b"",
+                status_code=201,
+                body=b"{}",
+                expires_at=expires_at,
+            )
+        )
+    session.commit()
+
+    assert data_access.purge_idempotency_keys(session, now) == 1
+    assert session.query(models.IdempotencyKey).count() == 1
@@ -0,0 +1,104 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app import api
+from app import metrics
+
+
+client = TestClient(api.app)
+
+CHARGE_ROUTE = "/api/v.1/charge/{charge_id}"
+
+
+class TestCounter:
+    def test_renders_one_line_per_label_set(self):
+        counter = metrics.Counter("things_total", "Things", ("kind",))
+        counter.inc(kind="a")
+        counter.inc(2, kind="b")
+        counter.inc(kind="a")
+
+        assert counter.render() == [
+            "# HELP things_total Things",
+            "# TYPE things_total counter",
+            'things_total{kind="a"} 2.0',
+            'things_total{kind="b"} 2.0',
+        ]
+
+    def test_label_values_are_escaped(self):
+        counter = metrics.Counter("things_total", "Things", ("kind",))
+        counter.inc(kind='say "hi"\n')
+        assert counter.render()[-1] == (
+            'things_total{kind="say \\"hi\\"\\n"} 1.0'
+        )
+
+
+class TestHistogram:
+    def test_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("took_seconds", "Took", buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+
+        assert histogram.render()[2:] == [
+            'took_seconds_bucket{le="1.0"} 2',
+            'took_seconds_bucket{le="5.0"} 3',
+            'took_seconds_bucket{le="+Inf"} 4',
+            "took_seconds_sum 14.5",
+            "took_seconds_count 4",
+        ]
+
+
+@pytest.mark.usefixtures("use_db")
+class TestMetricsEndpoint:
+    def read_charge(self, db_entity_fixture, charge_id="missing"):
+        return client.get(
+            f"/api/v.1/charge/{charge_id}?api_key={db_entity_fixture.api_key}"
+        )
+
+    def test_is_prometheus_text(self):
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert "# TYPE http_request_duration_seconds histogram" in (
+            response.text
+        )
+
+    def test_counts_requests_by_route_template(self, db_entity_fixture):
+        self.read_charge(db_entity_fixture, "first")
+        self.read_charge(db_entity_fixture, "second")
+
+        assert (
+            metrics.HTTP_REQUESTS.value(
+                method="GET", route=CHARGE_ROUTE, status=404
+            )
+            == 2
+        )
+        assert (
+            metrics.HTTP_REQUEST_DURATION.count(
+                method="GET", route=CHARGE_ROUTE
+            )
+            == 2
+        )
+
+    def test_counts_sql_statements_per_request(self, db_entity_fixture):
+        self.read_charge(db_entity_fixture)
+
+        labels = {"method": "GET", "route": CHARGE_ROUTE}
+        assert metrics.DB_STATEMENTS_PER_REQUEST.count(**labels) == 1
+        # The API key is cached, only the charge is looked up
+        assert metrics.DB_STATEMENTS_PER_REQUEST.sum(**labels) >= 1
+        assert metrics.DB_SECONDS_PER_REQUEST.sum(**labels) > 0
+
+    def test_reports_pools_and_caches(self):
+        text = client.get("/metrics").text
+        assert 'db_pool_checked_out{engine="primary"}' in text
+        assert 'cache_hits_total{cache="charge_page"}' in text
+
+    def test_measures_password_hashing(self, payload):
+        client.post(
+            "/api/v.1/authenticate",
+            json={"cpf_cnpj": payload["cpf_cnpj"], "password": "wrong"},
+        )
+        client.post("/api/v.1/entity", json=payload)
+
+        duration = metrics.PASSWORD_HASH_DURATION
+        assert duration.count(operation="get_password_hash") == 1
@@ -0,0 +1,119 @@
+import unittest.mock
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import api
+from app import cache
+from app import ratelimit
+
+
+client = TestClient(api.app)
+
+
+@pytest.fixture
+def limiter():
+    limiter = ratelimit.RateLimiter(
+        cache.MemoryKV(maxsize=100, ttl=60),
+        {"authenticate_login": ratelimit.Budget(2, 60)},
+        ratelimit.Budget(3, 60),
+    )
+    with unittest.mock.patch.object(api, "rate_limiter", limiter):
+        yield limiter
+
+
+class TestParseBudget:
+    def test_valid(self):
+        assert ratelimit.parse_budget("10/60") == ratelimit.Budget(10, 60.0)
+
+    @pytest.mark.parametrize("value", ["0/60", "10/0", "ten/60"])
+    def test_invalid(self, value):
+        with pytest.raises(ValueError):
+            ratelimit.parse_budget(value)
+
+    def test_budgets_by_route(self):
+        assert ratelimit.parse_budgets("a=1/2, b=3/4,") == {
+            "a": ratelimit.Budget(1, 2.0),
+            "b": ratelimit.Budget(3, 4.0),
+        }
+
+
+def test_client_key_does_not_hold_the_api_key_id():
+    key = ratelimit.client_key("secret-identifier", "10.0.0.1")
+    assert key.startswith("api_key:")
+    assert "secret" not in key
+    assert ratelimit.client_key(None, "10.0.0.1") == "ip:10.0.0.1"
+
+
+@pytest.mark.usefixtures("use_db")
+class TestRateLimit:
+    def login(self, payload, api_key=None):
+        url = "/api/v.1/authenticate"
+        if api_key:
+            url += f"?api_key={api_key}"
+
+        return client.post(
+            url,
+            json={"cpf_cnpj": payload["cpf_cnpj"], "password": "wrong"},
+        )
+
+    def read_charge(self, api_key):
+        return client.get(f"/api/v.1/charge/missing?api_key={api_key}")
+
+    def test_returns_too_many_requests_with_retry_after(
+        self, limiter, payload
+    ):
+        statuses = [self.login(payload).status_code for _ in range(3)]
+        assert statuses[-1] == 429
+        assert 429 not in statuses[:2]
+
+        response = self.login(payload)
+        assert response.status_code == 429
+        assert 1 <= int(response.headers["Retry-After"]) <= 30
+
+    def test_made_up_api_keys_share_the_budget_of_the_ip(
+        self, limiter, payload
+    ):
+        statuses = [
+            self.login(payload, api_key=f"junk{index}.key").status_code
+            for index in range(3)
+        ]
+        assert statuses == [400, 400, 429]
+
+    def test_bad_api_keys_spend_the_budget_of_the_ip(
+        self, limiter, db_entity_fixture
+    ):
+        statuses = [
+            self.read_charge(f"junk{index}.key").status_code
+            for index in range(4)
+        ]
+        assert statuses == [403, 403, 403, 429]
+
+        # Valid keys keep their own budget
+        api_key = db_entity_fixture.api_key
+        assert self.read_charge(api_key).status_code == 404
+
+    def test_routes_have_their_own_budgets(self, limiter, payload):
+        for _ in range(2):
+            self.login(payload)
+        assert self.login(payload).status_code == 429
+
+        response = client.get("/api/v.1/entity-logged")
+        assert response.status_code != 429
+
+    def test_api_keys_have_their_own_buckets(
+        self, limiter, db_entity_fixture
+    ):
+        api_key = db_entity_fixture.api_key
+        for _ in range(3):
+            assert self.read_charge(api_key).status_code == 404
+        assert self.read_charge(api_key).status_code == 429
+
+        assert self.read_charge("another-key").status_code == 403
+
+    def test_disabled_without_backend(self, db_entity_fixture):
+        limiter = ratelimit.RateLimiter(None, {}, ratelimit.Budget(1, 60))
+        with unittest.mock.patch.object(api, "rate_limiter", limiter):
+            for _ in range(3):
+                response = self.read_charge(db_entity_fixture.api_key)
+                assert response.status_code == 404
@@ -0,0 +1,99 @@
+import os
+import unittest.mock
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from app import api
+from app import database
+from app import migrations
+
+NEW_CPF_CNPJ = "65665387040797"
+
+
+@pytest.fixture
+def lagging_replica(use_db):
+    # A replica that did not receive any of the writes yet
+    db_path = "./sql_app_replica_test.db"
+    url = f"sqlite:///{db_path}"
+    engine = database.create_engine_from_url(url)
+    async_engine = database.create_async_engine_from_url(
+        database.to_async_url(url), read_only=True
+    )
+    migrations.upgrade(engine)
+
+    with unittest.mock.patch.multiple(
+        "app.database",
+        ReadSessionLocal=sessionmaker(bind=engine),
+        AsyncReadSessionLocal=sessionmaker(
+            bind=async_engine, class_=AsyncSession, expire_on_commit=False
+        ),
+    ):
+        yield None
+
+    engine.dispose()
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@pytest.mark.usefixtures("lagging_replica")
+class TestReadYourWrites:
+    def build_url(self, cpf_cnpj, api_key):
+        return f"/api/v.1/entity/{cpf_cnpj}?api_key={api_key}"
+
+    def test_without_writes_reads_from_replica(self, db_entity_fixture):
+        client = TestClient(api.app)
+        response = client.get(
+            self.build_url(
+                db_entity_fixture.entity.cpf_cnpj, db_entity_fixture.api_key
+            )
+        )
+        # The replica does not know the api key yet
+        assert response.status_code == 403
+
+    def test_after_write_reads_from_primary(self, db_entity_fixture):
+        client = TestClient(api.app)
+        response = client.post(
+            "/api/v.1/entity",
+            json={"name": "foo", "cpf_cnpj": NEW_CPF_CNPJ, "password": "1"},
+        )
+        assert response.status_code == 201
+
+        response = client.get(
+            self.build_url(NEW_CPF_CNPJ, db_entity_fixture.api_key)
+        )
+        assert response.status_code == 200
+        assert response.json()["name"] == "foo"
+
+    def test_write_sets_read_primary_cookie(self, payload):
+        client = TestClient(api.app)
+        response = client.post("/api/v.1/entity", json=payload)
+        assert api._READ_PRIMARY_COOKIE in response.cookies
+        assert len(response.raw.headers.getlist("set-cookie")) == 1
+
+    def test_cookie_routes_other_workers_to_primary(self, db_entity_fixture):
+        client = TestClient(api.app)
+        client.post(
+            "/api/v.1/entity",
+            json={"name": "foo", "cpf_cnpj": NEW_CPF_CNPJ, "password": "1"},
+        )
+        # Another worker does not share the memory of this one
+        api.recent_writers.clear()
+
+        response = client.get(
+            self.build_url(NEW_CPF_CNPJ, db_entity_fixture.api_key)
+        )
+        assert response.status_code == 200
+
+    def test_expired_cookie_reads_from_replica(self, db_entity_fixture):
+        client = TestClient(api.app)
+        client.cookies[api._READ_PRIMARY_COOKIE] = "1"
+        response = client.get(
+            self.build_url(
+                db_entity_fixture.entity.cpf_cnpj, db_entity_fixture.api_key
+            )
+        )
+        assert response.status_code == 403
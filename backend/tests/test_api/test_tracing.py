@@ -0,0 +1,225 @@
+import http.server
+import json
+import threading
+import unittest.mock
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import api
+from app import metrics
+from app import tracing
+
+
+client = TestClient(api.app)
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+@pytest.fixture
+def exporter():
+    memory = tracing.MemoryExporter()
+    with unittest.mock.patch.object(tracing, "exporter", memory):
+        yield memory
+
+
+def spans_by_name(exporter):
+    return {span.name: span for span in exporter.spans}
+
+
+def children(exporter, parent):
+    return [
+        span for span in exporter.spans if span.parent_id == parent.span_id
+    ]
+
+
+class TestParseTraceparent:
+    def test_valid(self):
+        assert tracing.parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01") == (
+            TRACE_ID,
+            PARENT_ID,
+            True,
+        )
+
+    @pytest.mark.parametrize(
+        "value",
+        [
+            None,
+            "",
+            "garbage",
+            f"01-{TRACE_ID}-{PARENT_ID}-01",
+            f"00-{'0' * 32}-{PARENT_ID}-01",
+            f"00-{TRACE_ID}-{'0' * 16}-01",
+        ],
+    )
+    def test_invalid(self, value):
+        assert tracing.parse_traceparent(value) is None
+
+
+class TestSpan:
+    def test_nested_spans_share_the_trace(self, exporter):
+        with tracing.span("outer") as outer:
+            with tracing.span("inner", key="value") as inner:
+                pass
+
+        assert inner.trace_id == outer.trace_id
+        assert inner.parent_id == outer.span_id
+        assert exporter.spans == [inner, outer]
+        assert inner.to_otlp()["attributes"] == [
+            {"key": "key", "value": {"stringValue": "value"}}
+        ]
+
+    def test_records_errors(self, exporter):
+        with pytest.raises(ValueError):
+            with tracing.span("failing"):
+                raise ValueError("boom")
+
+        otlp = exporter.spans[0].to_otlp()
+        assert otlp["status"] == {"code": 2, "message": "ValueError: boom"}
+
+
+@pytest.mark.usefixtures("use_db")
+class TestRequestTracing:
+    def test_request_span_is_returned_as_traceparent(
+        self, db_entity_fixture, exporter
+    ):
+        response = client.get(
+            f"/api/v.1/charge/missing?api_key={db_entity_fixture.api_key}"
+        )
+
+        server = spans_by_name(exporter)["GET /api/v.1/charge/{charge_id}"]
+        assert server.kind == "server"
+        assert server.attributes["http.status_code"] == 404
+        assert response.headers["traceparent"] == server.traceparent
+
+    def test_span_name_and_metric_route_come_from_the_route(
+        self, db_entity_fixture, exporter
+    ):
+        client.get(
+            f"/api/v.1/charge/missing?api_key={db_entity_fixture.api_key}"
+        )
+        client.get("/missing")
+
+        names = spans_by_name(exporter)
+        assert {"GET /api/v.1/charge/{charge_id}", "GET /missing"} <= set(
+            names
+        )
+        rendered = metrics.registry.render()
+        assert 'route="/api/v.1/charge/{charge_id}"' in rendered
+        assert 'route="unmatched"' in rendered
+
+    def test_continues_incoming_trace(self, db_entity_fixture, exporter):
+        client.get(
+            f"/api/v.1/charge/missing?api_key={db_entity_fixture.api_key}",
+            headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"},
+        )
+
+        server = spans_by_name(exporter)["GET /api/v.1/charge/{charge_id}"]
+        assert server.trace_id == TRACE_ID
+        assert server.parent_id == PARENT_ID
+        assert {span.trace_id for span in exporter.spans} == {TRACE_ID}
+
+    def test_unsampled_incoming_trace_is_not_exported(
+        self, db_entity_fixture, exporter
+    ):
+        response = client.get(
+            f"/api/v.1/charge/missing?api_key={db_entity_fixture.api_key}",
+            headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-00"},
+        )
+
+        assert response.headers["traceparent"].endswith("-00")
+        assert exporter.spans == []
+
+    def test_payment_spans_data_access_sql_and_commit(
+        self, db_entity_fixture, exporter
+    ):
+        api_key = db_entity_fixture.api_key
+        charge = client.post(
+            f"/api/v.1/charge?api_key={api_key}",
+            json={
+                "debtor": {"name": "debtor", "cpf_cnpj": "03497961786765"},
+                "creditor_cpf_cnpj": db_entity_fixture.entity.cpf_cnpj,
+                "debito": 100,
+            },
+        ).json()
+        exporter.spans.clear()
+
+        client.post(
+            f"/api/v.1/charge/payment?api_key={api_key}",
+            json={
+                "id": charge["id"],
+                "creditor_cpf_cnpj": charge["creditor_cpf_cnpj"],
+            },
+        )
+
+        spans = spans_by_name(exporter)
+        server = spans["POST /api/v.1/charge/payment"]
+        payment = spans["data_access.payment_charge"]
+        assert payment.parent_id == server.span_id
+        assert {span.name for span in children(exporter, payment)} >= {
+            "data_access.update_balance_summaries",
+            "db.commit",
+        }
+
+        statements = [
+            span for span in exporter.spans if span.name.startswith("SQL ")
+        ]
+        assert statements
+        assert all(span.trace_id == server.trace_id for span in statements)
+        assert "SQL UPDATE" in {span.name for span in statements}
+        assert all("db.statement" in span.attributes for span in statements)
+
+    def test_disabled_tracing_adds_no_header(self, db_entity_fixture):
+        response = client.get(
+            f"/api/v.1/charge/missing?api_key={db_entity_fixture.api_key}"
+        )
+        assert "traceparent" not in response.headers
+
+
+class TestExporters:
+    def test_file_exporter_writes_json_lines(self, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        exporter = tracing.FileExporter(str(path))
+        with unittest.mock.patch.object(tracing, "exporter", exporter):
+            with tracing.span("outer"):
+                with tracing.span("inner"):
+                    pass
+        exporter.flush()
+
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [line["name"] for line in lines] == ["inner", "outer"]
+        assert lines[0]["parentSpanId"] == lines[1]["spanId"]
+
+    def test_otlp_exporter_posts_to_collector(self):
+        received = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                received.append(json.loads(self.rfile.read(length)))
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            exporter = tracing.OTLPExporter(
+                f"http://127.0.0.1:{server.server_port}/v1/traces"
+            )
+            with unittest.mock.patch.object(tracing, "exporter", exporter):
+                with tracing.span("exported"):
+                    pass
+            exporter.flush()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        (resource,) = received[0]["resourceSpans"]
+        assert resource["resource"]["attributes"][0]["key"] == "service.name"
+        (span,) = resource["scopeSpans"][0]["spans"]
+        assert span["name"] == "exported"
@@ -0,0 +1,75 @@
+import gzip
+import json
+
+import pytest
+
+from app import assets
+
+
+@pytest.fixture
+def frontend(tmp_path):
+    source = tmp_path / "frontend"
+    (source / "static").mkdir(parents=True)
+    (source / "home").mkdir()
+    (source / "static" / "main.js").write_text("console.log('hi');\n" * 50)
+    (source / "static" / "styles.css").write_text("body { margin: 0; }\n")
+    (source / "home" / "index.html").write_text(
+        '<link rel="stylesheet" href="/static/styles.css">\n'
+        '<script src="/static/main.js"></script>\n'
+        '<script src="https://cdn.example.com/vue.js"></script>\n'
+    )
+    return source
+
+
+def test_hashed_name_follows_content():
+    assert assets.hashed_name("main.js", b"a") != assets.hashed_name(
+        "main.js", b"b"
+    )
+    assert assets.hashed_name("css/site.css", b"a").startswith("css/site.")
+
+
+def test_gzip_copies_do_not_change_between_builds():
+    data = b"console.log('hi');\n" * 50
+    compressed = assets.gzip_compress(data)
+    assert compressed == assets.gzip_compress(data)
+    assert gzip.decompress(compressed) == data
+
+
+def test_build_writes_hashed_and_precompressed_files(frontend, tmp_path):
+    output = tmp_path / "dist"
+    manifest = assets.build(frontend, output)
+
+    original = (frontend / "static" / "main.js").read_bytes()
+    script = output / "static" / manifest["main.js"]
+    compressed = script.with_name(script.name + ".gz")
+    assert script.read_bytes() == original
+    assert gzip.decompress(compressed.read_bytes()) == original
+    assert json.loads((output / "manifest.json").read_text()) == manifest
+
+
+def test_build_skips_copies_that_are_not_smaller(frontend, tmp_path):
+    output = tmp_path / "dist"
+    manifest = assets.build(frontend, output)
+
+    styles = output / "static" / manifest["styles.css"]
+    assert not styles.with_name(styles.name + ".gz").exists()
+
+
+def test_build_points_home_page_at_hashed_files(frontend, tmp_path):
+    output = tmp_path / "dist"
+    manifest = assets.build(frontend, output)
+
+    page = (output / "home" / "index.html").read_text()
+    assert f'href="/static/{manifest["styles.css"]}"' in page
+    assert f'src="/static/{manifest["main.js"]}"' in page
+    assert "https://cdn.example.com/vue.js" in page
+
+
+def test_build_replaces_previous_build(frontend, tmp_path):
+    output = tmp_path / "dist"
+    first = assets.build(frontend, output)
+    (frontend / "static" / "main.js").write_text("console.log('bye');\n")
+    second = assets.build(frontend, output)
+
+    assert first["main.js"] != second["main.js"]
+    assert not (output / "static" / first["main.js"]).exists()
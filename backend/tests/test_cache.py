@@ -0,0 +1,174 @@
+import sqlite3
+import time
+
+import pytest
+
+from app import cache
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def kv(request, tmp_path):
+    return cache.create_kv(
+        request.param, maxsize=3, ttl=60, path=str(tmp_path / "kv.db")
+    )
+
+
+class TestKV:
+    def test_get_returns_what_was_set(self, kv):
+        kv.set("key", {"items": [1, 2]})
+        assert kv.get("key") == {"items": [1, 2]}
+        assert kv.get("missing", "default") == "default"
+
+    def test_counts_hits_and_misses(self, kv):
+        kv.set("key", 1)
+        kv.get("key")
+        kv.get("missing")
+        info = kv.cache_info()
+        assert (info.hits, info.misses, info.currsize) == (1, 1, 1)
+
+    def test_expired_entries_are_misses(self, kv):
+        kv.ttl = 0.01
+        kv.set("key", 1)
+        time.sleep(0.02)
+        assert kv.get("key") is None
+
+    def test_counters_start_at_zero(self, kv):
+        assert kv.counter("generation") == 0
+        assert kv.incr("generation") == 1
+        assert kv.incr("generation") == 2
+        assert kv.counter("generation") == 2
+
+    def test_clear_removes_entries_and_counters(self, kv):
+        kv.set("key", 1)
+        kv.incr("generation")
+        kv.clear()
+        assert kv.get("key") is None
+        assert kv.counter("generation") == 0
+
+    def test_idle_counters_are_dropped_above_their_last_value(self, kv):
+        kv.ttl = 0.01
+        kv.incr("generation", 5)
+        time.sleep(0.03)
+        # Memory counters are dropped as they are read
+        if isinstance(kv, cache.SQLiteKV):
+            kv.purge()
+        assert kv.counter("generation") == 0
+        # Generations 1 to 5 are never handed out again
+        assert kv.incr("other") == 6
+        assert kv.incr("generation") == 6
+
+    def test_busy_counters_are_kept(self, kv):
+        kv.ttl = 0.01
+        kv.incr("generation", 5)
+        if isinstance(kv, cache.SQLiteKV):
+            kv.purge()
+        assert kv.counter("generation") == 5
+
+    def test_take_spends_tokens_until_the_bucket_is_empty(self, kv):
+        waits = [kv.take("bucket", capacity=3, rate=1) for _ in range(4)]
+        assert waits[:3] == [0, 0, 0]
+        assert 0 < waits[3] <= 1
+        # Other buckets are not touched
+        assert kv.take("other", capacity=3, rate=1) == 0
+
+    def test_take_refills_over_time(self, kv):
+        assert kv.take("bucket", capacity=1, rate=100) == 0
+        assert kv.take("bucket", capacity=1, rate=100) > 0
+        time.sleep(0.02)
+        assert kv.take("bucket", capacity=1, rate=100) == 0
+
+    def test_clear_refills_buckets(self, kv):
+        kv.take("bucket", capacity=1, rate=0.001)
+        kv.clear()
+        assert kv.take("bucket", capacity=1, rate=0.001) == 0
+
+
+class TestSQLiteKV:
+    def test_is_shared_between_instances(self, tmp_path):
+        path = str(tmp_path / "kv.db")
+        first = cache.SQLiteKV(path)
+        second = cache.SQLiteKV(path)
+
+        first.set("key", 1)
+        first.incr("generation")
+        assert second.get("key") == 1
+        assert second.counter("generation") == 1
+
+    def test_buckets_are_shared_between_instances(self, tmp_path):
+        path = str(tmp_path / "kv.db")
+        first = cache.SQLiteKV(path)
+        second = cache.SQLiteKV(path)
+
+        assert first.take("bucket", capacity=1, rate=0.001) == 0
+        assert second.take("bucket", capacity=1, rate=0.001) > 0
+
+    def test_purge_keeps_maxsize_entries(self, tmp_path):
+        kv = cache.SQLiteKV(str(tmp_path / "kv.db"), maxsize=2)
+        for key in "abc":
+            kv.set(key, key)
+
+        assert kv.purge() == 1
+        assert len(kv) == 2
+
+    def test_counters_of_older_files_are_kept(self, tmp_path):
+        path = str(tmp_path / "kv.db")
+        connection = sqlite3.connect(path)
+        connection.execute(
+            "CREATE TABLE counters (key TEXT PRIMARY KEY, value INTEGER)"
+        )
+        connection.execute("INSERT INTO counters VALUES ('generation', 3)")
+        connection.commit()
+        connection.close()
+
+        kv = cache.SQLiteKV(path)
+        kv.purge()
+        assert kv.counter("generation") == 3
+        assert kv.incr("generation") == 4
+
+
+class TestCreateKV:
+    def test_none_turns_cache_off(self):
+        assert cache.create_kv("none", maxsize=1, ttl=1) is None
+
+    def test_unknown_backend_raises(self):
+        with pytest.raises(ValueError):
+            cache.create_kv("redis", maxsize=1, ttl=1)
+
+
+class TestTaggedCache:
+    @pytest.fixture
+    def tagged(self, kv):
+        return cache.TaggedCache(kv, namespace="test")
+
+    def test_invalidating_a_tag_changes_keys_that_depend_on_it(self, tagged):
+        key = tagged.key(["creditor:1"], "page")
+        tagged.set(key, "value")
+
+        tagged.invalidate(["creditor:1"])
+        assert tagged.key(["creditor:1"], "page") != key
+        assert tagged.get(tagged.key(["creditor:1"], "page")) is None
+
+    def test_other_tags_are_kept(self, tagged):
+        key = tagged.key(["debtor:2"], "page")
+        tagged.set(key, "value")
+
+        tagged.invalidate(["creditor:1"])
+        assert tagged.get(tagged.key(["debtor:2"], "page")) == "value"
+
+    def test_statistics(self, tagged):
+        key = tagged.key(["all"], "page")
+        tagged.get(key)
+        tagged.set(key, "value")
+        tagged.get(key)
+        tagged.invalidate(["all", "creditor:1"])
+
+        statistics = tagged.statistics()
+        assert statistics["hits"] == 1
+        assert statistics["misses"] == 1
+        assert statistics["invalidations"] == 2
+
+    def test_without_backend_is_disabled(self):
+        tagged = cache.TaggedCache(None, namespace="test")
+        assert not tagged.enabled
+        tagged.invalidate(["all"])
+        assert tagged.statistics()["backend"] == "none"
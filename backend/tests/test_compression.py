@@ -0,0 +1,142 @@
+import asyncio
+import gzip
+import zlib
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, StreamingResponse
+
+from app import api
+from app import compression
+
+
+client = TestClient(api.app)
+
+OPENAPI_URL = "/api/v.1/openapi.json"
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, encodings, expected",
+    [
+        ("gzip, deflate", ("br", "gzip"), "gzip"),
+        ("gzip, br", ("br", "gzip"), "br"),
+        ("gzip;q=1.0, br;q=0.5", ("br", "gzip"), "gzip"),
+        ("*", ("br", "gzip"), "br"),
+        ("*, gzip;q=0", ("gzip",), None),
+        ("identity", ("br", "gzip"), None),
+        ("br", ("gzip",), None),
+        ("gzip;q=bad", ("gzip",), None),
+        (None, ("gzip",), None),
+    ],
+)
+def test_negotiate(accept_encoding, encodings, expected):
+    assert compression.negotiate(accept_encoding, encodings) == expected
+
+
+def streaming_app(chunks):
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    app = Starlette()
+    app.add_middleware(compression.CompressionMiddleware, minimum_size=100)
+    app.add_route(
+        "/small", lambda request: PlainTextResponse("small", status_code=200)
+    )
+    app.add_route(
+        "/stream",
+        lambda request: StreamingResponse(stream(), media_type="text/csv"),
+    )
+    app.add_route(
+        "/image",
+        lambda request: PlainTextResponse(
+            "x" * 1000, media_type="image/png"
+        ),
+    )
+    return TestClient(app)
+
+
+def call(app, path):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "root_path": "",
+        "scheme": "http",
+        "query_string": b"",
+        "headers": [(b"accept-encoding", b"gzip")],
+        "server": ("testserver", 80),
+    }
+    asyncio.run(app(scope, receive, send))
+    return messages
+
+
+class TestCompressionMiddleware:
+    def test_large_json_is_gzipped(self):
+        response = client.get(OPENAPI_URL, headers={"Accept-Encoding": "gzip"})
+
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in response.headers["Vary"]
+        assert int(response.headers["Content-Length"]) < len(
+            response.content
+        )
+        assert response.json()["openapi"]
+
+    def test_not_compressed_without_accept_encoding(self):
+        response = client.get(
+            OPENAPI_URL, headers={"Accept-Encoding": "identity"}
+        )
+        assert "Content-Encoding" not in response.headers
+        assert response.json()["openapi"]
+
+    def test_small_responses_are_not_compressed(self):
+        response = streaming_app([]).get(
+            "/small", headers={"Accept-Encoding": "gzip"}
+        )
+        assert "Content-Encoding" not in response.headers
+        assert response.text == "small"
+
+    def test_binary_types_are_not_compressed(self):
+        response = streaming_app([]).get(
+            "/image", headers={"Accept-Encoding": "gzip"}
+        )
+        assert "Content-Encoding" not in response.headers
+
+    def test_streams_are_compressed_chunk_by_chunk(self):
+        chunks = [f"row,{index}\n".encode() * 20 for index in range(5)]
+        messages = call(streaming_app(chunks).app, "/stream")
+
+        headers = dict(messages[0]["headers"])
+        assert headers[b"content-encoding"] == b"gzip"
+        assert b"content-length" not in headers
+
+        # Every chunk is flushed, it decodes before the stream ends
+        decoder = zlib.decompressobj(31)
+        bodies = [message["body"] for message in messages[1:]]
+        for chunk, body in zip(chunks, bodies):
+            assert decoder.decompress(body) == chunk
+        assert gzip.decompress(b"".join(bodies)) == b"".join(chunks)
+
+    def test_compressed_etag_is_weak(self):
+        app = Starlette()
+        app.add_middleware(compression.CompressionMiddleware, minimum_size=1)
+        app.add_route(
+            "/",
+            lambda request: PlainTextResponse(
+                "x" * 100, headers={"ETag": '"tag"'}
+            ),
+        )
+
+        response = TestClient(app).get(
+            "/", headers={"Accept-Encoding": "gzip"}
+        )
+        assert response.headers["ETag"] == 'W/"tag"'
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from app import cpf_cnpj
+
+
+class TestParse:
+    @pytest.mark.parametrize(
+        "value,expected",
+        [
+            ("80962607401", ("80962607401", "pf")),
+            ("809.626.074-01", ("80962607401", "pf")),
+            ("03497961786765", ("03497961786765", "pj")),
+            ("65.665.387/0407-97", ("65665387040797", "pj")),
+        ],
+    )
+    def test_valid_returns_digits_and_type(self, value, expected):
+        assert cpf_cnpj.parse(value) == expected
+
+    @pytest.mark.parametrize(
+        "value",
+        [
+            "",
+            "12345678910",
+            "80962607402",
+            "03497961786766",
+            "11111111111",
+            "00000000000000",
+            "8096260740",
+            "1234567891-011",
+        ],
+    )
+    def test_invalid_returns_none(self, value):
+        assert cpf_cnpj.parse(value) is None
+        assert not cpf_cnpj.is_valid(value)
+
+    def test_is_memoized(self):
+        cpf_cnpj.parse.cache_clear()
+        cpf_cnpj.parse("80962607401")
+        cpf_cnpj.parse("80962607401")
+        assert cpf_cnpj.cache_info().hits == 1
+
+
+class TestCheckDigits:
+    def test_cpf(self):
+        assert (
+            cpf_cnpj.check_digits("809626074", cpf_cnpj._CPF_WEIGHTS) == "01"
+        )
+
+    def test_cnpj(self):
+        assert (
+            cpf_cnpj.check_digits("034979617867", cpf_cnpj._CNPJ_WEIGHTS)
+            == "65"
+        )
+
+
+class TestValidateMany:
+    def test_returns_document_per_distinct_value(self):
+        assert cpf_cnpj.validate_many(
+            ["80962607401", "80962607401", "fake"]
+        ) == {
+            "80962607401": cpf_cnpj.Document("80962607401", "pf"),
+            "fake": None,
+        }
+
+
+class TestRandom:
+    def test_documents_are_valid(self):
+        rng = random.Random(0)
+        for _ in range(100):
+            assert cpf_cnpj.parse(cpf_cnpj.random_cpf(rng)).type_entity == "pf"
+            assert (
+                cpf_cnpj.parse(cpf_cnpj.random_cnpj(rng)).type_entity == "pj"
+            )
+
+    def test_same_seed_same_documents(self):
+        assert cpf_cnpj.random_cpf(random.Random(1)) == cpf_cnpj.random_cpf(
+            random.Random(1)
+        )
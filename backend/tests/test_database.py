@@ -0,0 +1,199 @@
+import os
+import unittest.mock
+
+import pytest
+import sqlalchemy.exc
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+
+from app import api
+from app import database
+
+
+@pytest.fixture
+def small_pool_engine():
+    db_path = "./sql_app_pool_test.db"
+    with unittest.mock.patch.dict(
+        os.environ,
+        {
+            "SQLALCHEMY_POOL_SIZE": "1",
+            "SQLALCHEMY_POOL_MAX_OVERFLOW": "0",
+            "SQLALCHEMY_POOL_TIMEOUT": "0.05",
+        },
+    ):
+        engine = database.create_engine_from_url(f"sqlite:///{db_path}")
+
+    yield engine
+    engine.dispose()
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+
+class TestEngineOptions:
+    def test_sqlite_file_uses_instrumented_queue_pool(self):
+        options = database.engine_options("sqlite:///./file.db")
+        assert options["connect_args"] == {"check_same_thread": False}
+        assert options["poolclass"] is database.InstrumentedQueuePool
+        assert options["pool_pre_ping"] is False
+
+    def test_sqlite_memory_keeps_its_pool(self):
+        options = database.engine_options("sqlite://")
+        assert "poolclass" not in options
+
+    def test_async_uses_async_pool(self):
+        options = database.engine_options(
+            "sqlite+aiosqlite:///./file.db", use_async=True
+        )
+        assert options["poolclass"] is database.InstrumentedAsyncQueuePool
+
+    def test_postgresql_has_no_sqlite_connect_args(self):
+        options = database.engine_options("postgresql://u:p@host/db")
+        assert "connect_args" not in options
+        assert options["pool_pre_ping"] is True
+        assert options["pool_recycle"] == 1800
+
+    def test_settings_come_from_environment(self):
+        with unittest.mock.patch.dict(
+            os.environ,
+            {"SQLALCHEMY_POOL_SIZE": "42", "SQLALCHEMY_POOL_PRE_PING": "0"},
+        ):
+            options = database.engine_options("postgresql://u:p@host/db")
+
+        assert options["pool_size"] == 42
+        assert options["pool_pre_ping"] is False
+
+    @pytest.mark.parametrize(
+        "url,connect_args",
+        [
+            (
+                "postgresql://u:p@host/db",
+                {"options": "-c statement_timeout=500"},
+            ),
+            (
+                "postgresql+asyncpg://u:p@host/db",
+                {"server_settings": {"statement_timeout": "500"}},
+            ),
+        ],
+    )
+    def test_statement_timeout(self, url, connect_args):
+        with unittest.mock.patch.object(
+            database, "SQLALCHEMY_STATEMENT_TIMEOUT", 500
+        ):
+            options = database.engine_options(url)
+
+        assert options["connect_args"] == connect_args
+
+
+class TestPoolStatistics:
+    def test_reports_checked_out_connections(self, small_pool_engine):
+        with small_pool_engine.connect():
+            statistics = database.pool_statistics(small_pool_engine)
+
+        assert statistics["pool"] == "InstrumentedQueuePool"
+        assert statistics["size"] == 1
+        assert statistics["checked_out"] == 1
+        assert statistics["wait_count"] == 1
+
+    def test_exhausted_pool_fails_fast(self, small_pool_engine):
+        with small_pool_engine.connect():
+            with pytest.raises(sqlalchemy.exc.TimeoutError):
+                small_pool_engine.connect()
+
+        statistics = database.pool_statistics(small_pool_engine)
+        assert statistics["timeouts"] == 1
+        assert statistics["checked_out"] == 0
+
+    def test_exhausted_pool_returns_service_unavailable(
+        self, small_pool_engine
+    ):
+        session_local = sessionmaker(bind=small_pool_engine)
+        with unittest.mock.patch.multiple(
+            database,
+            SessionLocal=session_local,
+            ReadSessionLocal=session_local,
+            SQLALCHEMY_ASYNC=False,
+        ):
+            with small_pool_engine.connect():
+                response = TestClient(api.app).get(
+                    "/api/v.1/entity-logged?api_key=fake.key"
+                )
+
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+
+@pytest.fixture
+def sqlite_url():
+    db_path = "./sql_app_sqlite_test.db"
+    yield f"sqlite:///{db_path}"
+
+    for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def read_pragma(connection, name):
+    return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+
+class TestSqliteProfile:
+    def test_performance_pragmas_are_set_on_connect(self, sqlite_url):
+        engine = database.create_engine_from_url(sqlite_url)
+        with engine.connect() as connection:
+            assert read_pragma(connection, "journal_mode") == "wal"
+            assert read_pragma(connection, "synchronous") == 1  # NORMAL
+            assert read_pragma(connection, "busy_timeout") == 5000
+            assert read_pragma(connection, "cache_size") == -64000
+
+        engine.dispose()
+
+    def test_default_profile_leaves_sqlite_alone(self, sqlite_url):
+        with unittest.mock.patch.object(database, "SQLITE_PROFILE", "default"):
+            engine = database.create_engine_from_url(sqlite_url)
+
+        with engine.connect() as connection:
+            assert read_pragma(connection, "journal_mode") == "delete"
+
+        engine.dispose()
+
+    def test_read_only_engine_refuses_writes(self, sqlite_url):
+        engine = database.create_engine_from_url(sqlite_url)
+        read_engine = database.create_engine_from_url(
+            sqlite_url, read_only=True
+        )
+        with engine.begin() as connection:
+            connection.exec_driver_sql("CREATE TABLE items (id INTEGER)")
+
+        with read_engine.connect() as connection:
+            assert read_pragma(connection, "query_only") == 1
+            with pytest.raises(sqlalchemy.exc.OperationalError):
+                connection.exec_driver_sql("INSERT INTO items VALUES (1)")
+
+        engine.dispose()
+        read_engine.dispose()
+
+    def test_readers_do_not_wait_on_open_write(self, sqlite_url):
+        engine = database.create_engine_from_url(sqlite_url)
+        read_engine = database.create_engine_from_url(
+            sqlite_url, read_only=True
+        )
+        with engine.begin() as connection:
+            connection.exec_driver_sql("CREATE TABLE items (id INTEGER)")
+            connection.exec_driver_sql("INSERT INTO items VALUES (1)")
+
+        with engine.begin() as writer:
+            writer.exec_driver_sql("INSERT INTO items VALUES (2)")
+            with read_engine.connect() as reader:
+                count = reader.exec_driver_sql(
+                    "SELECT count(*) FROM items"
+                ).scalar()
+
+        assert count == 1
+        engine.dispose()
+        read_engine.dispose()
+
+    def test_memory_database_has_no_read_pool(self):
+        assert not database.has_read_pool("sqlite://")
+        assert not database.has_read_pool("postgresql://u:p@host/db")
+        assert database.has_read_pool("sqlite:///./file.db")
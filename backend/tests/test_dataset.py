@@ -0,0 +1,101 @@
+import collections
+import random
+
+import pytest
+import sqlalchemy
+
+from app import cpf_cnpj
+from app import database
+from app import dataset
+from app import models
+
+
+class TestDocuments:
+    def test_bases_are_a_permutation(self):
+        bases = list(dataset.document_bases(3, random.Random(0)))
+        assert sorted(bases) == [f"{number:03d}" for number in range(1000)]
+
+    def test_documents_are_valid_and_distinct(self):
+        documents = list(
+            dataset.iter_entities(2000, random.Random(0), "hash", 0.3)
+        )
+        assert len({item["cpf_cnpj"] for item in documents}) == 2000
+        for item in documents:
+            document = cpf_cnpj.parse(item["cpf_cnpj"])
+            assert document.type_entity == item["type_entity"]
+
+    def test_same_seed_same_rows(self):
+        def rows(seed):
+            rng = random.Random(seed)
+            entities = [
+                item["cpf_cnpj"]
+                for item in dataset.iter_entities(100, rng, "hash")
+            ]
+            return entities, list(
+                dataset.iter_charges(100, entities, rng, creditors=10)
+            )
+
+        assert rows(1) == rows(1)
+        assert rows(1) != rows(2)
+
+
+class TestCharges:
+    @pytest.fixture
+    def charges(self):
+        entities = [str(number) for number in range(100)]
+        return list(
+            dataset.iter_charges(
+                5000, entities, random.Random(0), creditors=10, skew=1.5
+            )
+        )
+
+    def test_few_creditors_hold_most_charges(self, charges):
+        per_creditor = collections.Counter(
+            charge["creditor_cpf_cnpj"] for charge in charges
+        ).most_common()
+        assert len(per_creditor) == 10
+        assert per_creditor[0][1] > 10 * per_creditor[-1][1]
+
+    def test_creditor_is_not_its_own_debtor(self, charges):
+        assert all(
+            charge["creditor_cpf_cnpj"] != charge["debtor_cpf_cnpj"]
+            for charge in charges
+        )
+
+    def test_only_paid_charges_have_payed_at(self, charges):
+        for charge in charges:
+            assert (charge["payed_at"] is None) == charge["is_active"]
+            if charge["payed_at"]:
+                assert charge["payed_at"] >= charge["created_at"]
+
+
+@pytest.mark.usefixtures("use_db")
+class TestGenerate:
+    def test_loads_rows_and_summaries(self, session_maker):
+        result = dataset.generate(
+            database.engine, entities=50, charges=500, seed=3, batch_size=64
+        )
+        assert (result["entities"], result["charges"]) == (50, 500)
+
+        session = session_maker()
+        assert session.query(models.Entity).count() == 50
+        assert session.query(models.Charge).count() == 500
+
+        summaries = models.BalanceSummary
+        open_count = (
+            session.query(sqlalchemy.func.sum(summaries.open_count))
+            .filter(summaries.role == "creditor")
+            .scalar()
+        )
+        assert open_count == session.query(models.Charge).filter_by(
+            is_active=True
+        ).count()
+
+    def test_indexes_are_built_again(self):
+        dataset.generate(database.engine, entities=10, charges=10)
+
+        inspector = sqlalchemy.inspect(database.engine)
+        for table in (models.Entity.__table__, models.Charge.__table__):
+            indexes = inspector.get_indexes(table.name)
+            names = {item["name"] for item in indexes}
+            assert {index.name for index in table.indexes} <= names
@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import unittest.mock
+
+import pytest
+
+from app import api
+from app import cache
+from app import loadtest
+from app import ratelimit
+
+
+class TestPercentile:
+    def test_nearest_rank(self):
+        values = list(range(1, 101))
+        assert loadtest.percentile(values, 50) == 50
+        assert loadtest.percentile(values, 99) == 99
+        assert loadtest.percentile(values, 100) == 100
+
+    def test_empty_is_zero(self):
+        assert loadtest.percentile([], 95) == 0.0
+
+
+class TestParseMix:
+    def test_weights(self):
+        assert loadtest.parse_mix("login=1, payment=4") == {
+            "login": 1,
+            "payment": 4,
+        }
+
+    def test_unknown_operation_raises(self):
+        with pytest.raises(argparse.ArgumentTypeError):
+            loadtest.parse_mix("delete_everything=1")
+
+
+class TestReport:
+    def test_summary_per_route_and_total(self):
+        report = loadtest.Report()
+        report.started, report.finished = 0.0, 2.0
+        for seconds in (0.01, 0.02, 0.03):
+            report.record("GET /charge", seconds, 200)
+        report.record("POST /charge", 0.05, 400)
+
+        summary = report.summary()
+        assert summary["GET /charge"]["requests"] == 3
+        assert summary["GET /charge"]["rps"] == 1.5
+        assert summary["GET /charge"]["p50_ms"] == pytest.approx(20)
+        assert summary["total"]["requests"] == 4
+        assert summary["total"]["statuses"] == {"200": 3, "400": 1}
+
+
+@pytest.mark.usefixtures("use_db")
+class TestRun:
+    def test_in_process_run_reports_every_route(self):
+        report = asyncio.run(
+            loadtest.run(
+                loadtest.ASGITransport(api.app),
+                users=2,
+                duration=60,
+                requests=40,
+                seed=1,
+            )
+        )
+
+        summary = report.summary()
+        assert summary["total"]["requests"] == 40
+        assert {
+            "POST /charge",
+            "GET /charge",
+            "POST /charge/payment",
+        } <= set(summary)
+        assert summary["POST /charge"]["statuses"] == {
+            "201": summary["POST /charge"]["requests"]
+        }
+        assert summary["POST /charge/payment"]["statuses"] == {
+            "200": summary["POST /charge/payment"]["requests"]
+        }
+
+    def test_default_users_log_in_with_rate_limits(self):
+        limiter = ratelimit.RateLimiter(
+            cache.MemoryKV(maxsize=1000, ttl=60),
+            {
+                route: ratelimit.parse_budget(budget)
+                for route, budget in ratelimit.ROUTE_BUDGETS.items()
+            },
+            ratelimit.parse_budget(ratelimit.RATE_LIMIT_DEFAULT),
+        )
+        with unittest.mock.patch.object(api, "rate_limiter", limiter):
+            report = asyncio.run(
+                loadtest.run(
+                    loadtest.ASGITransport(api.app),
+                    duration=60,
+                    requests=40,
+                    seed=1,
+                )
+            )
+
+        assert report.summary()["total"]["requests"] == 40
@@ -0,0 +1,181 @@
+import datetime
+import os
+import unittest.mock
+
+import pytest
+import sqlalchemy
+
+from app import migrations
+from app import models
+
+
+@pytest.fixture
+def engine():
+    db_path = "./sql_app_migrations_test.db"
+    engine = sqlalchemy.create_engine(f"sqlite:///{db_path}")
+    yield engine
+    engine.dispose()
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+
+def index_names(engine, table_name):
+    inspector = sqlalchemy.inspect(engine)
+    return {index["name"] for index in inspector.get_indexes(table_name)}
+
+
+class TestUpgrade:
+    def test_empty_database_applies_all(self, engine):
+        applied = migrations.upgrade(engine)
+        assert [item.version for item in applied] == [
+            item.version for item in migrations.MIGRATIONS
+        ]
+
+        inspector = sqlalchemy.inspect(engine)
+        assert set(models.Base.metadata.tables) <= set(
+            inspector.get_table_names()
+        )
+
+    def test_second_run_applies_nothing(self, engine):
+        migrations.upgrade(engine)
+        assert migrations.upgrade(engine) == []
+
+    def test_creates_performance_indexes(self, engine):
+        migrations.upgrade(engine)
+
+        assert {
+            "ix_charges_creditor_active_created",
+            "ix_charges_debtor_active_created",
+            "ix_charges_created_id",
+        } <= index_names(engine, "charges")
+        assert "ix_apikeys_cpf_cnpj" in index_names(engine, "apikeys")
+
+    def test_database_made_by_create_all_is_adopted(self, engine):
+        # Old databases were made by create_all, without the new indexes
+        models.Base.metadata.create_all(engine)
+        with engine.begin() as connection:
+            for name in (
+                "ix_charges_creditor_active_created",
+                "ix_charges_debtor_active_created",
+                "ix_charges_created_id",
+                "ix_apikeys_cpf_cnpj",
+                "ix_entities_type_entity",
+            ):
+                connection.execute(sqlalchemy.text(f"DROP INDEX {name}"))
+
+        migrations.upgrade(engine)
+
+        assert "ix_charges_debtor_active_created" in index_names(
+            engine, "charges"
+        )
+        with engine.connect() as connection:
+            assert migrations.applied_versions(connection) == {
+                item.version for item in migrations.MIGRATIONS
+            }
+
+    def test_models_match_migrated_indexes(self, engine):
+        migrations.upgrade(engine)
+
+        for table in models.Base.metadata.sorted_tables:
+            expected = {index.name for index in table.indexes}
+            assert expected <= index_names(engine, table.name)
+
+    def test_balance_summaries_are_filled_from_charges(self, engine):
+        with unittest.mock.patch.object(
+            migrations, "MIGRATIONS", migrations.MIGRATIONS[:2]
+        ):
+            migrations.upgrade(engine)
+
+        charges = migrations._reflect(engine, "charges")
+        with engine.begin() as connection:
+            connection.execute(
+                charges.insert(),
+                [
+                    {
+                        "id": str(index),
+                        "creditor_cpf_cnpj": "c",
+                        "debtor_cpf_cnpj": "d",
+                        "debito": 10.0 * (index + 1),
+                        "is_active": index < 2,
+                        "created_at": datetime.datetime.utcnow(),
+                    }
+                    for index in range(3)
+                ],
+            )
+
+        migrations.upgrade(engine)
+
+        with engine.connect() as connection:
+            rows = connection.execute(
+                sqlalchemy.text(
+                    "SELECT cpf_cnpj, role, open_count, open_total, "
+                    "paid_total FROM balance_summaries ORDER BY role"
+                )
+            ).fetchall()
+        assert [tuple(row) for row in rows] == [
+            ("c", "creditor", 2, 30.0, 30.0),
+            ("d", "debtor", 2, 30.0, 30.0),
+        ]
+
+    def test_charge_version_is_added_to_old_charges(self, engine):
+        with unittest.mock.patch.object(
+            migrations, "MIGRATIONS", migrations.MIGRATIONS[:4]
+        ):
+            migrations.upgrade(engine)
+
+        charges = migrations._reflect(engine, "charges")
+        with engine.begin() as connection:
+            connection.execute(
+                charges.insert().values(id="old", is_active=True, debito=1.0)
+            )
+
+        migrations.upgrade(engine)
+
+        with engine.connect() as connection:
+            version = connection.execute(
+                sqlalchemy.text("SELECT version FROM charges")
+            ).scalar()
+        assert version == 1
+
+    def test_claimed_at_is_added_to_old_idempotency_keys(self, engine):
+        with unittest.mock.patch.object(
+            migrations, "MIGRATIONS", migrations.MIGRATIONS[:5]
+        ):
+            migrations.upgrade(engine)
+
+        migrations.upgrade(engine)
+
+        columns = migrations._reflect(engine, "idempotency_keys").c
+        assert columns["claimed_at"].nullable
+
+    def test_type_entity_is_filled_on_old_entities(self, engine):
+        with unittest.mock.patch.object(
+            migrations, "MIGRATIONS", migrations.MIGRATIONS[:6]
+        ):
+            migrations.upgrade(engine)
+
+        entities = migrations._reflect(engine, "entities")
+        with engine.begin() as connection:
+            connection.execute(
+                entities.insert(),
+                [
+                    {"cpf_cnpj": "03497961786765", "name": "company"},
+                    {"cpf_cnpj": "80962607401", "name": "person"},
+                    {"cpf_cnpj": "invalid", "name": "invalid"},
+                ],
+            )
+
+        migrations.upgrade(engine)
+
+        with engine.connect() as connection:
+            rows = connection.execute(
+                sqlalchemy.text(
+                    "SELECT name, type_entity FROM entities ORDER BY name"
+                )
+            ).fetchall()
+        assert [tuple(row) for row in rows] == [
+            ("company", "pj"),
+            ("invalid", None),
+            ("person", "pf"),
+        ]
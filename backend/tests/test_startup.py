@@ -0,0 +1,68 @@
+import json
+import os
+import subprocess
+import sys
+import urllib.parse
+
+from app import data_access, manage, migrations
+
+
+def run_python(code, tmp_path):
+    env = dict(
+        os.environ,
+        SQLALCHEMY_DATABASE_URL=f"sqlite:///{tmp_path / 'startup.db'}",
+    )
+    return subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        env=env,
+        stdout=subprocess.PIPE,
+        text=True,
+    ).stdout
+
+
+def test_import_does_not_touch_database_or_load_passlib(tmp_path):
+    output = run_python(
+        "import json, sys, app.api;"
+        "print(json.dumps(sorted(sys.modules)))",
+        tmp_path,
+    )
+
+    assert not (tmp_path / "startup.db").exists()
+    assert "passlib" not in json.loads(output)
+
+
+def test_startup_applies_migrations(tmp_path):
+    run_python(
+        "import asyncio, app.api;"
+        "asyncio.run(app.api.app.router.startup())",
+        tmp_path,
+    )
+
+    output = run_python(
+        "import app.database, app.migrations;"
+        "connection = app.database.engine.connect();"
+        "print(len(app.migrations.applied_versions(connection)))",
+        tmp_path,
+    )
+    assert int(output) == len(migrations.MIGRATIONS)
+
+
+def test_startup_benchmark_reports_every_step(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv(
+        "SQLALCHEMY_DATABASE_URL", f"sqlite:///{tmp_path / 'startup.db'}"
+    )
+    manage.main(["startup-benchmark", "--runs", "1"])
+
+    output = capsys.readouterr().out
+    assert "-> 403" in output
+    for step in ("import", "startup", "first_request", "total"):
+        assert f"\n{step} " in output
+
+
+def test_startup_benchmark_api_key_is_looked_up():
+    args = manage.build_parser().parse_args(["startup-benchmark"])
+    query = urllib.parse.urlsplit(args.path).query
+    (api_key,) = urllib.parse.parse_qs(query)["api_key"]
+    # Malformed keys are refused before the query
+    assert data_access.split_api_key(api_key)
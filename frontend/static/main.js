@@ -168,9 +168,18 @@ var app = new Vue({
         debtor_cpf_cnpj: search,
         is_active: true,
       }
-      axios.get('/api/v.1/charge', { params: params })
-        .then((response) => {
-          this.chargesList = response.data.map(
+      const charges = [];
+      // Charges come in pages, X-Next-Cursor asks for the next one
+      const getPage = (cursor) => axios.get(
+        '/api/v.1/charge', { params: Object.assign({ cursor: cursor }, params) }
+      ).then((response) => {
+        charges.push(...response.data);
+        const nextCursor = response.headers['x-next-cursor'];
+        return nextCursor ? getPage(nextCursor) : charges;
+      });
+      getPage(undefined)
+        .then((rows) => {
+          this.chargesList = rows.map(
             row => ({
               created_at: moment(row.created_at).format('L'),
               creditor: {